@@ -0,0 +1,94 @@
+"""
+/start throughput benchmark for pending-payment writes.
+
+Simulates a broadcast burst: N users pressing /start concurrently, each
+resulting in one create_pending_payment() call. Compares the original
+one-connection-one-commit-per-row write path against the batched
+write-behind buffer in both durability modes.
+
+    python benchmarks/bench_start.py --users 5000
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def legacy_create_pending_payment(db_path, telegram_id, username, reference):
+    # The pre-async code path: blocking connect + INSERT + commit per call
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(database.UPSERT_PENDING_SQL, (telegram_id, username, reference, now))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def run_legacy(users):
+    for i in range(users):
+        legacy_create_pending_payment(database.DB_PATH, i, f"user{i}", f"MBG-{i}-0")
+
+
+async def run_per_row(users):
+    # Async writer, but still one transaction per row
+    now = int(time.time())
+
+    async def insert(i):
+        async def job(conn):
+            await conn.execute(database.UPSERT_PENDING_SQL, (i, f"user{i}", f"MBG-{i}-0", now))
+        await database._write(job)
+
+    await asyncio.gather(*(insert(i) for i in range(users)))
+
+
+async def run_batched(users):
+    await asyncio.gather(*(
+        database.create_pending_payment(i, f"user{i}", f"MBG-{i}-0")
+        for i in range(users)
+    ))
+    await database.flush_pending_payments()
+
+
+async def bench(label, users, runner, mode="durable", batch_size=database.PENDING_BATCH_SIZE):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.PENDING_WRITE_MODE = mode
+        database.PENDING_BATCH_SIZE = batch_size
+
+        await database.init_db()
+        started = time.perf_counter()
+        await runner(users)
+        elapsed = time.perf_counter() - started
+        await database.close_db()
+
+        conn = sqlite3.connect(database.DB_PATH)
+        rows = conn.execute("SELECT COUNT(*) FROM pending_payments").fetchone()[0]
+        conn.close()
+
+    print(f"{label:<32} {users / elapsed:>10.0f} /start per sec  ({rows} rows, {elapsed:.2f}s)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=database.PENDING_BATCH_SIZE)
+    args = parser.parse_args()
+
+    await bench("legacy (connect+commit per row)", args.users, run_legacy)
+    await bench("writer queue (commit per row)", args.users, run_per_row)
+    await bench(f"durable, batch={args.batch_size}", args.users, run_batched,
+                "durable", args.batch_size)
+    await bench(f"buffered, batch={args.batch_size}", args.users, run_batched,
+                "buffered", args.batch_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
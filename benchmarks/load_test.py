@@ -0,0 +1,382 @@
+"""
+End-to-end load test with fake Telegram and Korapay stand-ins.
+
+Starts a local fake Bot API server, points the bot at it through
+TELEGRAM_API_URL, then drives the real dispatcher and web server:
+
+  1. N concurrent /start updates
+  2. N concurrent /status updates, then FLOOD_STARTS /start updates per
+     user, most of which the anti-flood middleware must drop
+  3. N signed Korapay charge.success webhooks POSTed to /korapay-webhook,
+     timed until the worker pool has processed them all, then N with a
+     forged signature, which must be refused
+  4. N agreement PDF uploads (download, validation, storage)
+
+For each phase it reports throughput, p50/p95/p99 latency, errors and
+DB contention: the writer queue backlog and "db wait", the time callers
+spent inside database functions summed across concurrent calls (so it
+grows far past wall time when queries queue behind each other).
+
+    python benchmarks/load_test.py --users 1000 --concurrency 1000
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_TOKEN = "123456:LOADTEST"
+ADMIN_CHAT_ID = 1
+KORAPAY_SECRET = "sk_loadtest"
+# /start updates per user in the flood phase
+FLOOD_STARTS = 10
+
+
+# ================== FAKE TELEGRAM BOT API ==================
+def minimal_pdf(telegram_id: int) -> bytes:
+    """
+    A small, structurally valid one-page PDF, unique per user.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>",
+    ]
+    out = b"%PDF-1.4\n%% agreement for " + str(telegram_id).encode() + b"\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 4\n0000000000 65535 f \n"
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size 4 /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % xref
+    return out
+
+
+class FakeTelegram:
+    """
+    Answers the Bot API methods the bot uses with canned results, after an
+    optional artificial latency, and serves agreement files for download.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra
+        }
+
+    async def api(self, request):
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method == "getfile":
+            file_id = form["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"documents/{file_id}.pdf"}
+        elif method in ("sendmessage", "senddocument"):
+            result = self._message(form["chat_id"], text=form.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request):
+        self.calls["download"] = self.calls.get("download", 0) + 1
+        telegram_id = int(request.match_info["path"].split("/")[-1].split("-")[1].split(".")[0])
+        return web.Response(body=minimal_pdf(telegram_id), content_type="application/pdf")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        return app
+
+
+async def start_app(app, port: int = 0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+# ================== SYNTHETIC UPDATES ==================
+def message_update(update_id: int, telegram_id: int, **content):
+    from aiogram import types
+
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=types.Chat(id=telegram_id, type="private"),
+            from_user=types.User(id=telegram_id, is_bot=False, first_name="User",
+                                 username=f"user{telegram_id}"),
+            **content
+        )
+    )
+
+
+def korapay_webhook_body(telegram_id: int, payment_reference: str):
+    body = {
+        "event": "charge.success",
+        "data": {
+            "reference": f"KPY-LOAD-{telegram_id}",
+            "payment_reference": payment_reference,
+            "amount": 20000,
+            "currency": "NGN",
+            "status": "success",
+            "metadata": {"telegram_id": telegram_id}
+        }
+    }
+    # Korapay signs the JSON-encoded `data` object with the secret key
+    signature = hmac.new(
+        KORAPAY_SECRET.encode(), json.dumps(body["data"], separators=(",", ":")).encode(),
+        hashlib.sha256
+    ).hexdigest()
+    return json.dumps(body), signature
+
+
+# ================== MEASUREMENT ==================
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class WriterSampler:
+    """
+    Samples the database writer queue while a phase runs.
+    """
+
+    def __init__(self, database, interval: float = 0.005):
+        self.database = database
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.samples.append(self.database._write_queue.qsize())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def db_seconds(metrics) -> float:
+    return sum(series[-1] for series in metrics.DB_LATENCY.values.values())
+
+
+async def run_phase(label, users, concurrency, action, sampler, errors, metrics, settle=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = 0
+    errors_before = errors.count
+    db_before = db_seconds(metrics)
+
+    async def one(telegram_id):
+        nonlocal failed
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await action(telegram_id)
+            except Exception:
+                failed += 1
+            latencies.append(time.perf_counter() - started)
+
+    sampler.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(telegram_id) for telegram_id in users))
+    if settle:
+        await settle()
+    elapsed = time.perf_counter() - started
+    await sampler.stop()
+
+    backlog = sampler.samples or [0]
+    print(
+        f"{label:<10} {len(users) / elapsed:>8.0f}/s  "
+        f"p50 {percentile(latencies, 50) * 1000:>7.1f}ms  "
+        f"p95 {percentile(latencies, 95) * 1000:>7.1f}ms  "
+        f"p99 {percentile(latencies, 99) * 1000:>7.1f}ms  "
+        f"errors {failed + errors.count - errors_before:>4}  "
+        f"writer backlog max {max(backlog):>5} avg {sum(backlog) / len(backlog):>7.1f}  "
+        f"db wait {db_seconds(metrics) - db_before:>8.2f}s"
+    )
+
+
+# ================== MAIN ==================
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="seconds the fake Bot API waits before answering")
+    parser.add_argument("--telegram-rate", type=float, default=10000,
+                        help="send scheduler global rate (Telegram allows ~30/s)")
+    parser.add_argument("--pending-mode", choices=("durable", "buffered"), default="durable")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.api_latency)
+    fake_runner, fake_port = await start_app(fake.app())
+
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_CHAT_ID": str(ADMIN_CHAT_ID),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{fake_port}",
+        "TELEGRAM_GLOBAL_RATE": str(args.telegram_rate),
+        "KORAPAY_SECRET_KEY": KORAPAY_SECRET,
+        # Every request comes from 127.0.0.1; don't let the per-IP limit skew results
+        "KORAPAY_WEBHOOK_RATE": "1000000",
+        "KORAPAY_WEBHOOK_BURST": "1000000",
+        "PENDING_WRITE_MODE": args.pending_mode,
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "ERROR"),
+        "PORT": "0"
+    })
+
+    import bot
+    import database
+    import metrics
+    import throttle
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    sampler = WriterSampler(database)
+
+    await database.init_db()
+    await bot.sender.start()
+    await bot.webhook_workers.start()
+    app_runner = await bot.start_webserver()
+    app_port = app_runner.addresses[0][1]
+
+    users = list(range(1_000_000, 1_000_000 + args.users))
+    update_ids = itertools.count(1)
+    print(f"👥 {args.users} users, concurrency {args.concurrency}, "
+          f"Bot API latency {args.api_latency * 1000:.0f}ms, pending writes {args.pending_mode}")
+
+    async def start(telegram_id):
+        await bot.dp.feed_update(bot.bot, message_update(next(update_ids), telegram_id, text="/start"))
+
+    async def status(telegram_id):
+        await bot.dp.feed_update(bot.bot, message_update(next(update_ids), telegram_id, text="/status"))
+
+    await run_phase("/start", users, args.concurrency, start, sampler, errors, metrics,
+                    settle=database.flush_pending_payments)
+    await run_phase("/status", users, args.concurrency, status, sampler, errors, metrics)
+
+    async def flood(telegram_id):
+        for _ in range(FLOOD_STARTS):
+            await start(telegram_id)
+
+    throttled_before = sum(throttle.THROTTLED_MESSAGES.values.values())
+    await run_phase("flood", users, args.concurrency, flood, sampler, errors, metrics,
+                    settle=database.flush_pending_payments)
+    throttled = sum(throttle.THROTTLED_MESSAGES.values.values()) - throttled_before
+    print(f"🚦 Dropped {throttled:.0f} of {len(users) * FLOOD_STARTS} flood updates")
+
+    references = {}
+    for telegram_id in users:
+        pending = await database.get_pending_payment_by_telegram_id(telegram_id)
+        references[telegram_id] = pending["payment_reference"] if pending else ""
+
+    async with ClientSession() as http:
+        async def webhook(telegram_id):
+            body, signature = korapay_webhook_body(telegram_id, references[telegram_id])
+            async with http.post(
+                f"http://127.0.0.1:{app_port}/korapay-webhook", data=body,
+                headers={"Content-Type": "application/json", "x-korapay-signature": signature}
+            ) as resp:
+                if resp.status != 200 or await resp.text() != "ok":
+                    raise RuntimeError(f"webhook answered {resp.status}")
+
+        await run_phase("webhook", users, args.concurrency, webhook, sampler, errors, metrics,
+                        settle=bot.webhook_workers.queue.join)
+
+        async def forged(telegram_id):
+            body, _ = korapay_webhook_body(telegram_id, references[telegram_id])
+            async with http.post(
+                f"http://127.0.0.1:{app_port}/korapay-webhook", data=body,
+                headers={"Content-Type": "application/json", "x-korapay-signature": "0" * 64}
+            ) as resp:
+                if resp.status != 401:
+                    raise RuntimeError(f"forged webhook answered {resp.status}")
+
+        await run_phase("forged", users, args.concurrency, forged, sampler, errors, metrics)
+
+    async def upload(telegram_id):
+        from aiogram import types
+
+        document = types.Document(
+            file_id=f"agreement-{telegram_id}", file_unique_id=f"agreement-{telegram_id}",
+            file_name="agreement.pdf", mime_type="application/pdf", file_size=600
+        )
+        await bot.dp.feed_update(bot.bot, message_update(next(update_ids), telegram_id, document=document))
+
+    await run_phase("upload", users, args.concurrency, upload, sampler, errors, metrics)
+
+    stats = await database.get_stats()
+    print(f"📊 DB after run: {json.dumps(stats)}")
+    print(f"📡 Fake Bot API calls: {json.dumps(fake.calls, sort_keys=True)}")
+    print(f"📤 Send scheduler: {json.dumps(bot.sender.stats())}")
+    print("🐢 Slowest DB functions (total / mean):")
+    slowest = sorted(
+        ((dict(labels)["function"], series[-1], sum(series[:-1]))
+         for labels, series in metrics.DB_LATENCY.values.items()),
+        key=lambda row: row[1], reverse=True
+    )
+    for function, total, count in slowest[:5]:
+        print(f"   {function:<36} {total:>7.2f}s  {total / count * 1000:>7.2f}ms x {count}")
+
+    await app_runner.cleanup()
+    await bot.webhook_workers.stop()
+    await bot.sender.stop()
+    bot.pdf_validator.close()
+    await database.close_db()
+    await bot.bot.session.close()
+    await fake_runner.cleanup()
+    os.chdir(ROOT)
+    workdir.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
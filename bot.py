@@ -1,136 +1,294 @@
 import os
+import hmac
+import json
+import logging
+import signal
 import asyncio
 import datetime
+import tempfile
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.filters.callback_data import CallbackData
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods import SendDocument, SendMessage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 from aiohttp import web
 from urllib.parse import quote_plus
+from aiogram.webhook.aiohttp_server import setup_application
 
 from database import (
     init_db,
+    close_db,
     create_pending_payment,
     mark_payment_paid,
     mark_agreement_signed,
-    get_user_by_reference,
-    get_user_by_korapay_reference,
-    get_user_by_telegram_id,
     is_payment_paid,
+    get_user_by_telegram_id,
+    claim_webhook_event,
+    add_unmatched_payment,
+    get_unmatched_payments,
+    resolve_unmatched_payment,
+    get_verified_users_page,
+    count_verified_users,
+    get_funnel,
+    find_agreement_document,
+    add_agreement_document,
+    record_agreement_validation,
+    prune_coordination_state,
+    expire_pending_payments,
+    compact_database,
+    EXPORT_COLUMNS,
     ensure_signed_dir
 )
+from payments import (
+    PAYMENT_AMOUNT,
+    SignatureVerifier,
+    build_payment_reference,
+    match_payment,
+    parse_webhook_body,
+    webhook_event_key
+)
+from cache import RecentSet
+from webhook_worker import WebhookWorkerPool
+from sender import KeyedRateLimiter, SendScheduler, PRIORITY_PAYMENT, PRIORITY_ADMIN, PRIORITY_BULK
+from broadcast import BroadcastRunner
+from uploads import AgreementUploadPipeline, UploadTooLarge
+from storage import get_blob_store
+from pdfcheck import PdfValidator, REJECTION_REASONS
+from telegram_webhook import TelegramWebhookHandler
+from metrics import Gauge, TelegramApiMetrics, WEBHOOK_REJECTED, timed_handler, render as render_metrics
+from logs import setup_logging
+from export import EXPORT_FORMATS, export_chunks, export_filename, write_export
+from reconcile import Reconciler, SETTLEMENT_SUFFIXES
+from cluster import Coordinator, SqliteLease, run_processes
+from fsm_storage import get_fsm_storage
+from onboarding import Onboarding, OnboardingStateMiddleware, PAID_STATES, restore_state
+from templates import LANGUAGE_NAMES, LanguageMiddleware, TemplateRegistry, escape_markdown, language_for
+from throttle import ThrottleMiddleware, parse_throttle_rules
 
 # ================== CONFIG ==================
 load_dotenv()
 
+# LOG_LEVEL=DEBUG adds per-lookup detail; LOG_FORMAT=json for log shippers
+setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text"))
+logger = logging.getLogger("bot")
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID"))
 NAIRA_TRADER_LINK = os.getenv("NAIRA_TRADER_LINK")
 PRIVATE_GROUP_LINK = os.getenv("PRIVATE_GROUP_LINK")
 AGREEMENT_LINK = os.getenv("AGREEMENT_LINK")
 KORAPAY_BASE_LINK = os.getenv("KORAPAY_PAYMENT_LINK")
+# Verifies x-korapay-signature; webhooks are refused while it's unset
+KORAPAY_SECRET_KEY = os.getenv("KORAPAY_SECRET_KEY")
+# Per-client-IP limit on /korapay-webhook, requests per second and burst
+KORAPAY_WEBHOOK_RATE = float(os.getenv("KORAPAY_WEBHOOK_RATE", 50))
+KORAPAY_WEBHOOK_BURST = float(os.getenv("KORAPAY_WEBHOOK_BURST", 200))
+# Reverse proxies in front of the web server; the client IP is taken
+# this many entries from the end of X-Forwarded-For (0 = peer address)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+
+# Telegram webhook mode: set TELEGRAM_WEBHOOK_URL to the public base URL of
+# this service to receive updates on the web server instead of polling.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram-webhook")
+# Sent back by Telegram on every webhook call. Without one configured it's
+# derived from the bot token, so every worker and node agrees on it.
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hmac.new(
+    BOT_TOKEN.encode(), b"telegram-webhook-secret", "sha256"
+).hexdigest()
+TELEGRAM_WEBHOOK_CONCURRENCY = int(os.getenv("TELEGRAM_WEBHOOK_CONCURRENCY", 100))
+
+# Self-hosted Bot API server (or the load-test fake) instead of api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Processes to run on this node; they share users.db and the web port.
+# Polling and other run-once work happen on the elected leader only.
+# Rate limits are kept per process, so every configured rate below is
+# split evenly between the workers.
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Bearer token for GET /export/{table}; the route is disabled while unset
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+# Telegram bots can't send files larger than this
+MAX_EXPORT_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+# Korapay transaction exports dropped here are reconciled by the leader
+# every RECONCILE_INTERVAL seconds, then moved to RECONCILE_INBOX/done
+# next to their report
+RECONCILE_INBOX = os.getenv("RECONCILE_INBOX")
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", 3600))
+
+# Seconds a stopping process spends finishing its queued webhook events
+# and outbound messages before it exits
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", 10))
+
+# Unpaid /start references older than this are archived (0 = never)
+PENDING_TTL_DAYS = float(os.getenv("PENDING_TTL_DAYS", 30))
+# How often the leader expires pending payments and compacts the database
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 21600))
+# Free pages returned to the filesystem per maintenance run
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", 2000))
 
 SIGNED_DIR = ensure_signed_dir("signed_agreements")
+INCOMING_DIR = ensure_signed_dir(os.path.join(SIGNED_DIR, ".incoming"))
+MAX_AGREEMENT_MB = int(os.getenv("MAX_AGREEMENT_MB", 10))
+
+# Language for users who haven't picked one and whose Telegram client
+# language we have no texts for: en, pcm (Pidgin) or yo (Yoruba)
+DEFAULT_LANGUAGE = os.getenv("DEFAULT_LANGUAGE", "en")
+
+# Per-user anti-flood limits overriding throttle.DEFAULT_THROTTLE_RULES,
+# as bucket=messages/seconds pairs, e.g. "start=3/60,document=5/60".
+# Buckets are command names, "document" and "message" (anything else).
+THROTTLE_RULES = parse_throttle_rules(os.getenv("THROTTLE_RULES"))
+
+# User-facing texts and keyboards, with the links filled in once
+templates = TemplateRegistry({
+    "naira_trader_link": NAIRA_TRADER_LINK,
+    "private_group_link": PRIVATE_GROUP_LINK,
+    "agreement_link": AGREEMENT_LINK,
+    "payment_link": KORAPAY_BASE_LINK,
+    "payment_amount": PAYMENT_AMOUNT,
+    "max_agreement_mb": MAX_AGREEMENT_MB,
+}, DEFAULT_LANGUAGE)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-init_db()
+async def notify_throttled(message: types.Message, data: dict, retry_after: float):
+    # Throttling runs before the FSM is loaded: Telegram's language only
+    lang = language_for({}, message.from_user)
+    await message.answer(templates.text("throttled", lang, seconds=int(retry_after) + 1))
+
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+bot.session.middleware(TelegramApiMetrics())
+# Onboarding state lives in the FSM; FSM_STORAGE picks where it's kept
+dp = Dispatcher(storage=get_fsm_storage())
+# Ahead of the FSM context, so flooding is dropped before any storage or
+# database lookup. Dispatcher() has already registered the FSM middleware,
+# so it's moved behind the throttle.
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(ThrottleMiddleware(
+    THROTTLE_RULES, exempt={ADMIN_CHAT_ID}, on_throttled=notify_throttled,
+    # Polled updates all reach the leader; webhook updates land on any worker
+    processes=WORKERS if TELEGRAM_WEBHOOK_URL else 1
+))
+dp.update.outer_middleware(dp.fsm)
+dp.message.outer_middleware(OnboardingStateMiddleware())
+dp.message.outer_middleware(LanguageMiddleware())
+
+# Outbound notifications (not direct replies) go through the send
+# scheduler so bursts stay within Telegram's rate limits.
+sender = SendScheduler(
+    bot,
+    global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", 30)) / WORKERS,
+    chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", 1)) / WORKERS,
+    workers=int(os.getenv("TELEGRAM_SEND_WORKERS", 8))
+)
+broadcaster = BroadcastRunner(sender, report_chat_id=ADMIN_CHAT_ID)
+agreement_store = get_blob_store(SIGNED_DIR)
+uploads = AgreementUploadPipeline(
+    bot,
+    max_bytes=MAX_AGREEMENT_MB * 1024 * 1024,
+    workers=int(os.getenv("UPLOAD_WORKERS", 4))
+)
+# PDF parsing is CPU-bound; PDF_VALIDATOR_POOL=thread avoids extra processes
+pdf_validator = PdfValidator(
+    mode=os.getenv("PDF_VALIDATOR_POOL", "process"),
+    workers=int(os.getenv("PDF_VALIDATOR_WORKERS", 2))
+)
+
+def onboarding_state(telegram_id: int) -> FSMContext:
+    """
+    FSM context of a user outside their own updates (payment webhooks,
+    admin commands). Onboarding happens in the private chat, whose id is
+    the user's id.
+    """
+    return dp.fsm.get_context(bot, chat_id=telegram_id, user_id=telegram_id)
 
 # ================== START COMMAND ==================
 @dp.message(Command("start"))
-async def start_cmd(message: types.Message):
+@timed_handler
+async def start_cmd(message: types.Message, state: FSMContext, raw_state: str = None, lang: str = None):
     telegram_id = message.from_user.id
     username = message.from_user.username or "N/A"
-    timestamp = int(datetime.datetime.now().timestamp())
-    reference = f"MBG-{telegram_id}-{timestamp}"
+    reference = build_payment_reference(telegram_id)
 
     # Store pending payment in DB
-    create_pending_payment(
+    await create_pending_payment(
         telegram_id=telegram_id,
         username=username,
         reference=reference
     )
+    # Paying again mustn't lose track of a confirmed payment
+    if raw_state is None:
+        await state.set_state(Onboarding.started)
 
     # Build Korapay payment link
-    korapay_link = f"{KORAPAY_BASE_LINK}?amount=20000&reference={quote_plus(reference)}"
-
-    kb = InlineKeyboardBuilder()
-    kb.button(text="💳 Pay ₦20,000", url=korapay_link)
+    korapay_link = f"{KORAPAY_BASE_LINK}?amount={PAYMENT_AMOUNT}&reference={quote_plus(reference)}"
 
     await message.answer(
-        "👋 *Welcome to MakeBankGuru*\n\n"
-        "To activate your Trading Support Service:\n"
-        "1️⃣ Complete payment\n"
-        "2️⃣ Payment is auto-confirmed\n"
-        "3️⃣ Upload signed agreement\n\n"
-        "No manual verification required.",
+        templates.text("welcome", lang),
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=templates.keyboard("pay", lang, url=korapay_link)
     )
 
 # ================== STATUS COMMAND ==================
 @dp.message(Command("status"))
-async def status_cmd(message: types.Message):
-    telegram_id = message.from_user.id
-    
+@timed_handler
+async def status_cmd(message: types.Message, state: FSMContext, raw_state: str = None, lang: str = None):
     # Check if payment is verified
-    if not is_payment_paid(telegram_id):
-        await message.answer(
-            "⚠️ *Payment Status: Not Verified*\n\n"
-            "Please complete your payment first.\n"
-            "Use /start to get the payment link.",
-            parse_mode="Markdown"
-        )
+    if raw_state not in PAID_STATES:
+        await message.answer(templates.text("status_unpaid", lang), parse_mode="Markdown")
         return
     
     # Check if agreement is signed
-    from database import get_user_by_telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    
-    if user and user['agreement_signed']:
-        await message.answer(
-            "✅ *Status: Fully Activated*\n\n"
-            f"🔗 Register for your Naira Trading Account:\n{NAIRA_TRADER_LINK}\n\n"
-            f"👥 Join our private group:\n{PRIVATE_GROUP_LINK}",
-            parse_mode="Markdown"
-        )
+    if raw_state == Onboarding.activated:
+        await message.answer(templates.text("status_activated", lang), parse_mode="Markdown")
     else:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="📄 Download Agreement Template", url=AGREEMENT_LINK)
-        kb.adjust(1)
-        
         await message.answer(
-            "✅ *Payment: Verified*\n"
-            "⏳ *Agreement: Pending*\n\n"
-            "📋 *Next Step: Upload Signed Agreement*\n\n"
-            "1️⃣ Download the agreement template below\n"
-            "2️⃣ Fill in your details and sign it\n"
-            "3️⃣ Scan/photograph and convert to PDF\n"
-            "4️⃣ Send the PDF file here in this chat\n\n"
-            "⚠️ *Important:* Only PDF files are accepted.",
+            templates.text("status_awaiting_agreement", lang),
             parse_mode="Markdown",
-            reply_markup=kb.as_markup()
+            reply_markup=templates.keyboard("download_agreement", lang)
         )
+        if raw_state != Onboarding.awaiting_agreement:
+            await state.set_state(Onboarding.awaiting_agreement)
 
 # ================== HELP COMMAND ==================
 @dp.message(Command("help"))
-async def help_cmd(message: types.Message):
-    await message.answer(
-        "ℹ️ *MakeBankGuru Bot Help*\n\n"
-        "*Available Commands:*\n"
-        "/start - Begin registration & payment\n"
-        "/status - Check your activation status\n"
-        "/help - Show this help message\n\n"
-        "*How It Works:*\n"
-        "1️⃣ Use /start to get your payment link\n"
-        "2️⃣ Pay ₦20,000 via the link\n"
-        "3️⃣ Payment is auto-verified\n"
-        "4️⃣ Upload your signed agreement PDF\n"
-        "5️⃣ Get access to Naira Trader & private group\n\n"
-        "*Need Support?*\n"
-        "Contact: @MakeBankGuru",
-        parse_mode="Markdown"
-    )
+async def help_cmd(message: types.Message, lang: str = None):
+    await message.answer(templates.text("help", lang), parse_mode="Markdown")
+
+# ================== LANGUAGE COMMAND ==================
+class LanguageChoice(CallbackData, prefix="lang"):
+    code: str
+
+
+language_kb = InlineKeyboardBuilder()
+for code, name in LANGUAGE_NAMES.items():
+    language_kb.button(text=name, callback_data=LanguageChoice(code=code))
+language_kb.adjust(1)
+LANGUAGE_KEYBOARD = language_kb.as_markup()
+
+
+@dp.message(Command("language"))
+async def language_cmd(message: types.Message, lang: str = None):
+    await message.answer(templates.text("choose_language", lang), reply_markup=LANGUAGE_KEYBOARD)
+
+@dp.callback_query(LanguageChoice.filter())
+async def language_cb(callback: types.CallbackQuery, callback_data: LanguageChoice, state: FSMContext):
+    lang = templates.language(callback_data.code)
+    await state.update_data(lang=lang)
+    await callback.message.edit_text(templates.text("language_set", lang))
+    await callback.answer()
 
 # ================== ADMIN COMMANDS ==================
 @dp.message(Command("stats"))
@@ -138,212 +296,771 @@ async def stats_cmd(message: types.Message):
     if message.from_user.id != ADMIN_CHAT_ID:
         return
     
-    from database import get_stats
-    stats = get_stats()
+    from database import get_stats, get_user_cache_stats
+    stats = await get_stats()
+    cache = get_user_cache_stats()
+    outbox = sender.stats()
     
     await message.answer(
         f"📊 *Bot Statistics*\n\n"
         f"⏳ Pending Payments: {stats['pending_payments']}\n"
         f"✅ Paid Users: {stats['paid_users']}\n"
-        f"📄 Signed Agreements: {stats['signed_agreements']}",
+        f"📄 Signed Agreements: {stats['signed_agreements']}\n\n"
+        f"🗃 User Cache: {cache['hits']} hits / {cache['misses']} misses ({cache['size']} entries)\n"
+        f"📤 Outbox: {outbox['queue_depth']} queued, {outbox['sent']} sent, {outbox['failed']} failed, "
+        f"avg {outbox['avg_latency'] * 1000:.0f}ms",
         parse_mode="Markdown"
     )
 
+USERS_PAGE_SIZE = 10
+
+
+class UsersPage(CallbackData, prefix="users"):
+    # Short field names: callback data is limited to 64 bytes
+    d: str        # "n" next / "p" previous
+    t: int        # cursor payment_verified_at
+    i: int        # cursor telegram_id
+    f: str        # "a" all / "s" signed / "u" unsigned
+    a: int = 0    # date_from (0 = none)
+    b: int = 0    # date_to (0 = none)
+
+
+def parse_users_filters(args):
+    """
+    /users [signed|unsigned] [from YYYY-MM-DD] [to YYYY-MM-DD]
+    Dates without a keyword are read as from, then to.
+    Returns (filter, date_from, date_to) or None if the arguments are invalid.
+    """
+    signed_filter, dates, keyword = "a", {}, None
+    for arg in args:
+        if keyword is None and arg in ("signed", "unsigned"):
+            signed_filter = arg[0]
+            continue
+        if keyword is None and arg in ("from", "to"):
+            keyword = arg
+            continue
+        try:
+            day = int(datetime.datetime.strptime(arg, "%Y-%m-%d").timestamp())
+        except ValueError:
+            return None
+        keyword = keyword or ("to" if "from" in dates else "from")
+        if keyword in dates:
+            return None
+        dates[keyword], keyword = day, None
+
+    if keyword is not None:
+        return None
+    date_from = dates.get("from", 0)
+    # The end date is inclusive
+    date_to = dates["to"] + 86400 if "to" in dates else 0
+    return signed_filter, date_from, date_to
+
+
+async def render_users_page(page: UsersPage = None, signed_filter="a", date_from=0, date_to=0):
+    if page:
+        signed_filter, date_from, date_to = page.f, page.a, page.b
+
+    filters = {
+        "signed": {"a": None, "s": True, "u": False}[signed_filter],
+        "date_from": date_from or None,
+        "date_to": date_to or None
+    }
+    cursor = (page.t, page.i) if page else None
+    backwards = bool(page and page.d == "p")
+
+    users, has_more = await get_verified_users_page(
+        **filters, cursor=cursor, backwards=backwards, limit=USERS_PAGE_SIZE
+    )
+    if not users:
+        return "No verified users found.", None
+
+    total = await count_verified_users(**filters)
+    has_prev = has_more if backwards else cursor is not None
+    has_next = True if backwards else has_more
+
+    response = "👥 *Verified Users*\n\n"
+    for user in users:
+        status = "✅ Signed" if user['agreement_signed'] else "⏳ Pending Agreement"
+        response += f"• @{escape_markdown(user['username'])} (ID: {user['telegram_id']}) - {status}\n"
+    response += f"\n_{total} users_"
+
+    kb = InlineKeyboardBuilder()
+    first, last = users[0], users[-1]
+    if has_prev:
+        kb.button(text="⬅️ Prev", callback_data=UsersPage(
+            d="p", t=first['payment_verified_at'], i=first['telegram_id'],
+            f=signed_filter, a=date_from, b=date_to
+        ))
+    if has_next:
+        kb.button(text="Next ➡️", callback_data=UsersPage(
+            d="n", t=last['payment_verified_at'], i=last['telegram_id'],
+            f=signed_filter, a=date_from, b=date_to
+        ))
+    return response, kb.as_markup() if (has_prev or has_next) else None
+
+
+@dp.message(Command("funnel"))
+async def funnel_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_CHAT_ID:
+        return
+    
+    granularity = "hour" if "hour" in (message.text or "") else "day"
+    limit = 24 if granularity == "hour" else 14
+    buckets = await get_funnel(granularity, limit)
+    
+    if not buckets:
+        await message.answer("No funnel data yet.")
+        return
+    
+    fmt = "%Y-%m-%d %H:00" if granularity == "hour" else "%Y-%m-%d"
+    response = f"📈 Funnel by {granularity} (UTC)\nstarted → paid → signed\n\n"
+    for row in buckets:
+        label = datetime.datetime.fromtimestamp(row['bucket'], datetime.timezone.utc).strftime(fmt)
+        rate = f"{row['paid'] / row['started']:.0%}" if row['started'] else "-"
+        response += f"{label}: {row['started']} → {row['paid']} → {row['signed']} ({rate} paid)\n"
+    
+    await message.answer(response)
+
 @dp.message(Command("users"))
 async def users_cmd(message: types.Message):
     if message.from_user.id != ADMIN_CHAT_ID:
         return
     
-    from database import get_all_verified_users
-    users = get_all_verified_users()
+    filters = parse_users_filters((message.text or "").split()[1:])
+    if filters is None:
+        await message.answer("Usage: /users [signed|unsigned] [from YYYY-MM-DD] [to YYYY-MM-DD]")
+        return
     
-    if not users:
-        await message.answer("No verified users yet.")
+    response, markup = await render_users_page(None, *filters)
+    await message.answer(response, parse_mode="Markdown", reply_markup=markup)
+
+@dp.callback_query(UsersPage.filter())
+async def users_page_cb(callback: types.CallbackQuery, callback_data: UsersPage):
+    if callback.from_user.id != ADMIN_CHAT_ID:
+        await callback.answer()
         return
     
-    response = "👥 *Verified Users*\n\n"
-    for user in users[:10]:  # Show first 10
-        status = "✅ Signed" if user['agreement_signed'] else "⏳ Pending Agreement"
-        response += f"• @{user['username']} (ID: {user['telegram_id']}) - {status}\n"
+    response, markup = await render_users_page(callback_data)
+    await callback.message.edit_text(response, parse_mode="Markdown", reply_markup=markup)
+    await callback.answer()
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_CHAT_ID:
+        return
     
-    if len(users) > 10:
-        response += f"\n_Showing 10 of {len(users)} users_"
+    text = (message.text or "").partition(" ")[2].strip()
+    if not text:
+        await message.answer("Usage: /broadcast <message to send to all verified users>")
+        return
     
-    await message.answer(response, parse_mode="Markdown")
+    broadcast_id = await broadcaster.start(text)
+    await message.answer(f"📣 Broadcast #{broadcast_id} started. You'll get a report when it finishes.")
 
-# ================== AGREEMENT UPLOAD ==================
-@dp.message(F.document)
-async def receive_agreement(message: types.Message):
-    telegram_id = message.from_user.id
+@dp.message(Command("unmatched"))
+async def unmatched_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_CHAT_ID:
+        return
+    
+    payments = await get_unmatched_payments()
+    
+    if not payments:
+        await message.answer("No unmatched payments.")
+        return
+    
+    response = "⚠️ Unmatched Payments\n\n"
+    for payment in payments:
+        received = datetime.datetime.fromtimestamp(payment['received_at']).strftime('%Y-%m-%d %H:%M')
+        response += f"• {payment['korapay_reference']} - ₦{payment['amount']:,.0f} ({received})\n"
+    response += "\nAssign with: /resolve <korapay_reference> <telegram_id>"
+    
+    await message.answer(response)
 
-    # Check payment status
-    if not is_payment_paid(telegram_id):
-        kb = InlineKeyboardBuilder()
-        kb.button(text="💳 Make Payment", url=f"{KORAPAY_BASE_LINK}?amount=20000")
-        
-        await message.reply(
-            "⚠️ *Payment Not Confirmed*\n\n"
-            "Please complete your payment first before uploading the agreement.\n\n"
-            "Use /start to get your payment link.",
-            parse_mode="Markdown",
-            reply_markup=kb.as_markup()
+@dp.message(Command("resolve"))
+async def resolve_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_CHAT_ID:
+        return
+    
+    args = (message.text or "").split()[1:]
+    if len(args) != 2 or not args[1].isdigit():
+        await message.answer("Usage: /resolve <korapay_reference> <telegram_id>")
+        return
+    
+    korapay_reference, telegram_id = args[0], int(args[1])
+    
+    if await paid_with_other_charge(telegram_id, korapay_reference):
+        await message.answer(f"❌ User {telegram_id} has already paid.")
+        return
+    
+    if not await mark_payment_paid(korapay_reference, telegram_id=telegram_id):
+        await message.answer(f"❌ No pending payment for user {telegram_id}.")
+        return
+    
+    await resolve_unmatched_payment(korapay_reference, telegram_id)
+    try:
+        await notify_payment_confirmed(telegram_id)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.error("❌ Failed to notify user %s: %s", telegram_id, e)
+    await message.answer(f"✅ Payment {korapay_reference} assigned to user {telegram_id}.")
+
+@dp.message(Command("export"))
+async def export_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_CHAT_ID:
+        return
+    
+    args = (message.text or "").split()[1:]
+    table = args[0] if args else None
+    fmt = args[1] if len(args) > 1 else "csv"
+    if table not in EXPORT_COLUMNS or fmt not in EXPORT_FORMATS or len(args) > 2:
+        await message.answer(
+            f"Usage: /export <{'|'.join(EXPORT_COLUMNS)}> [{'|'.join(EXPORT_FORMATS)}]"
         )
         return
+    
+    # Streamed to a temporary file rather than built in memory
+    fd, path = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        size = await write_export(path, table, fmt)
+        if size > MAX_EXPORT_DOCUMENT_BYTES:
+            await message.answer(
+                f"❌ The {table} export is {size / 1024 / 1024:.0f} MB, over Telegram's 50 MB limit.\n"
+                f"Download it from GET /export/{table}?format={fmt} instead."
+            )
+            return
+        await message.answer_document(
+            types.FSInputFile(path, filename=export_filename(table, fmt)),
+            caption=f"📦 {table} ({fmt}, gzip)"
+        )
+    finally:
+        os.remove(path)
+
+# ================== AGREEMENT UPLOAD ==================
+async def reply_agreement_duplicate(message: types.Message, lang: str = None):
+    await message.reply(templates.text("agreement_duplicate", lang), parse_mode="Markdown")
+
+@dp.message(F.document, StateFilter(*PAID_STATES))
+@timed_handler
+async def receive_agreement(message: types.Message, state: FSMContext, lang: str = None):
+    telegram_id = message.from_user.id
 
     # Validate PDF
     if not message.document.file_name.lower().endswith(".pdf"):
-        await message.reply(
-            "❌ *Invalid File Format*\n\n"
-            "Only PDF files are accepted.\n\n"
-            "Please convert your agreement to PDF and try again."
-        )
+        await message.reply(templates.text("agreement_not_pdf", lang))
+        return
+
+    # Reject oversized files before downloading anything
+    try:
+        uploads.check_size(message.document)
+    except UploadTooLarge:
+        await message.reply(templates.text("agreement_too_large", lang), parse_mode="Markdown")
+        return
+
+    # Same Telegram file sent again: nothing to download
+    if await find_agreement_document(telegram_id, file_unique_id=message.document.file_unique_id):
+        await mark_agreement_signed(telegram_id)
+        await state.set_state(Onboarding.activated)
+        await reply_agreement_duplicate(message, lang)
         return
 
     # Show processing message
-    processing_msg = await message.reply("⏳ Processing your agreement...")
+    processing_msg = await message.reply(templates.text("agreement_processing", lang))
 
+    staging_path = os.path.join(INCOMING_DIR, f"{telegram_id}_{message.message_id}.pdf")
     try:
-        # Download file (Aiogram 3.x method)
-        timestamp = int(datetime.datetime.now().timestamp())
-        file_name = f"{telegram_id}_{timestamp}.pdf"
-        file_path = os.path.join(SIGNED_DIR, file_name)
+        # Stream the file to a staging path, hashing as it downloads
+        upload = await uploads.download(message.document, staging_path)
 
-        file = await bot.get_file(message.document.file_id)
-        await bot.download_file(file.file_path, file_path)
+        # Same bytes under a different file: keep the existing version
+        duplicate = await find_agreement_document(telegram_id, sha256=upload['sha256'])
+
+        # New content: check it's a real, readable PDF before storing it
+        if not duplicate:
+            check = await pdf_validator.validate(staging_path)
+            await record_agreement_validation(
+                telegram_id, message.document.file_unique_id,
+                upload['sha256'], upload['size'], check
+            )
+            if not check['valid']:
+                os.remove(staging_path)
+                await processing_msg.delete()
+                await message.reply(
+                    templates.text("agreement_invalid", lang, reason=REJECTION_REASONS[check['reason']]),
+                    parse_mode="Markdown"
+                )
+                return
+
+        # Content-addressed: identical files share one blob
+        storage_key = await agreement_store.put(upload['sha256'], staging_path)
+        if not duplicate:
+            version = await add_agreement_document(
+                telegram_id, upload['sha256'], upload['size'], storage_key,
+                message.document.file_unique_id
+            )
 
         # Mark as signed
-        mark_agreement_signed(telegram_id)
+        await mark_agreement_signed(telegram_id)
+        await state.set_state(Onboarding.activated)
 
         # Delete processing message
         await processing_msg.delete()
 
-        # Send success message with next steps
-        await message.reply(
-            "✅ *Agreement Received Successfully!*\n\n"
-            "🎉 Your account is now fully activated!\n\n"
-            "📌 *Next Steps:*\n\n"
-            f"1️⃣ Register for a  Naira Trading account:\n{NAIRA_TRADER_LINK}\n\n"
-            f"2️⃣ Join our private group:\n{PRIVATE_GROUP_LINK}\n\n"
-            "Welcome to MakeBankGuru! 🚀",
-            parse_mode="Markdown"
-        )
+        if duplicate:
+            await reply_agreement_duplicate(message, lang)
+            return
 
-        # Notify admin
-        await bot.send_document(
-            ADMIN_CHAT_ID,
-            types.FSInputFile(file_path),
-            caption=f"📄 *New Agreement Uploaded*\n\n"
-                    f"👤 User: @{message.from_user.username or 'N/A'}\n"
-                    f"🆔 Telegram ID: {telegram_id}\n"
-                    f"📅 Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-            parse_mode="Markdown"
-        )
+        # Send success message with next steps
+        await message.reply(templates.text("agreement_received", lang), parse_mode="Markdown")
 
+    except UploadTooLarge:
+        # No file_size up front, so the cap was only hit mid-download
+        # (the pipeline has already removed the partial file)
+        await processing_msg.delete()
+        await message.reply(templates.text("agreement_too_large", lang), parse_mode="Markdown")
+        return
     except Exception as e:
-        print(f"❌ Error downloading agreement: {e}")
+        logger.error("❌ Error downloading agreement: %s", e)
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
         await processing_msg.delete()
-        await message.reply(
-            "❌ *Failed to Process Agreement*\n\n"
-            "There was an error processing your file.\n"
-            "Please try again or contact support."
-        )
+        await message.reply(templates.text("agreement_failed", lang))
+        return
+
+    # Notify admin, reusing Telegram's file_id instead of re-uploading bytes.
+    # Not awaited: the admin chat drains at its per-chat rate limit, and a
+    # burst of uploads shouldn't make every user wait for that queue.
+    sender.submit(SendDocument(
+        chat_id=ADMIN_CHAT_ID,
+        document=message.document.file_id,
+        caption=f"📄 *New Agreement Uploaded*\n\n"
+                f"👤 User: @{escape_markdown(message.from_user.username or 'N/A')}\n"
+                f"🆔 Telegram ID: {telegram_id}\n"
+                f"📅 Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"📑 Version: {version}\n"
+                f"🔑 SHA-256: `{upload['sha256'][:16]}`",
+        parse_mode="Markdown"
+    ), PRIORITY_ADMIN).add_done_callback(log_admin_forward_result)
+
+
+@dp.message(F.document)
+@timed_handler
+async def agreement_before_payment(message: types.Message, state: FSMContext, lang: str = None):
+    # The state trails the database if saving it failed, so confirm
+    # before turning the user away
+    if await is_payment_paid(message.from_user.id):
+        await state.set_state(Onboarding.awaiting_agreement)
+        await receive_agreement(message, state, lang)
+        return
+
+    await message.reply(
+        templates.text("payment_not_confirmed", lang),
+        parse_mode="Markdown",
+        reply_markup=templates.keyboard("make_payment", lang)
+    )
+
+
+def log_admin_forward_result(future):
+    if not future.cancelled() and future.exception():
+        logger.error("❌ Failed to forward agreement to admin: %s", future.exception())
 
 # ================== KORAPAY WEBHOOK ==================
+# Event keys seen recently, so Korapay retries are acknowledged without a
+# DB round trip. The webhook_events primary key backs this up.
+recent_webhook_events = RecentSet(maxsize=int(os.getenv("WEBHOOK_RECENT_EVENTS", 50000)))
+korapay_signatures = SignatureVerifier(KORAPAY_SECRET_KEY) if KORAPAY_SECRET_KEY else None
+webhook_rate_limiter = KeyedRateLimiter(KORAPAY_WEBHOOK_RATE / WORKERS, KORAPAY_WEBHOOK_BURST / WORKERS)
+if not korapay_signatures:
+    logger.warning("⚠️ KORAPAY_SECRET_KEY is not set; Korapay webhooks will be refused")
+
+
+def client_ip(request) -> str:
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [ip.strip() for ip in request.headers.get("X-Forwarded-For", "").split(",")]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote
+
+
+def reject_webhook(reason: str, status: int, text: str):
+    WEBHOOK_REJECTED.inc(reason=reason)
+    return web.Response(text=text, status=status)
+
+
+@timed_handler
+async def process_korapay_payment(data):
+    """
+    Match a successful charge to a user, mark it paid and notify them.
+    Returns the webhook event status to record.
+    """
+    korapay_reference = data.get("reference") or data.get("payment_reference")
+    user = await match_payment(data)
+
+    if not user:
+        logger.error("❌ Could not match payment to any user: %s", korapay_reference)
+        await add_unmatched_payment(korapay_reference, float(data.get("amount", 0)), json.dumps(data))
+        await sender.send(SendMessage(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"⚠️ Unmatched payment: {korapay_reference} (₦{data.get('amount')})\n"
+                 "Use /unmatched to review and /resolve to assign it."
+        ), PRIORITY_ADMIN)
+        return "unmatched"
+
+    telegram_id = user["telegram_id"]
+    if await paid_with_other_charge(telegram_id, korapay_reference):
+        # A second charge: the first one stays on file and the user's
+        # onboarding is left alone
+        logger.warning("⚠️ User %s already paid; extra charge %s", telegram_id, korapay_reference)
+        await sender.send(SendMessage(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"⚠️ Payment {korapay_reference} (₦{data.get('amount')}) is from user {telegram_id}, "
+                 "who has already paid. Review or refund it on Korapay."
+        ), PRIORITY_ADMIN)
+        return "processed"
+
+    # Mark payment as paid with Korapay reference
+    if not await mark_payment_paid(korapay_reference, user.get("payment_reference"), telegram_id):
+        # Not recorded: retry rather than tell an unpaid user they're done
+        raise RuntimeError(f"could not mark payment {korapay_reference} paid")
+    logger.info("✅ Payment marked as paid for user: %s", telegram_id)
+
+    # Notify user with detailed instructions
+    try:
+        await notify_payment_confirmed(telegram_id)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Permanent (user blocked the bot, bad chat); retrying won't help.
+        # Anything else propagates so the worker pool retries the event.
+        logger.error("❌ Failed to notify user %s: %s", telegram_id, e)
+
+    return "processed"
+
+
+async def paid_with_other_charge(telegram_id: int, korapay_reference: str) -> bool:
+    """
+    Whether the user's payment is already on file under a different
+    Korapay reference.
+    """
+    user = await get_user_by_telegram_id(telegram_id)
+    return bool(
+        user and user["payment_status"] == "paid"
+        and user["korapay_reference"] != korapay_reference
+    )
+
+
+async def notify_payment_confirmed(telegram_id: int, priority: int = PRIORITY_PAYMENT):
+    """
+    Move a user whose payment was just recorded to the state their rows
+    imply, sending the next-step instructions unless their agreement is
+    already on file.
+    """
+    state = onboarding_state(telegram_id)
+    target = await restore_state(telegram_id)
+    if target != Onboarding.awaiting_agreement:
+        if target is not None and await state.get_state() != target.state:
+            await state.set_state(target)
+        return
+
+    await state.set_state(Onboarding.paid)
+    lang = language_for(await state.get_data())
+    await sender.send(SendMessage(
+        chat_id=telegram_id,
+        text=templates.text("payment_confirmed", lang),
+        parse_mode="Markdown",
+        reply_markup=templates.keyboard("download_agreement", lang)
+    ), priority)
+    await state.set_state(Onboarding.awaiting_agreement)
+
+
+webhook_workers = WebhookWorkerPool(
+    process_korapay_payment,
+    workers=int(os.getenv("WEBHOOK_WORKERS", 4)),
+    max_attempts=int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 5)),
+    # A failed event must be claimable again by Korapay's next delivery
+    on_give_up=recent_webhook_events.discard
+)
+
+Gauge("bot_send_queue_depth", "Outbound Telegram calls waiting to be sent",
+      lambda: sender.stats()["queue_depth"])
+Gauge("bot_webhook_queue_depth", "Korapay webhook events waiting for a worker",
+      lambda: webhook_workers.queue.qsize())
+
+
+@timed_handler
 async def korapay_webhook(request):
+    # Cheapest checks first, so junk is turned away before any parsing
+    ip = client_ip(request)
+    if not webhook_rate_limiter.allow(ip):
+        return reject_webhook("rate_limited", 429, "too many requests")
+
+    signature = request.headers.get("x-korapay-signature")
+    if not signature or not korapay_signatures:
+        return reject_webhook("unsigned", 401, "unauthorized")
+
     try:
-        body = await request.json()
-        print("🔥 Webhook received:", body)
+        body = await request.json(loads=parse_webhook_body)
     except Exception as e:
-        print(f"⚠️ Failed to parse webhook: {e}")
-        return web.Response(text="bad request", status=400)
+        logger.warning("⚠️ Failed to parse webhook: %s", e)
+        return reject_webhook("bad_request", 400, "bad request")
+
+    if not isinstance(body, dict) or not isinstance(body.get("data"), dict):
+        return reject_webhook("bad_request", 400, "bad request")
+
+    if not korapay_signatures.verify(body["data"], signature):
+        logger.warning("⚠️ Rejected Korapay webhook with bad signature from %s", ip)
+        return reject_webhook("bad_signature", 401, "unauthorized")
+
+    logger.debug("🔥 Webhook received: %s", body)
 
     # Validate event type
     if body.get("event") != "charge.success":
-        print(f"⚠️ Ignored event: {body.get('event')}")
+        logger.warning("⚠️ Ignored event: %s", body.get('event'))
         return web.Response(text="ignored")
 
     data = body.get("data", {})
     korapay_reference = data.get("reference") or data.get("payment_reference")
     amount = float(data.get("amount", 0))
 
-    print(f"💰 Payment - Korapay Reference: {korapay_reference}, Amount: {amount}")
+    logger.info("💰 Payment - Korapay Reference: %s, Amount: %s", korapay_reference, amount)
 
     # Validate amount
-    if amount < 20000:
-        print(f"❌ Amount too low: {amount}")
+    if amount < PAYMENT_AMOUNT:
+        logger.error("❌ Amount too low: %s", amount)
         return web.Response(text="invalid amount")
 
-    # Find user by Korapay reference
-    user = get_user_by_korapay_reference(korapay_reference)
-    
-    # If not found, try to match by timing (last pending payment)
-    if not user:
-        print(f"⚠️ No direct match for Korapay ref: {korapay_reference}")
-        print("🔍 Attempting to match by recent pending payment...")
-        
-        # This is a fallback - matches the most recent pending payment
-        from database import get_most_recent_pending_payment
-        user = get_most_recent_pending_payment()
-        
-        if user:
-            print(f"✅ Matched to recent pending payment: User {user['telegram_id']}")
-
-    if not user:
-        print(f"❌ Could not match payment to any user")
-        return web.Response(text="user not found")
-
-    # Mark payment as paid with Korapay reference
-    mark_payment_paid(korapay_reference, user.get("payment_reference"))
-    print(f"✅ Payment marked as paid for user: {user['telegram_id']}")
+    # Drop retries of an event we've already taken
+    event_key = webhook_event_key(body["event"], data)
+    if event_key in recent_webhook_events:
+        logger.info("♻️ Duplicate webhook acknowledged: %s", event_key)
+        return web.Response(text="duplicate")
 
-    # Notify user with detailed instructions
-    try:
-        kb = InlineKeyboardBuilder()
-        kb.button(text="📄 Download Agreement Template", url=AGREEMENT_LINK)
-        kb.adjust(1)
-        
-        await bot.send_message(
-            user["telegram_id"],
-            "✅ *Payment Confirmed Successfully!*\n\n"
-            "📋 *Next Step: Upload Signed Agreement*\n\n"
-            "1️⃣ Download the agreement template below\n"
-            "2️⃣ Fill in your details and sign it\n"
-            "3️⃣ Scan/photograph and convert to PDF\n"
-            "4️⃣ Send the PDF file here in this chat\n\n"
-            "⚠️ *Important:* Only PDF files are accepted.",
-            parse_mode="Markdown",
-            reply_markup=kb.as_markup()
-        )
-    except Exception as e:
-        print(f"❌ Failed to notify user {user['telegram_id']}: {e}")
+    recent_webhook_events.add(event_key)
+    if not await claim_webhook_event(event_key, body["event"], korapay_reference, json.dumps(body)):
+        logger.info("♻️ Duplicate webhook acknowledged: %s", event_key)
+        return web.Response(text="duplicate")
 
+    # The event row is the durable queue entry; processing happens in the
+    # worker pool so Korapay isn't kept waiting on the DB or Telegram.
+    webhook_workers.enqueue(event_key, data)
     return web.Response(text="ok")
 
 # ================== WEB SERVER ==================
 async def handle_root(request):
     return web.Response(text="MakeBankGuru Bot Running ✔️")
 
+def bearer_authorized(request, token: str) -> bool:
+    supplied = request.headers.get("Authorization", "")
+    return hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+async def handle_metrics(request):
+    if METRICS_TOKEN and not bearer_authorized(request, METRICS_TOKEN):
+        return web.Response(status=401)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def handle_export(request):
+    if not EXPORT_TOKEN:
+        raise web.HTTPNotFound()
+    if not bearer_authorized(request, EXPORT_TOKEN):
+        return web.Response(status=401)
+
+    table = request.match_info["table"]
+    fmt = request.query.get("format", "csv")
+    if table not in EXPORT_COLUMNS or fmt not in EXPORT_FORMATS:
+        raise web.HTTPNotFound()
+
+    # Chunked: rows are read, encoded and compressed one batch at a time,
+    # and each write waits for the client to drain the previous one
+    response = web.StreamResponse(headers={
+        "Content-Type": "application/gzip",
+        "Content-Disposition": f'attachment; filename="{export_filename(table, fmt)}"'
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    chunks = export_chunks(table, fmt)
+    try:
+        async for chunk in chunks:
+            await response.write(chunk)
+    finally:
+        # A client that disconnects mid-download ends the loop early; give
+        # the export's read connection back now rather than at collection
+        await chunks.aclose()
+    await response.write_eof()
+    logger.info("📦 Exported %s as %s to %s", table, fmt, request.remote)
+    return response
+
 async def start_webserver():
     app = web.Application()
     app.add_routes([
         web.get("/", handle_root),
+        web.get("/metrics", handle_metrics),
+        web.get("/export/{table}", handle_export),
         web.post("/korapay-webhook", korapay_webhook)
     ])
 
+    if TELEGRAM_WEBHOOK_URL:
+        TelegramWebhookHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            concurrency=TELEGRAM_WEBHOOK_CONCURRENCY
+        ).register(app, path=TELEGRAM_WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 10000))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=WORKERS > 1)
     await site.start()
-    print(f"🌍 Webserver running on port {port}")
+    logger.info("🌍 Webserver running on port %s", port)
+    return runner
+
+# ================== RECONCILIATION ==================
+async def on_reconciled_payment(telegram_id: int):
+    await notify_payment_confirmed(telegram_id, PRIORITY_BULK)
+
+
+async def reconcile_inbox():
+    """
+    Reconcile every settlement file waiting in RECONCILE_INBOX.
+    """
+    done_dir = ensure_signed_dir(os.path.join(RECONCILE_INBOX, "done"))
+    for name in sorted(os.listdir(RECONCILE_INBOX)):
+        source = os.path.join(RECONCILE_INBOX, name)
+        if not name.lower().endswith(SETTLEMENT_SUFFIXES) or not os.path.isfile(source):
+            continue
+
+        report = os.path.join(done_dir, f"{name}.report.csv")
+        summary = await Reconciler(on_paid=on_reconciled_payment).run(source, report)
+        os.replace(source, os.path.join(done_dir, name))
+
+        sender.submit(SendMessage(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"🧾 Reconciled {name}\n\n"
+                 f"✅ Marked paid: {summary['marked_paid']}\n"
+                 f"☑️ Already paid: {summary['already_paid']}\n"
+                 f"⚠️ Unmatched: {summary['unmatched']} (see /unmatched)\n"
+                 f"⏭ Skipped: {summary['skipped']}\n"
+                 f"❌ Unreadable amount: {summary['error']} (see the report)\n"
+                 f"⏳ Still pending: {summary['still_pending']}\n\n"
+                 f"Report: {report}"
+        ), PRIORITY_ADMIN)
+
+
+# ================== MAINTENANCE ==================
+EXPIRE_BATCH_SIZE = 1000
+
+
+async def run_maintenance():
+    """
+    Archive expired pending payments, then compact the database.
+    """
+    expired = 0
+    if PENDING_TTL_DAYS > 0:
+        # Small batches, so user writes queued behind each one wait briefly
+        while True:
+            moved = await expire_pending_payments(int(PENDING_TTL_DAYS * 86400), EXPIRE_BATCH_SIZE)
+            expired += moved
+            if moved < EXPIRE_BATCH_SIZE:
+                break
+
+    free_pages = await compact_database(VACUUM_PAGES)
+    logger.info("🧹 Maintenance done - expired %s pending payments, %s free pages left", expired, free_pages)
+
+# ================== LEADER DUTIES ==================
+polling_task: asyncio.Task = None
+# Periodic jobs only the leader runs, by name
+leader_jobs = {}
+
+
+async def run_every(interval: float, job):
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logger.error("❌ %s failed: %s", job.__name__, e)
+        await asyncio.sleep(interval)
+
+
+async def on_elected():
+    global polling_task
+
+    await broadcaster.resume()
+    await webhook_workers.adopt_orphans()
+    leader_jobs["maintenance"] = asyncio.create_task(run_every(MAINTENANCE_INTERVAL, run_maintenance))
+    if RECONCILE_INBOX:
+        leader_jobs["reconcile"] = asyncio.create_task(run_every(RECONCILE_INTERVAL, reconcile_inbox))
+
+    if TELEGRAM_WEBHOOK_URL:
+        webhook_url = TELEGRAM_WEBHOOK_URL.rstrip("/") + TELEGRAM_WEBHOOK_PATH
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("🔗 Telegram webhook set: %s", webhook_url)
+    else:
+        # getUpdates fails while a webhook is registered
+        await bot.delete_webhook()
+        polling_task = asyncio.create_task(
+            dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+        )
+
+
+async def on_demoted():
+    global polling_task
+
+    if polling_task and not polling_task.done():
+        await dp.stop_polling()
+    polling_task = None
+    for task in leader_jobs.values():
+        task.cancel()
+    await asyncio.gather(*leader_jobs.values(), return_exceptions=True)
+    leader_jobs.clear()
+    await broadcaster.stop()
+
+
+async def on_leader_tick():
+    await webhook_workers.adopt_orphans()
+    await broadcaster.resume()
+    await prune_coordination_state()
+
+
+coordinator = Coordinator(SqliteLease("leader"), on_elected, on_demoted, on_leader_tick)
 
 # ================== MAIN ==================
 async def main():
-    await start_webserver()
-    print("✅ Bot started successfully")
-    await dp.start_polling(bot)
+    await init_db()
+    await sender.start()
+    await webhook_workers.start()
+    await coordinator.start()
+    runner = await start_webserver()
+    logger.info("✅ Bot started successfully")
 
-if __name__ == "__main__":
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await stop.wait()
+    finally:
+        # Stop taking work, then finish this instance's queued work while
+        # its heartbeat still keeps the leader from adopting it
+        await runner.cleanup()
+        await coordinator.resign()
+        await webhook_workers.stop(drain=SHUTDOWN_DRAIN_SECONDS)
+        await sender.stop(drain=SHUTDOWN_DRAIN_SECONDS)
+        await coordinator.stop()
+        await agreement_store.close()
+        pdf_validator.close()
+        await close_db()
+        await bot.session.close()
+
+
+def run():
     asyncio.run(main())
 
 
+if __name__ == "__main__":
+    if WORKERS > 1:
+        run_processes(run, WORKERS)
+    else:
+        run()
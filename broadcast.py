@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+
+from aiogram.methods import SendMessage
+
+from database import (
+    iter_verified_user_ids,
+    create_broadcast,
+    update_broadcast_progress,
+    finish_broadcast,
+    adopt_orphaned_broadcasts,
+    release_broadcasts
+)
+from sender import SendScheduler, PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+# ================== BROADCAST RUNNER ==================
+class BroadcastRunner:
+    """
+    Fans a text message out to every verified user.
+
+    Recipients are streamed in keyset batches; each batch is handed to the
+    send scheduler (lowest priority lane, so payment confirmations still go
+    first) and the last ID of the batch is checkpointed once it completes.
+    Each broadcast is owned by the instance sending it. When that
+    instance stops, the leader adopts the broadcast and resumes it from its
+    checkpoint, so at most one batch can be delivered twice.
+    """
+
+    def __init__(self, sender: SendScheduler, report_chat_id: int, batch_size: int = 100):
+        self.sender = sender
+        self.report_chat_id = report_chat_id
+        self.batch_size = batch_size
+        self._tasks = {}
+
+    async def start(self, text: str) -> int:
+        broadcast_id = await create_broadcast(text)
+        self._spawn({
+            "id": broadcast_id,
+            "text": text,
+            "last_telegram_id": 0,
+            "sent": 0,
+            "failed": 0
+        })
+        return broadcast_id
+
+    async def resume(self):
+        for broadcast in await adopt_orphaned_broadcasts():
+            logger.info(
+                "📣 Resuming broadcast %s after user %s",
+                broadcast['id'], broadcast['last_telegram_id']
+            )
+            self._spawn(broadcast)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        await release_broadcasts()
+
+    def _spawn(self, broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast["id"], None))
+
+    async def _run(self, broadcast):
+        broadcast_id = broadcast["id"]
+        sent, failed = broadcast["sent"], broadcast["failed"]
+        started = time.monotonic()
+        sent_this_run = 0
+
+        try:
+            async for batch in iter_verified_user_ids(broadcast["last_telegram_id"], self.batch_size):
+                results = await asyncio.gather(*(
+                    self.sender.submit(SendMessage(chat_id=telegram_id, text=broadcast["text"]),
+                                       PRIORITY_BULK)
+                    for telegram_id in batch
+                ), return_exceptions=True)
+
+                batch_failed = sum(1 for result in results if isinstance(result, Exception))
+                failed += batch_failed
+                sent += len(batch) - batch_failed
+                sent_this_run += len(batch) - batch_failed
+                if not await update_broadcast_progress(broadcast_id, batch[-1], sent, failed):
+                    logger.warning("⚠️ Broadcast %s was taken over by another instance", broadcast_id)
+                    return
+        except asyncio.CancelledError:
+            # Checkpoint is already saved; the broadcast resumes on next start
+            raise
+        except Exception as e:
+            logger.error("❌ Broadcast %s stopped: %s", broadcast_id, e)
+            await finish_broadcast(broadcast_id, "failed")
+            await self._report(f"❌ Broadcast #{broadcast_id} stopped: {e}")
+            return
+
+        await finish_broadcast(broadcast_id)
+        elapsed = time.monotonic() - started
+        rate = sent_this_run / elapsed if elapsed else 0
+        logger.info("📣 Broadcast %s done - Sent: %s, Failed: %s", broadcast_id, sent, failed)
+        await self._report(
+            f"📣 Broadcast #{broadcast_id} finished\n\n"
+            f"✅ Sent: {sent}\n"
+            f"❌ Failed: {failed}\n"
+            f"⏱ {elapsed:.0f}s ({rate:.1f} msg/s)"
+        )
+
+    async def _report(self, text: str):
+        try:
+            await self.sender.send(SendMessage(chat_id=self.report_chat_id, text=text))
+        except Exception as e:
+            logger.error("❌ Failed to send broadcast report: %s", e)
@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+
+
+# ================== TTL / LRU CACHE ==================
+class TTLCache:
+    """
+    Bounded in-process cache. Entries expire `ttl` seconds after being
+    stored and the least recently used entry is evicted once `maxsize`
+    is reached.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # A fill that started before its key was invalidated must not
+        # store its (possibly stale) result. Invalidations are numbered;
+        # a fill takes a ticket() first and passes it to set().
+        self._sequence = 0
+        self._invalidated = OrderedDict()
+        # Fills with a ticket below this are refused for every key (after
+        # clear(), or once the oldest invalidations are forgotten)
+        self._floor = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def ticket(self) -> int:
+        return self._sequence
+
+    def set(self, key, value, ticket: int = None):
+        if ticket is not None and (ticket < self._floor or ticket < self._invalidated.get(key, 0)):
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._sequence += 1
+        self._invalidated[key] = self._sequence
+        self._invalidated.move_to_end(key)
+        if len(self._invalidated) > self.maxsize:
+            _, sequence = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, sequence)
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._sequence += 1
+        self._floor = self._sequence
+        self._invalidated.clear()
+        self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ================== RECENT KEY SET ==================
+class RecentSet:
+    """
+    Bounded set remembering the most recently added keys. Used as an exact
+    in-memory front for deduplication; anything it has forgotten is still
+    caught by the database.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def add(self, key):
+        self._data[key] = None
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
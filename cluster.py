@@ -0,0 +1,152 @@
+"""
+Running several bot processes against shared state.
+
+Every process serves the web routes (Korapay and Telegram webhooks,
+/metrics) and processes the webhook events it accepts. Work that must
+happen exactly once - polling Telegram, resuming broadcasts, adopting
+webhook events of dead instances - runs only on the elected leader.
+
+WORKERS=4 python bot.py forks four processes sharing users.db (WAL)
+and one listening port (SO_REUSEPORT). Leader election uses a lease row
+in that database.
+
+Single host only. Every piece of state, payments included, lives in
+the local SQLite file, and there is no networked (Postgres-compatible)
+database backend. Processes on other hosts would each have their own
+database and would not see each other's payments, so scale out with
+more processes on one host, not more hosts. Don't put users.db on a
+network filesystem to get around this: SQLite's locking isn't reliable
+there.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+
+import database
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = int(os.getenv("LEASE_TTL", 15))
+LEASE_RENEW_SECONDS = float(os.getenv("LEASE_RENEW_SECONDS", 5))
+
+
+# ================== LEASES ==================
+class SqliteLease:
+    """
+    Lease row in the shared database; lapses unless renewed within `ttl`.
+    """
+
+    def __init__(self, name: str, ttl: int = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+
+    async def acquire(self) -> bool:
+        return await database.acquire_lease(self.name, database.INSTANCE_ID, self.ttl)
+
+    async def release(self):
+        await database.release_lease(self.name, database.INSTANCE_ID)
+
+
+# ================== COORDINATOR ==================
+class Coordinator:
+    """
+    Keeps this instance's liveness lease fresh and competes for the
+    leader lease. `on_elected` / `on_demoted` run when leadership changes
+    hands and `on_tick` runs on every renewal while leader.
+    """
+
+    def __init__(self, leader_lease, on_elected, on_demoted, on_tick=None,
+                 interval: float = LEASE_RENEW_SECONDS):
+        self.leader_lease = leader_lease
+        self.heartbeat = None
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_tick = on_tick
+        self.interval = interval
+        self.is_leader = False
+        self.resigned = False
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        self.heartbeat = SqliteLease(f"instance:{database.INSTANCE_ID}")
+        # First round inline, so the heartbeat exists before any webhook
+        # event is claimed under this instance's name
+        await self._round()
+        self._task = asyncio.create_task(self._loop())
+
+    async def resign(self):
+        """
+        Give up leadership for good while still renewing the heartbeat,
+        so this instance can finish its own work before stop().
+        """
+        async with self._lock:
+            self.resigned = True
+            if self.is_leader:
+                self.is_leader = False
+                await self.on_demoted()
+            await self.leader_lease.release()
+
+    async def stop(self):
+        await self.resign()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.heartbeat.release()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._round()
+            except Exception as e:
+                logger.error("❌ Coordinator round failed: %s", e)
+
+    async def _round(self):
+        async with self._lock:
+            await self._renew()
+
+    async def _renew(self):
+        await self.heartbeat.acquire()
+        leader = not self.resigned and await self.leader_lease.acquire()
+
+        if leader and not self.is_leader:
+            self.is_leader = True
+            logger.info("👑 %s elected leader", database.INSTANCE_ID)
+            await self.on_elected()
+        elif not leader and self.is_leader:
+            self.is_leader = False
+            logger.warning("⚠️ %s lost leadership", database.INSTANCE_ID)
+            await self.on_demoted()
+
+        if self.is_leader and self.on_tick:
+            await self.on_tick()
+
+
+# ================== PROCESS SUPERVISOR ==================
+def run_processes(target, count: int):
+    """
+    Run `target` in `count` processes and wait for them. SIGTERM/SIGINT
+    is passed on to every child.
+    """
+    children = [
+        multiprocessing.Process(target=target, name=f"worker-{i}")
+        for i in range(count)
+    ]
+    for child in children:
+        child.start()
+    logger.info("🚀 Started %s worker processes", count)
+
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for child in children:
+        child.join()
@@ -1,46 +1,214 @@
-import sqlite3
-import datetime
+import asyncio
+import json
+import logging
+import time
 import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
 
-DB_PATH = "users.db"
+import aiosqlite
+
+from cache import TTLCache
+from metrics import timed_db
+from migrations import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+# Every worker process on the host uses this one file. It must be on a
+# local disk: there is no multi-host backend, see cluster.py.
+DB_PATH = os.getenv("DB_PATH", "users.db")
 SIGNED_DIR = "signed_agreements"
 
+# Identifies this process in leases and as the owner of the webhook
+# events it accepted. Set by init_db() in each process, unique per start,
+# so a restarted or forked process never inherits another's work.
+INSTANCE_ID: str = None
+
+# Number of read-only connections kept open. Writes go through a single
+# dedicated connection so SQLite never has to arbitrate between writers.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+
+# Read-through cache for get_user_by_telegram_id / is_payment_paid.
+# Entries are dropped by the write paths that change a user's status.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+# How often to replay other processes' user changes into the cache
+USER_CACHE_SYNC_SECONDS = float(os.getenv("USER_CACHE_SYNC_SECONDS", 1))
+
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# FSM records per user, {(bot_id, chat_id, destiny): {"state", "data"}}
+_fsm_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_MISSING = object()
+
+_read_pool: asyncio.Queue = None
+_writer_conn: aiosqlite.Connection = None
+_write_queue: asyncio.Queue = None
+_writer_task: asyncio.Task = None
+_cache_sync_task: asyncio.Task = None
+_cache_sync_id = 0
+
+
+# ================== CONNECTIONS ==================
+async def _open_connection(readonly: bool = False) -> aiosqlite.Connection:
+    # Statements are module-level constants, so sqlite3's per-connection
+    # statement cache keeps them prepared across calls.
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=128)
+    if not readonly:
+        # Must precede the first write to a new database; see
+        # _enable_incremental_vacuum for existing ones
+        await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA busy_timeout=5000")
+    await conn.execute("PRAGMA foreign_keys=ON")
+    if readonly:
+        await conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+@asynccontextmanager
+async def _reader():
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+async def _fetchone(sql: str, params: tuple = ()):
+    async with _reader() as conn:
+        async with conn.execute(sql, params) as c:
+            return await c.fetchone()
+
+
+async def _fetchall(sql: str, params: tuple = ()):
+    async with _reader() as conn:
+        async with conn.execute(sql, params) as c:
+            return await c.fetchall()
+
+
+async def _iter_rows(sql: str, batch_size: int, params: tuple = ()):
+    # One cursor on a connection of its own: a consistent snapshot, and
+    # long scans (exports, reconciliation) don't hold a pooled reader
+    conn = await _open_connection(readonly=True)
+    try:
+        async with conn.execute(sql, params) as c:
+            while True:
+                rows = await c.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        await conn.close()
+
+
+# ================== WRITER QUEUE ==================
+async def _writer_loop():
+    while True:
+        job, future = await _write_queue.get()
+        try:
+            # Take the write lock up front: other processes may be writing
+            # too, and a read-then-write transaction that has to upgrade
+            # its lock fails with SQLITE_BUSY instead of waiting
+            await _writer_conn.execute("BEGIN IMMEDIATE")
+            result = await job(_writer_conn)
+            await _writer_conn.commit()
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            await _writer_conn.rollback()
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            _write_queue.task_done()
+
+
+async def _write(job):
+    """
+    Run `job(conn)` on the single writer connection and commit.
+    Jobs are serialized, so each one sees a consistent view of the DB.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await _write_queue.put((job, future))
+    return await future
+
+
+async def _enable_incremental_vacuum(conn):
+    """
+    Convert a database created without incremental auto-vacuum. That
+    takes a full VACUUM outside WAL mode, which needs the database to
+    ourselves, so it is skipped while other processes have it open.
+    """
+    async with conn.execute("PRAGMA auto_vacuum") as c:
+        # 2 = INCREMENTAL
+        if (await c.fetchone())[0] == 2:
+            return
+
+    async with conn.execute("PRAGMA journal_mode=DELETE") as c:
+        mode = (await c.fetchone())[0]
+    if mode == "delete":
+        logger.info("🧹 Converting database to incremental auto-vacuum")
+        await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.execute("VACUUM")
+    else:
+        logger.warning("⚠️ Database is in use elsewhere; incremental auto-vacuum not enabled yet")
+    await conn.execute("PRAGMA journal_mode=WAL")
+
 
 # ================== DATABASE INIT ==================
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-
-    # Table for pending payments
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS pending_payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            username TEXT,
-            payment_reference TEXT UNIQUE,
-            korapay_reference TEXT,
-            status TEXT DEFAULT 'pending',
-            date_created TEXT
-        )
-    """)
-
-    # Table for verified users
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS verified_users (
-            telegram_id INTEGER PRIMARY KEY,
-            username TEXT,
-            payment_reference TEXT,
-            korapay_reference TEXT,
-            payment_status TEXT DEFAULT 'pending',
-            date_payment_verified TEXT,
-            agreement_signed INTEGER DEFAULT 0,
-            date_agreement_signed TEXT
-        )
-    """)
+async def init_db():
+    global _read_pool, _writer_conn, _write_queue, _writer_task
+    global _pending_has_rows, _pending_full, _pending_flusher_task
+    global _cache_sync_task, _cache_sync_id, INSTANCE_ID
+
+    INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    _writer_conn = await _open_connection()
+
+    await apply_migrations(_writer_conn)
+    await _enable_incremental_vacuum(_writer_conn)
+
+    async with _writer_conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations") as c:
+        _cache_sync_id = (await c.fetchone())[0]
+
+    _read_pool = asyncio.Queue()
+    for _ in range(DB_POOL_SIZE):
+        _read_pool.put_nowait(await _open_connection(readonly=True))
+
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_writer_loop())
+
+    _pending_has_rows = asyncio.Event()
+    _pending_full = asyncio.Event()
+    _pending_flusher_task = asyncio.create_task(_pending_flusher())
+    if USER_CACHE_SYNC_SECONDS > 0:
+        _cache_sync_task = asyncio.create_task(_cache_sync_loop())
+    logger.info("✅ Database initialized successfully")
+
+
+async def close_db():
+    global _writer_task, _pending_flusher_task, _cache_sync_task
 
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized successfully")
+    if _cache_sync_task:
+        _cache_sync_task.cancel()
+        _cache_sync_task = None
+
+    if _pending_flusher_task:
+        _pending_flusher_task.cancel()
+        _pending_flusher_task = None
+        await flush_pending_payments()
+
+    if _writer_task:
+        await _write_queue.join()
+        _writer_task.cancel()
+        _writer_task = None
+
+    while _read_pool and not _read_pool.empty():
+        await _read_pool.get_nowait().close()
+
+    if _writer_conn:
+        await _writer_conn.close()
+    logger.info("🛑 Database connections closed")
 
 
 # ================== DIRECTORY ==================
@@ -50,168 +218,340 @@ def ensure_signed_dir(path):
 
 
 # ================== CREATE PENDING PAYMENT ==================
-def create_pending_payment(telegram_id: int, username: str, reference: str):
-    now = datetime.datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# A true upsert rather than INSERT OR REPLACE: REPLACE deletes the old
+# row without firing delete triggers, which would skew the stats counters.
+UPSERT_PENDING_SQL = """
+    INSERT INTO pending_payments
+    (telegram_id, username, payment_reference, status, created_at)
+    VALUES (?, ?, ?, 'pending', ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        username=excluded.username,
+        payment_reference=excluded.payment_reference,
+        korapay_reference=NULL,
+        status='pending',
+        created_at=excluded.created_at
+"""
+
+# Pending-payment upserts from /start are buffered and group-committed:
+# one transaction per batch instead of one commit per user. The buffer is
+# flushed when it reaches PENDING_BATCH_SIZE rows or PENDING_FLUSH_MS after
+# the first buffered row, whichever comes first.
+#
+# PENDING_WRITE_MODE controls the durability guarantee:
+#   "durable"  - create_pending_payment() returns once the batch is committed
+#   "buffered" - returns immediately; rows still in the buffer are lost if
+#                the process dies before the next flush
+PENDING_WRITE_MODE = os.getenv("PENDING_WRITE_MODE", "durable")
+PENDING_BATCH_SIZE = int(os.getenv("PENDING_BATCH_SIZE", 256))
+PENDING_FLUSH_MS = float(os.getenv("PENDING_FLUSH_MS", 5))
+
+_pending_buffer = {}
+_pending_waiters = []
+_pending_has_rows: asyncio.Event = None
+_pending_full: asyncio.Event = None
+_pending_flusher_task: asyncio.Task = None
+
+
+async def _pending_flusher():
+    while True:
+        await _pending_has_rows.wait()
+        try:
+            await asyncio.wait_for(_pending_full.wait(), PENDING_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        await flush_pending_payments()
+
+
+@timed_db
+async def flush_pending_payments():
+    """
+    Write every buffered pending payment in a single transaction.
+    """
+    global _pending_buffer, _pending_waiters
+
+    if not _pending_buffer:
+        return
+
+    rows = list(_pending_buffer.values())
+    waiters = _pending_waiters
+    _pending_buffer = {}
+    _pending_waiters = []
+    _pending_has_rows.clear()
+    _pending_full.clear()
+
+    async def job(conn):
+        await conn.executemany(UPSERT_PENDING_SQL, rows)
 
     try:
-        c.execute("""
-            INSERT OR REPLACE INTO pending_payments
-            (telegram_id, username, payment_reference, status, date_created)
-            VALUES (?, ?, ?, 'pending', ?)
-        """, (telegram_id, username, reference, now))
+        await _write(job)
+        logger.info("✅ Pending payments flushed - Rows: %s", len(rows))
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
+    except Exception as e:
+        logger.error("❌ Error flushing pending payments: %s", e)
+        for future in waiters:
+            if not future.done():
+                future.set_exception(e)
+
+
+@timed_db
+async def create_pending_payment(telegram_id: int, username: str, reference: str):
+    now = int(time.time())
 
-        conn.commit()
-        print(f"✅ Pending payment created - User: {telegram_id}, Ref: {reference}")
+    # Keyed by telegram_id: repeated /start presses inside one flush window
+    # collapse into a single row, same as INSERT OR REPLACE would leave.
+    _pending_buffer[telegram_id] = (telegram_id, username, reference, now)
+    _pending_has_rows.set()
+    if len(_pending_buffer) >= PENDING_BATCH_SIZE:
+        _pending_full.set()
+
+    if PENDING_WRITE_MODE == "buffered":
+        return
+
+    future = asyncio.get_running_loop().create_future()
+    _pending_waiters.append(future)
+    try:
+        await future
+        logger.info("✅ Pending payment created - User: %s, Ref: %s", telegram_id, reference)
     except Exception as e:
-        print(f"❌ Error creating pending payment: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        logger.error("❌ Error creating pending payment: %s", e)
 
 
 # ================== MARK PAYMENT PAID ==================
-def mark_payment_paid(korapay_reference: str, custom_reference: str = None):
+SELECT_PENDING_BY_KORAPAY_SQL = """
+    SELECT telegram_id, username, payment_reference FROM pending_payments
+    WHERE korapay_reference=?
+"""
+
+SELECT_PENDING_BY_REFERENCE_SQL = """
+    SELECT telegram_id, username, payment_reference FROM pending_payments
+    WHERE payment_reference=? AND status='pending'
+"""
+
+SELECT_PENDING_ROW_BY_TELEGRAM_ID_SQL = """
+    SELECT telegram_id, username, payment_reference FROM pending_payments
+    WHERE telegram_id=? AND status='pending'
+"""
+
+UPDATE_PENDING_PAID_SQL = """
+    UPDATE pending_payments
+    SET status='paid', korapay_reference=?
+    WHERE telegram_id=?
+"""
+
+UPSERT_VERIFIED_SQL = """
+    INSERT INTO verified_users
+    (telegram_id, username, payment_reference, korapay_reference, payment_status, payment_verified_at)
+    VALUES (?, ?, ?, ?, 'paid', ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        payment_reference=excluded.payment_reference,
+        korapay_reference=excluded.korapay_reference,
+        payment_status='paid',
+        payment_verified_at=excluded.payment_verified_at
+"""
+
+
+@timed_db
+async def mark_payment_paid(korapay_reference: str, custom_reference: str = None,
+                            telegram_id: int = None):
     """
     Mark payment as paid using Korapay's reference.
-    Can optionally match against custom reference too.
+    Can optionally match against custom reference or Telegram ID too.
     """
-    now = datetime.datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    now = int(time.time())
 
-    try:
+    # The pending row may still be sitting in the write-behind buffer
+    await flush_pending_payments()
+
+    async def job(conn):
         # Try to find by Korapay reference first
-        c.execute("""
-            SELECT telegram_id, username, payment_reference FROM pending_payments
-            WHERE korapay_reference=?
-        """, (korapay_reference,))
-        
-        pending = c.fetchone()
-        
-        # If not found by Korapay ref, try custom reference (fallback)
+        async with conn.execute(SELECT_PENDING_BY_KORAPAY_SQL, (korapay_reference,)) as c:
+            pending = await c.fetchone()
+
+        # If not found by Korapay ref, try custom reference (fallback).
+        # The fallbacks only match unpaid rows, so a second charge can't
+        # overwrite a payment that is already on file.
         if not pending and custom_reference:
-            c.execute("""
-                SELECT telegram_id, username, payment_reference FROM pending_payments
-                WHERE payment_reference=?
-            """, (custom_reference,))
-            pending = c.fetchone()
-        
+            async with conn.execute(SELECT_PENDING_BY_REFERENCE_SQL, (custom_reference,)) as c:
+                pending = await c.fetchone()
+
+        # Finally the user the reference was issued to
+        if not pending and telegram_id:
+            async with conn.execute(SELECT_PENDING_ROW_BY_TELEGRAM_ID_SQL, (telegram_id,)) as c:
+                pending = await c.fetchone()
+
         if not pending:
-            print(f"⚠️ No pending payment found for Korapay ref: {korapay_reference}")
-            conn.close()
-            return False
+            return None
 
-        telegram_id, username, payment_ref = pending
+        matched_id, username, payment_ref = pending
 
         # Update pending payments status
-        c.execute("""
-            UPDATE pending_payments
-            SET status='paid', korapay_reference=?
-            WHERE telegram_id=?
-        """, (korapay_reference, telegram_id))
+        await conn.execute(UPDATE_PENDING_PAID_SQL, (korapay_reference, matched_id))
 
         # Insert or update verified_users
-        c.execute("""
-            INSERT INTO verified_users 
-            (telegram_id, username, payment_reference, korapay_reference, payment_status, date_payment_verified)
-            VALUES (?, ?, ?, ?, 'paid', ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                payment_reference=excluded.payment_reference,
-                korapay_reference=excluded.korapay_reference,
-                payment_status='paid',
-                date_payment_verified=excluded.date_payment_verified
-        """, (telegram_id, username, payment_ref, korapay_reference, now))
-
-        conn.commit()
-        print(f"✅ Payment marked as paid - User: {telegram_id}, Korapay Ref: {korapay_reference}")
-        return True
-        
+        await conn.execute(
+            UPSERT_VERIFIED_SQL,
+            (matched_id, username, payment_ref, korapay_reference, now)
+        )
+        await conn.execute(INSERT_CACHE_INVALIDATION_SQL, (matched_id, now))
+        return matched_id
+
+    try:
+        telegram_id = await _write(job)
     except Exception as e:
-        print(f"❌ Error marking payment paid: {e}")
-        conn.rollback()
+        logger.error("❌ Error marking payment paid: %s", e)
         return False
-    finally:
-        conn.close()
+
+    if telegram_id is None:
+        logger.warning("⚠️ No pending payment found for Korapay ref: %s", korapay_reference)
+        return False
+
+    _user_cache.invalidate(telegram_id)
+
+    logger.info("✅ Payment marked as paid - User: %s, Korapay Ref: %s", telegram_id, korapay_reference)
+    return True
+
+
+# ================== RECONCILIATION ==================
+SELECT_UNPAID_PENDING_SQL = """
+    SELECT telegram_id, payment_reference FROM pending_payments
+    WHERE status='pending'
+"""
+
+SELECT_PAID_REFERENCES_SQL = """
+    SELECT korapay_reference, payment_reference FROM verified_users
+    WHERE payment_status='paid'
+"""
+
+# Onboarding state is rebuilt from the user's rows on their next message
+RESET_FSM_STATE_SQL = """
+    UPDATE fsm_states SET state=NULL, updated_at=? WHERE user_id=?
+"""
+
+
+async def iter_unpaid_pending_payments(batch_size: int = 5000):
+    """
+    Yield batches of (telegram_id, payment_reference) still awaiting payment.
+    """
+    await flush_pending_payments()
+    async for rows in _iter_rows(SELECT_UNPAID_PENDING_SQL, batch_size):
+        yield rows
+
+
+async def iter_paid_references(batch_size: int = 5000):
+    """
+    Yield batches of (korapay_reference, payment_reference) already paid.
+    """
+    async for rows in _iter_rows(SELECT_PAID_REFERENCES_SQL, batch_size):
+        yield rows
+
+
+@timed_db
+async def mark_payments_paid(payments):
+    """
+    Mark a batch of (korapay_reference, telegram_id) payments paid in one
+    transaction. Returns the Telegram IDs that had a pending payment.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        marked = []
+        for korapay_reference, telegram_id in payments:
+            async with conn.execute(SELECT_PENDING_ROW_BY_TELEGRAM_ID_SQL, (telegram_id,)) as c:
+                pending = await c.fetchone()
+            if not pending:
+                continue
+            _, username, payment_ref = pending
+            await conn.execute(UPDATE_PENDING_PAID_SQL, (korapay_reference, telegram_id))
+            await conn.execute(
+                UPSERT_VERIFIED_SQL,
+                (telegram_id, username, payment_ref, korapay_reference, now)
+            )
+            await conn.execute(RESET_FSM_STATE_SQL, (now, telegram_id))
+            await conn.execute(INSERT_CACHE_INVALIDATION_SQL, (telegram_id, now))
+            marked.append(telegram_id)
+        return marked
+
+    marked = await _write(job)
+    for telegram_id in marked:
+        _user_cache.invalidate(telegram_id)
+        _fsm_cache.invalidate(telegram_id)
+
+    logger.info("✅ Reconciled %s payments", len(marked))
+    return marked
 
 
 # ================== MARK AGREEMENT SIGNED ==================
-def mark_agreement_signed(telegram_id: int):
-    now = datetime.datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+UPDATE_AGREEMENT_SIGNED_SQL = """
+    UPDATE verified_users
+    SET agreement_signed=1,
+        agreement_signed_at=?
+    WHERE telegram_id=?
+"""
 
-    try:
-        c.execute("""
-            UPDATE verified_users
-            SET agreement_signed=1,
-                date_agreement_signed=?
-            WHERE telegram_id=?
-        """, (now, telegram_id))
 
-        conn.commit()
-        
-        if c.rowcount > 0:
-            print(f"✅ Agreement signed - User: {telegram_id}")
-            return True
-        else:
-            print(f"⚠️ User not found in verified_users: {telegram_id}")
-            return False
-            
+@timed_db
+async def mark_agreement_signed(telegram_id: int):
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(UPDATE_AGREEMENT_SIGNED_SQL, (now, telegram_id)) as c:
+            rowcount = c.rowcount
+        if rowcount:
+            await conn.execute(INSERT_CACHE_INVALIDATION_SQL, (telegram_id, now))
+        return rowcount
+
+    try:
+        rowcount = await _write(job)
     except Exception as e:
-        print(f"❌ Error marking agreement signed: {e}")
-        conn.rollback()
+        logger.error("❌ Error marking agreement signed: %s", e)
         return False
-    finally:
-        conn.close()
 
+    _user_cache.invalidate(telegram_id)
 
-# ================== CHECK PAYMENT STATUS ==================
-def is_payment_paid(telegram_id: int) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    try:
-        c.execute("""
-            SELECT payment_status FROM verified_users WHERE telegram_id=?
-        """, (telegram_id,))
-        row = c.fetchone()
-        
-        result = row is not None and row[0] == "paid"
-        print(f"🔍 Payment check - User: {telegram_id}, Paid: {result}")
-        return result
-        
-    except Exception as e:
-        print(f"❌ Error checking payment status: {e}")
+    if rowcount > 0:
+        logger.info("✅ Agreement signed - User: %s", telegram_id)
+        return True
+    else:
+        logger.warning("⚠️ User not found in verified_users: %s", telegram_id)
         return False
-    finally:
-        conn.close()
+
+
+# ================== CHECK PAYMENT STATUS ==================
+@timed_db
+async def is_payment_paid(telegram_id: int) -> bool:
+    user = await get_user_by_telegram_id(telegram_id)
+
+    result = user is not None and user["payment_status"] == "paid"
+    logger.debug("🔍 Payment check - User: %s, Paid: %s", telegram_id, result)
+    return result
 
 
 # ================== GET USER BY REFERENCE ==================
-def get_user_by_reference(reference: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+SELECT_VERIFIED_BY_REFERENCE_SQL = """
+    SELECT telegram_id, username, payment_reference, payment_status,
+           agreement_signed, agreement_signed_at
+    FROM verified_users
+    WHERE payment_reference=?
+"""
+
+SELECT_PENDING_USER_BY_REFERENCE_SQL = """
+    SELECT telegram_id, username, payment_reference, status, 0, NULL
+    FROM pending_payments
+    WHERE payment_reference=?
+"""
+
+
+@timed_db
+async def get_user_by_reference(reference: str):
     try:
         # First check verified_users
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, payment_status, 
-                   agreement_signed, date_agreement_signed
-            FROM verified_users
-            WHERE payment_reference=?
-        """, (reference,))
-        row = c.fetchone()
+        row = await _fetchone(SELECT_VERIFIED_BY_REFERENCE_SQL, (reference,))
 
         # If not found in verified_users, check pending_payments
         if not row:
-            c.execute("""
-                SELECT telegram_id, username, payment_reference, status, 0, NULL
-                FROM pending_payments
-                WHERE payment_reference=?
-            """, (reference,))
-            row = c.fetchone()
+            row = await _fetchone(SELECT_PENDING_USER_BY_REFERENCE_SQL, (reference,))
 
         if row:
             user_data = {
@@ -220,48 +560,47 @@ def get_user_by_reference(reference: str):
                 "payment_reference": row[2],
                 "payment_status": row[3],
                 "agreement_signed": row[4],
-                "date_agreement_signed": row[5]
+                "agreement_signed_at": row[5]
             }
-            print(f"✅ User found - Ref: {reference}, ID: {row[0]}")
+            logger.debug("✅ User found - Ref: %s, ID: %s", reference, row[0])
             return user_data
         else:
-            print(f"⚠️ No user found for reference: {reference}")
+            logger.warning("⚠️ No user found for reference: %s", reference)
             return None
-            
+
     except Exception as e:
-        print(f"❌ Error getting user by reference: {e}")
+        logger.error("❌ Error getting user by reference: %s", e)
         return None
-    finally:
-        conn.close()
 
 
 # ================== GET USER BY KORAPAY REFERENCE ==================
-def get_user_by_korapay_reference(korapay_reference: str):
+SELECT_VERIFIED_BY_KORAPAY_SQL = """
+    SELECT telegram_id, username, payment_reference, korapay_reference,
+           payment_status, agreement_signed, agreement_signed_at
+    FROM verified_users
+    WHERE korapay_reference=?
+"""
+
+SELECT_PENDING_USER_BY_KORAPAY_SQL = """
+    SELECT telegram_id, username, payment_reference, korapay_reference,
+           status, 0, NULL
+    FROM pending_payments
+    WHERE korapay_reference=?
+"""
+
+
+@timed_db
+async def get_user_by_korapay_reference(korapay_reference: str):
     """
     Get user by Korapay's reference (used in webhook).
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
     try:
         # Check verified_users first
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, korapay_reference,
-                   payment_status, agreement_signed, date_agreement_signed
-            FROM verified_users
-            WHERE korapay_reference=?
-        """, (korapay_reference,))
-        row = c.fetchone()
+        row = await _fetchone(SELECT_VERIFIED_BY_KORAPAY_SQL, (korapay_reference,))
 
         # If not found, check pending_payments
         if not row:
-            c.execute("""
-                SELECT telegram_id, username, payment_reference, korapay_reference,
-                       status, 0, NULL
-                FROM pending_payments
-                WHERE korapay_reference=?
-            """, (korapay_reference,))
-            row = c.fetchone()
+            row = await _fetchone(SELECT_PENDING_USER_BY_KORAPAY_SQL, (korapay_reference,))
 
         if row:
             user_data = {
@@ -271,72 +610,205 @@ def get_user_by_korapay_reference(korapay_reference: str):
                 "korapay_reference": row[3],
                 "payment_status": row[4],
                 "agreement_signed": row[5],
-                "date_agreement_signed": row[6]
+                "agreement_signed_at": row[6]
             }
-            print(f"✅ User found by Korapay ref: {korapay_reference}, ID: {row[0]}")
+            logger.debug("✅ User found by Korapay ref: %s, ID: %s", korapay_reference, row[0])
             return user_data
         else:
-            print(f"⚠️ No user found for Korapay reference: {korapay_reference}")
+            logger.warning("⚠️ No user found for Korapay reference: %s", korapay_reference)
             return None
-            
+
     except Exception as e:
-        print(f"❌ Error getting user by Korapay reference: {e}")
+        logger.error("❌ Error getting user by Korapay reference: %s", e)
         return None
-    finally:
-        conn.close()
 
 
 # ================== GET USER BY TELEGRAM ID ==================
-def get_user_by_telegram_id(telegram_id: int):
+SELECT_VERIFIED_BY_TELEGRAM_ID_SQL = """
+    SELECT telegram_id, username, payment_reference, korapay_reference,
+           payment_status, agreement_signed, agreement_signed_at
+    FROM verified_users
+    WHERE telegram_id=?
+"""
+
+
+@timed_db
+async def get_user_by_telegram_id(telegram_id: int):
     """
     Get verified user by their Telegram ID.
+    Served from the user cache when possible; misses (including users
+    with no verified_users row) are cached too.
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+    user = _user_cache.get(telegram_id, _MISSING)
+    if user is not _MISSING:
+        return dict(user) if user else None
+
+    ticket = _user_cache.ticket()
     try:
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, korapay_reference,
-                   payment_status, agreement_signed, date_agreement_signed
-            FROM verified_users
-            WHERE telegram_id=?
-        """, (telegram_id,))
-        row = c.fetchone()
+        row = await _fetchone(SELECT_VERIFIED_BY_TELEGRAM_ID_SQL, (telegram_id,))
 
+        user = None
         if row:
-            return {
+            user = {
                 "telegram_id": row[0],
                 "username": row[1],
                 "payment_reference": row[2],
                 "korapay_reference": row[3],
                 "payment_status": row[4],
                 "agreement_signed": row[5],
-                "date_agreement_signed": row[6]
+                "agreement_signed_at": row[6]
             }
+
+        _user_cache.set(telegram_id, user, ticket)
+        return dict(user) if user else None
+
+    except Exception as e:
+        logger.error("❌ Error getting user by telegram ID: %s", e)
         return None
-        
+
+
+# ================== USER CACHE STATS ==================
+def get_user_cache_stats():
+    return _user_cache.stats()
+
+
+# ================== USER CACHE SYNC ==================
+# Every write that changes a user's status logs the user here, in the same
+# transaction. Each process replays new entries into its own cache, so a
+# payment confirmed by one worker is seen by the others within
+# USER_CACHE_SYNC_SECONDS instead of after USER_CACHE_TTL.
+INSERT_CACHE_INVALIDATION_SQL = """
+    INSERT INTO cache_invalidations (telegram_id, created_at) VALUES (?, ?)
+"""
+
+SELECT_CACHE_INVALIDATIONS_SQL = """
+    SELECT id, telegram_id FROM cache_invalidations
+    WHERE id > ?
+    ORDER BY id
+"""
+
+
+async def sync_user_cache():
+    """
+    Drop cached users that another process has changed since the last sync.
+    """
+    global _cache_sync_id
+
+    for row_id, telegram_id in await _fetchall(SELECT_CACHE_INVALIDATIONS_SQL, (_cache_sync_id,)):
+        _user_cache.invalidate(telegram_id)
+        _fsm_cache.invalidate(telegram_id)
+        _cache_sync_id = row_id
+
+
+async def _cache_sync_loop():
+    while True:
+        await asyncio.sleep(USER_CACHE_SYNC_SECONDS)
+        try:
+            await sync_user_cache()
+        except Exception as e:
+            logger.error("❌ Error syncing user cache: %s", e)
+
+
+# ================== FSM STATES ==================
+# Backing store for fsm_storage.SqliteStorage. Reads go through
+# _fsm_cache, so routing an update on its state costs no query once the
+# user is cached; writes invalidate it here and, via the invalidation
+# log, in every other process.
+SELECT_FSM_RECORDS_SQL = """
+    SELECT bot_id, chat_id, destiny, state, data FROM fsm_states
+    WHERE user_id=?
+"""
+
+UPSERT_FSM_STATE_SQL = """
+    INSERT INTO fsm_states (bot_id, chat_id, user_id, destiny, state, data, updated_at)
+    VALUES (?, ?, ?, ?, ?, '{}', ?)
+    ON CONFLICT(bot_id, chat_id, user_id, destiny) DO UPDATE SET
+        state=excluded.state,
+        updated_at=excluded.updated_at
+"""
+
+UPSERT_FSM_DATA_SQL = """
+    INSERT INTO fsm_states (bot_id, chat_id, user_id, destiny, state, data, updated_at)
+    VALUES (?, ?, ?, ?, NULL, ?, ?)
+    ON CONFLICT(bot_id, chat_id, user_id, destiny) DO UPDATE SET
+        data=excluded.data,
+        updated_at=excluded.updated_at
+"""
+
+
+@timed_db
+async def get_fsm_records(user_id: int):
+    """
+    All FSM records of a user, keyed by (bot_id, chat_id, destiny).
+    Returns None if they couldn't be read.
+    """
+    records = _fsm_cache.get(user_id)
+    if records is not None:
+        return records
+
+    ticket = _fsm_cache.ticket()
+    try:
+        rows = await _fetchall(SELECT_FSM_RECORDS_SQL, (user_id,))
+        records = {
+            (row[0], row[1], row[2]): {"state": row[3], "data": json.loads(row[4] or "{}")}
+            for row in rows
+        }
+        _fsm_cache.set(user_id, records, ticket)
+        return records
+
     except Exception as e:
-        print(f"❌ Error getting user by telegram ID: {e}")
+        logger.error("❌ Error getting FSM state: %s", e)
         return None
+
+
+async def _save_fsm_record(sql: str, user_id: int, params: tuple):
+    now = int(time.time())
+
+    async def job(conn):
+        await conn.execute(sql, params + (now,))
+        await conn.execute(INSERT_CACHE_INVALIDATION_SQL, (user_id, now))
+
+    try:
+        await _write(job)
     finally:
-        conn.close()
+        _fsm_cache.invalidate(user_id)
+
+
+@timed_db
+async def set_fsm_state(bot_id: int, chat_id: int, user_id: int, destiny: str, state: str = None):
+    try:
+        await _save_fsm_record(UPSERT_FSM_STATE_SQL, user_id, (bot_id, chat_id, user_id, destiny, state))
+        return True
+    except Exception as e:
+        logger.error("❌ Error setting FSM state: %s", e)
+        return False
+
+
+@timed_db
+async def set_fsm_data(bot_id: int, chat_id: int, user_id: int, destiny: str, data: dict):
+    try:
+        await _save_fsm_record(UPSERT_FSM_DATA_SQL, user_id, (bot_id, chat_id, user_id, destiny, json.dumps(data)))
+        return True
+    except Exception as e:
+        logger.error("❌ Error setting FSM data: %s", e)
+        return False
 
 
 # ================== GET PENDING PAYMENT BY TELEGRAM ID ==================
-def get_pending_payment_by_telegram_id(telegram_id: int):
+SELECT_PENDING_BY_TELEGRAM_ID_SQL = """
+    SELECT telegram_id, username, payment_reference, korapay_reference, status
+    FROM pending_payments
+    WHERE telegram_id=?
+"""
+
+
+@timed_db
+async def get_pending_payment_by_telegram_id(telegram_id: int):
     """
     Get pending payment details for a user (used before payment).
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
     try:
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, korapay_reference, status
-            FROM pending_payments
-            WHERE telegram_id=?
-        """, (telegram_id,))
-        row = c.fetchone()
+        row = await _fetchone(SELECT_PENDING_BY_TELEGRAM_ID_SQL, (telegram_id,))
 
         if row:
             return {
@@ -347,114 +819,849 @@ def get_pending_payment_by_telegram_id(telegram_id: int):
                 "status": row[4]
             }
         return None
-        
+
     except Exception as e:
-        print(f"❌ Error getting pending payment: {e}")
+        logger.error("❌ Error getting pending payment: %s", e)
         return None
-    finally:
-        conn.close()
 
 
-# ================== GET MOST RECENT PENDING PAYMENT ==================
-def get_most_recent_pending_payment():
+# ================== VERIFIED USERS (PAGINATED) ==================
+def _verified_users_filter(signed: bool = None, date_from: int = None, date_to: int = None):
+    clauses, params = [], []
+    if signed is not None:
+        clauses.append("agreement_signed=?")
+        params.append(1 if signed else 0)
+    if date_from is not None:
+        clauses.append("payment_verified_at>=?")
+        params.append(date_from)
+    if date_to is not None:
+        clauses.append("payment_verified_at<?")
+        params.append(date_to)
+    return clauses, params
+
+
+@timed_db
+async def get_verified_users_page(signed: bool = None, date_from: int = None,
+                                  date_to: int = None, cursor: tuple = None,
+                                  backwards: bool = False, limit: int = 10):
+    """
+    One page of verified users, newest payment first, using keyset
+    pagination on (payment_verified_at, telegram_id). `cursor` is the key
+    of the row the page starts after (or before, when `backwards`).
+    Returns (users, has_more) where has_more refers to the direction read.
     """
-    Get the most recent pending payment (fallback for webhook matching).
+    clauses, params = _verified_users_filter(signed, date_from, date_to)
+    if cursor is not None:
+        clauses.append("(payment_verified_at, telegram_id) " + (">" if backwards else "<") + " (?, ?)")
+        params.extend(cursor)
+
+    order = "ASC" if backwards else "DESC"
+    sql = f"""
+        SELECT telegram_id, username, agreement_signed, payment_verified_at
+        FROM verified_users
+        {"WHERE " + " AND ".join(clauses) if clauses else ""}
+        ORDER BY payment_verified_at {order}, telegram_id {order}
+        LIMIT ?
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+    params.append(limit + 1)
+
     try:
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, korapay_reference, status
-            FROM pending_payments
-            WHERE status='pending'
-            ORDER BY date_created DESC
-            LIMIT 1
-        """)
-        row = c.fetchone()
+        rows = await _fetchall(sql, tuple(params))
+    except Exception as e:
+        logger.error("❌ Error getting verified users page: %s", e)
+        return [], False
 
-        if row:
-            return {
-                "telegram_id": row[0],
-                "username": row[1],
-                "payment_reference": row[2],
-                "korapay_reference": row[3],
-                "status": row[4]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    users = [
+        {
+            "telegram_id": row[0],
+            "username": row[1],
+            "agreement_signed": row[2],
+            "payment_verified_at": row[3]
+        }
+        for row in rows
+    ]
+    return users, has_more
+
+
+_verified_count_cache = TTLCache(maxsize=256, ttl=float(os.getenv("USER_COUNT_CACHE_TTL", 30)))
+
+
+@timed_db
+async def count_verified_users(signed: bool = None, date_from: int = None, date_to: int = None):
+    """
+    Count verified users matching the /users filters. Answered from the
+    keyset indexes and cached briefly, since paging re-asks on every click.
+    """
+    key = (signed, date_from, date_to)
+    count = _verified_count_cache.get(key)
+    if count is not None:
+        return count
+
+    clauses, params = _verified_users_filter(signed, date_from, date_to)
+    sql = "SELECT COUNT(*) FROM verified_users"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+
+    try:
+        count = (await _fetchone(sql, tuple(params)))[0]
+    except Exception as e:
+        logger.error("❌ Error counting verified users: %s", e)
+        return 0
+
+    _verified_count_cache.set(key, count)
+    return count
+
+
+# ================== WEBHOOK EVENTS ==================
+INSERT_WEBHOOK_EVENT_SQL = """
+    INSERT OR IGNORE INTO webhook_events
+    (event_key, event, korapay_reference, status, payload, received_at, owner)
+    VALUES (?, ?, ?, 'received', ?, ?, ?)
+"""
+
+RECLAIM_WEBHOOK_EVENT_SQL = """
+    UPDATE webhook_events
+    SET status='received', received_at=?, owner=?
+    WHERE event_key=? AND status='failed'
+"""
+
+UPDATE_WEBHOOK_EVENT_STATUS_SQL = """
+    UPDATE webhook_events
+    SET status=?, processed_at=?
+    WHERE event_key=?
+"""
+
+
+@timed_db
+async def claim_webhook_event(event_key: str, event: str, korapay_reference: str,
+                              payload: str) -> bool:
+    """
+    Record a webhook delivery. Returns True if the caller should process
+    it: the event is new, or a previous attempt ended in 'failed'.
+    Returns False for duplicates.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(
+            INSERT_WEBHOOK_EVENT_SQL,
+            (event_key, event, korapay_reference, payload, now, INSTANCE_ID)
+        ) as c:
+            if c.rowcount:
+                return True
+        async with conn.execute(RECLAIM_WEBHOOK_EVENT_SQL, (now, INSTANCE_ID, event_key)) as c:
+            return c.rowcount > 0
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error recording webhook event: %s", e)
+        # Fail open: processing is still guarded by the payment status
+        return True
+
+
+@timed_db
+async def set_webhook_event_status(event_key: str, status: str):
+    now = int(time.time())
+
+    async def job(conn):
+        await conn.execute(UPDATE_WEBHOOK_EVENT_STATUS_SQL, (status, now, event_key))
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error updating webhook event %s: %s", event_key, e)
+
+
+SCHEDULE_WEBHOOK_RETRY_SQL = """
+    UPDATE webhook_events
+    SET status=?, attempts=?, next_attempt_at=?, last_error=?
+    WHERE event_key=?
+"""
+
+
+@timed_db
+async def schedule_webhook_event_retry(event_key: str, attempts: int, next_attempt_at: int,
+                                       error: str, give_up: bool = False):
+    """
+    Record a failed processing attempt. The event stays queued as 'retry'
+    unless `give_up` is set, in which case it is marked 'failed'.
+    """
+    status = "failed" if give_up else "retry"
+
+    async def job(conn):
+        await conn.execute(
+            SCHEDULE_WEBHOOK_RETRY_SQL,
+            (status, attempts, next_attempt_at, error, event_key)
+        )
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error scheduling webhook retry %s: %s", event_key, e)
+
+
+# Queued events whose owner is no longer alive: it stopped, crashed, or
+# the row predates owners. Their instance lease is gone or expired.
+SELECT_ORPHANED_WEBHOOK_EVENTS_SQL = """
+    SELECT event_key, korapay_reference, attempts, next_attempt_at, payload
+    FROM webhook_events e
+    WHERE status IN ('received', 'retry')
+      AND (owner IS NULL OR NOT EXISTS (
+          SELECT 1 FROM leases
+          WHERE name = 'instance:' || e.owner AND expires_at >= ?
+      ))
+    ORDER BY received_at
+"""
+
+ADOPT_WEBHOOK_EVENT_SQL = """
+    UPDATE webhook_events SET owner=? WHERE event_key=?
+"""
+
+
+@timed_db
+async def adopt_orphaned_webhook_events():
+    """
+    Take ownership of webhook events that were accepted but not finished
+    by an instance that is no longer alive, and return them for
+    re-queueing. Runs in one write transaction, so two instances can't
+    adopt the same event.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(SELECT_ORPHANED_WEBHOOK_EVENTS_SQL, (now,)) as c:
+            rows = await c.fetchall()
+        await conn.executemany(ADOPT_WEBHOOK_EVENT_SQL, [(INSTANCE_ID, row[0]) for row in rows])
+        return rows
+
+    try:
+        rows = await _write(job)
+        return [
+            {
+                "event_key": row[0],
+                "korapay_reference": row[1],
+                "attempts": row[2] or 0,
+                "next_attempt_at": row[3],
+                "payload": row[4]
+            }
+            for row in rows
+        ]
+    except Exception as e:
+        logger.error("❌ Error adopting orphaned webhook events: %s", e)
+        return []
+
+
+# ================== LEASES ==================
+# A lease is held by `holder` until `expires_at` unless renewed. Used for
+# leader election and as each instance's liveness heartbeat.
+ACQUIRE_LEASE_SQL = """
+    INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET
+        holder=excluded.holder,
+        expires_at=excluded.expires_at
+    WHERE leases.holder=excluded.holder OR leases.expires_at < ?
+"""
+
+
+@timed_db
+async def acquire_lease(name: str, holder: str, ttl: int) -> bool:
+    """
+    Take or renew the lease `name` for `ttl` seconds. Returns True if
+    `holder` now holds it.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(ACQUIRE_LEASE_SQL, (name, holder, now + ttl, now)) as c:
+            return c.rowcount > 0
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error acquiring lease %s: %s", name, e)
+        return False
+
+
+@timed_db
+async def release_lease(name: str, holder: str):
+    async def job(conn):
+        await conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error releasing lease %s: %s", name, e)
+
+
+@timed_db
+async def prune_coordination_state(older_than: int = 3600):
+    """
+    Drop long-expired leases and cache invalidations every process has
+    had time to replay.
+    """
+    cutoff = int(time.time()) - older_than
+
+    async def job(conn):
+        await conn.execute("DELETE FROM leases WHERE expires_at < ?", (cutoff,))
+        await conn.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (cutoff,))
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error pruning coordination state: %s", e)
+
+
+# ================== UNMATCHED PAYMENTS ==================
+INSERT_UNMATCHED_PAYMENT_SQL = """
+    INSERT OR IGNORE INTO unmatched_payments
+    (korapay_reference, amount, payload, received_at)
+    VALUES (?, ?, ?, ?)
+"""
+
+SELECT_UNMATCHED_PAYMENTS_SQL = """
+    SELECT korapay_reference, amount, payload, received_at
+    FROM unmatched_payments
+    WHERE resolved_at IS NULL
+    ORDER BY received_at
+    LIMIT ?
+"""
+
+RESOLVE_UNMATCHED_PAYMENT_SQL = """
+    UPDATE unmatched_payments
+    SET resolved_at=?, telegram_id=?
+    WHERE korapay_reference=? AND resolved_at IS NULL
+"""
+
+
+@timed_db
+async def add_unmatched_payment(korapay_reference: str, amount: float, payload: str):
+    """
+    Park a successful charge that couldn't be tied to a user, for an
+    admin to resolve instead of guessing.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        await conn.execute(INSERT_UNMATCHED_PAYMENT_SQL, (korapay_reference, amount, payload, now))
+
+    try:
+        await _write(job)
+        logger.info("📥 Unmatched payment queued - Korapay Ref: %s", korapay_reference)
+    except Exception as e:
+        logger.error("❌ Error queueing unmatched payment: %s", e)
+
+
+@timed_db
+async def get_unmatched_payments(limit: int = 20):
+    try:
+        rows = await _fetchall(SELECT_UNMATCHED_PAYMENTS_SQL, (limit,))
+        return [
+            {
+                "korapay_reference": row[0],
+                "amount": row[1],
+                "payload": row[2],
+                "received_at": row[3]
+            }
+            for row in rows
+        ]
+    except Exception as e:
+        logger.error("❌ Error getting unmatched payments: %s", e)
+        return []
+
+
+@timed_db
+async def resolve_unmatched_payment(korapay_reference: str, telegram_id: int) -> bool:
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(
+            RESOLVE_UNMATCHED_PAYMENT_SQL, (now, telegram_id, korapay_reference)
+        ) as c:
+            return c.rowcount > 0
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error resolving unmatched payment: %s", e)
+        return False
+
+
+# ================== BROADCASTS ==================
+SELECT_VERIFIED_IDS_AFTER_SQL = """
+    SELECT telegram_id FROM verified_users
+    WHERE telegram_id > ?
+    ORDER BY telegram_id
+    LIMIT ?
+"""
+
+
+async def iter_verified_user_ids(after_id: int = 0, batch_size: int = 500):
+    """
+    Yield batches of verified user IDs in ascending order, starting after
+    `after_id`. Each batch is one keyset query on the primary key, so
+    memory stays flat and no connection is held between batches.
+    """
+    while True:
+        rows = await _fetchall(SELECT_VERIFIED_IDS_AFTER_SQL, (after_id, batch_size))
+        if not rows:
+            return
+        batch = [row[0] for row in rows]
+        yield batch
+        after_id = batch[-1]
+
+
+@timed_db
+async def create_broadcast(text: str) -> int:
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(
+            "INSERT INTO broadcasts (text, created_at, owner) VALUES (?, ?, ?)",
+            (text, now, INSTANCE_ID)
+        ) as c:
+            return c.lastrowid
+
+    return await _write(job)
+
+
+@timed_db
+async def update_broadcast_progress(broadcast_id: int, last_telegram_id: int,
+                                    sent: int, failed: int) -> bool:
+    """
+    Checkpoint a broadcast this instance owns. Returns False once another
+    instance has taken it over, so the caller stops sending.
+    """
+    async def job(conn):
+        async with conn.execute("""
+            UPDATE broadcasts
+            SET last_telegram_id=?, sent=?, failed=?
+            WHERE id=? AND owner=?
+        """, (last_telegram_id, sent, failed, broadcast_id, INSTANCE_ID)) as c:
+            return c.rowcount > 0
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error checkpointing broadcast %s: %s", broadcast_id, e)
+        return True
+
+
+@timed_db
+async def finish_broadcast(broadcast_id: int, status: str = "done"):
+    now = int(time.time())
+
+    async def job(conn):
+        await conn.execute(
+            "UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND owner=?",
+            (status, now, broadcast_id, INSTANCE_ID)
+        )
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error finishing broadcast %s: %s", broadcast_id, e)
+
+
+# Running broadcasts whose owner is no longer alive, or that were
+# released by an instance that stopped sending them
+SELECT_ORPHANED_BROADCASTS_SQL = """
+    SELECT id, text, last_telegram_id, sent, failed, created_at
+    FROM broadcasts b
+    WHERE status='running'
+      AND (owner IS NULL OR NOT EXISTS (
+          SELECT 1 FROM leases
+          WHERE name = 'instance:' || b.owner AND expires_at >= ?
+      ))
+    ORDER BY id
+"""
+
+
+@timed_db
+async def adopt_orphaned_broadcasts():
+    """
+    Take ownership of running broadcasts nobody alive is sending and
+    return them for resuming. One write transaction, so two instances
+    can't adopt the same broadcast.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(SELECT_ORPHANED_BROADCASTS_SQL, (now,)) as c:
+            rows = await c.fetchall()
+        await conn.executemany(
+            "UPDATE broadcasts SET owner=? WHERE id=?", [(INSTANCE_ID, row[0]) for row in rows]
+        )
+        return rows
+
+    try:
+        rows = await _write(job)
+        return [
+            {
+                "id": row[0],
+                "text": row[1],
+                "last_telegram_id": row[2],
+                "sent": row[3],
+                "failed": row[4],
+                "created_at": row[5]
             }
+            for row in rows
+        ]
+    except Exception as e:
+        logger.error("❌ Error adopting broadcasts: %s", e)
+        return []
+
+
+@timed_db
+async def release_broadcasts():
+    """
+    Give up this instance's running broadcasts, so the leader resumes
+    them without waiting for this instance's lease to expire.
+    """
+    async def job(conn):
+        await conn.execute(
+            "UPDATE broadcasts SET owner=NULL WHERE owner=? AND status='running'", (INSTANCE_ID,)
+        )
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error releasing broadcasts: %s", e)
+
+
+# ================== AGREEMENT DOCUMENTS ==================
+AGREEMENT_DOCUMENT_COLUMNS = """
+    telegram_id, version, sha256, size, storage_key, file_unique_id, uploaded_at
+"""
+
+
+def _agreement_document(row):
+    return {
+        "telegram_id": row[0],
+        "version": row[1],
+        "sha256": row[2],
+        "size": row[3],
+        "storage_key": row[4],
+        "file_unique_id": row[5],
+        "uploaded_at": row[6]
+    }
+
+
+@timed_db
+async def find_agreement_document(telegram_id: int, sha256: str = None,
+                                  file_unique_id: str = None):
+    """
+    A document this user already uploaded with the same content hash or
+    the same Telegram file_unique_id (duplicate-upload detection).
+    """
+    if sha256:
+        sql = f"SELECT {AGREEMENT_DOCUMENT_COLUMNS} FROM agreement_documents WHERE sha256=? AND telegram_id=?"
+        params = (sha256, telegram_id)
+    else:
+        sql = f"SELECT {AGREEMENT_DOCUMENT_COLUMNS} FROM agreement_documents WHERE telegram_id=? AND file_unique_id=?"
+        params = (telegram_id, file_unique_id)
+
+    try:
+        row = await _fetchone(sql, params)
+        return _agreement_document(row) if row else None
+    except Exception as e:
+        logger.error("❌ Error finding agreement document: %s", e)
         return None
-        
+
+
+@timed_db
+async def add_agreement_document(telegram_id: int, sha256: str, size: int,
+                                 storage_key: str, file_unique_id: str = None) -> int:
+    """
+    Record a new agreement version for the user. Returns the version number.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(
+            "SELECT COALESCE(MAX(version), 0) + 1 FROM agreement_documents WHERE telegram_id=?",
+            (telegram_id,)
+        ) as c:
+            version = (await c.fetchone())[0]
+        await conn.execute(f"""
+            INSERT INTO agreement_documents ({AGREEMENT_DOCUMENT_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (telegram_id, version, sha256, size, storage_key, file_unique_id, now))
+        return version
+
+    version = await _write(job)
+    logger.info(
+        "✅ Agreement stored - User: %s, Version: %s, SHA-256: %s",
+        telegram_id, version, sha256[:12]
+    )
+    return version
+
+
+@timed_db
+async def get_latest_agreement_document(telegram_id: int):
+    try:
+        row = await _fetchone(f"""
+            SELECT {AGREEMENT_DOCUMENT_COLUMNS} FROM agreement_documents
+            WHERE telegram_id=?
+            ORDER BY version DESC
+            LIMIT 1
+        """, (telegram_id,))
+        return _agreement_document(row) if row else None
     except Exception as e:
-        print(f"❌ Error getting most recent pending payment: {e}")
+        logger.error("❌ Error getting agreement document: %s", e)
         return None
+
+
+@timed_db
+async def record_agreement_validation(telegram_id: int, file_unique_id: str, sha256: str,
+                                      size: int, result: dict):
+    """
+    Store the outcome of a PDF structural check (accepted or rejected).
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        await conn.execute("""
+            INSERT INTO agreement_validations
+                (telegram_id, file_unique_id, sha256, size, valid, reason,
+                 pdf_version, page_count, encrypted, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            telegram_id, file_unique_id, sha256, size, int(result["valid"]),
+            result["reason"], result["pdf_version"], result["page_count"],
+            int(result["encrypted"]), now
+        ))
+
+    try:
+        await _write(job)
+    except Exception as e:
+        logger.error("❌ Error recording agreement validation: %s", e)
+
+
+# ================== EXPORTS ==================
+# Tables an admin can export and the columns included, in order
+EXPORT_COLUMNS = {
+    "verified_users": (
+        "telegram_id", "username", "payment_reference", "korapay_reference",
+        "payment_status", "payment_verified_at", "agreement_signed", "agreement_signed_at"
+    ),
+    "pending_payments": (
+        "telegram_id", "username", "payment_reference", "korapay_reference",
+        "status", "created_at"
+    ),
+    "unmatched_payments": (
+        "korapay_reference", "amount", "received_at", "resolved_at", "telegram_id"
+    ),
+}
+
+
+async def iter_export_rows(table: str, batch_size: int = 1000):
+    """
+    Yield every row of an EXPORT_COLUMNS table in batches of `batch_size`.
+    """
+    columns = EXPORT_COLUMNS[table]
+    if table == "pending_payments":
+        await flush_pending_payments()
+
+    sql = f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid"
+    batches = _iter_rows(sql, batch_size)
+    try:
+        async for rows in batches:
+            yield rows
     finally:
-        conn.close()
-
-
-# ================== GET ALL VERIFIED USERS ==================
-def get_all_verified_users():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    try:
-        c.execute("""
-            SELECT telegram_id, username, payment_reference, payment_status, 
-                   agreement_signed, date_payment_verified, date_agreement_signed
-            FROM verified_users
-            ORDER BY date_payment_verified DESC
-        """)
-        rows = c.fetchall()
-        
-        users = []
-        for row in rows:
-            users.append({
-                "telegram_id": row[0],
-                "username": row[1],
-                "payment_reference": row[2],
-                "payment_status": row[3],
-                "agreement_signed": row[4],
-                "date_payment_verified": row[5],
-                "date_agreement_signed": row[6]
-            })
-        
-        return users
-        
-    except Exception as e:
-        print(f"❌ Error getting all verified users: {e}")
-        return []
-    finally:
-        conn.close()
+        # Close the read connection as soon as the consumer stops, even early
+        await batches.aclose()
+
+
+# ================== PENDING PAYMENT EXPIRY ==================
+SELECT_EXPIRED_PENDING_SQL = """
+    SELECT id, payment_reference, telegram_id, username, created_at
+    FROM pending_payments
+    WHERE status='pending' AND created_at < ?
+    ORDER BY created_at
+    LIMIT ?
+"""
+
+INSERT_PENDING_ARCHIVE_SQL = """
+    INSERT OR REPLACE INTO pending_payments_archive
+    (payment_reference, telegram_id, username, created_at, expired_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+DELETE_PENDING_BY_ID_SQL = """
+    DELETE FROM pending_payments WHERE id=?
+"""
+
+SELECT_ARCHIVED_PENDING_SQL = """
+    SELECT payment_reference, telegram_id, username, created_at
+    FROM pending_payments_archive
+    WHERE payment_reference=?
+"""
+
+RESTORE_PENDING_SQL = """
+    INSERT INTO pending_payments
+    (telegram_id, username, payment_reference, status, created_at)
+    VALUES (?, ?, ?, 'pending', ?)
+    ON CONFLICT(telegram_id) DO NOTHING
+"""
+
+DELETE_PENDING_ARCHIVE_SQL = """
+    DELETE FROM pending_payments_archive WHERE payment_reference=?
+"""
+
+# trg_pending_insert counts every insert as a new start in the funnel; a
+# restored reference was counted when it was first issued
+UNCOUNT_FUNNEL_START_SQL = """
+    UPDATE funnel_buckets SET started = started - 1
+    WHERE (granularity = 'hour' AND bucket = COALESCE(?1, 0) / 3600 * 3600)
+       OR (granularity = 'day' AND bucket = COALESCE(?1, 0) / 86400 * 86400)
+"""
+
+
+@timed_db
+async def expire_pending_payments(older_than: int, batch_size: int = 1000) -> int:
+    """
+    Move up to `batch_size` unpaid pending payments created more than
+    `older_than` seconds ago into pending_payments_archive. Returns how
+    many were moved; call again until it returns less than `batch_size`.
+    """
+    now = int(time.time())
+
+    async def job(conn):
+        async with conn.execute(SELECT_EXPIRED_PENDING_SQL, (now - older_than, batch_size)) as c:
+            rows = await c.fetchall()
+        await conn.executemany(
+            INSERT_PENDING_ARCHIVE_SQL, [(row[1], row[2], row[3], row[4], now) for row in rows]
+        )
+        await conn.executemany(DELETE_PENDING_BY_ID_SQL, [(row[0],) for row in rows])
+        return len(rows)
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error expiring pending payments: %s", e)
+        return 0
+
+
+@timed_db
+async def restore_pending_payment(payment_reference: str):
+    """
+    Bring an expired reference back into pending_payments, for a payment
+    that arrives after it expired. Returns the pending user, or None if
+    the reference isn't archived or its user has started over since.
+    """
+    async def job(conn):
+        async with conn.execute(SELECT_ARCHIVED_PENDING_SQL, (payment_reference,)) as c:
+            row = await c.fetchone()
+        if not row:
+            return None
+        async with conn.execute(RESTORE_PENDING_SQL, (row[1], row[2], row[0], row[3])) as c:
+            if not c.rowcount:
+                return None
+        await conn.execute(UNCOUNT_FUNNEL_START_SQL, (row[3],))
+        await conn.execute(DELETE_PENDING_ARCHIVE_SQL, (payment_reference,))
+        return row
+
+    try:
+        row = await _write(job)
+    except Exception as e:
+        logger.error("❌ Error restoring pending payment: %s", e)
+        return None
+
+    if not row:
+        return None
+    logger.info("♻️ Restored expired pending payment: %s", payment_reference)
+    return {
+        "telegram_id": row[1],
+        "username": row[2],
+        "payment_reference": row[0],
+        "payment_status": "pending",
+        "agreement_signed": 0,
+        "agreement_signed_at": None
+    }
+
+
+# ================== COMPACTION ==================
+@timed_db
+async def compact_database(vacuum_pages: int = 1000, analysis_limit: int = 1000):
+    """
+    Return up to `vacuum_pages` free pages to the filesystem and refresh
+    the query planner statistics. Returns the free pages left, or None
+    on error.
+    """
+    async def job(conn):
+        # Frees one page per step, so step it to completion
+        async with conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})") as c:
+            await c.fetchall()
+        # ANALYZE limited to `analysis_limit` rows per index, and only for
+        # tables whose statistics are missing or stale
+        await conn.execute(f"PRAGMA analysis_limit={int(analysis_limit)}")
+        await conn.execute("PRAGMA optimize")
+        async with conn.execute("PRAGMA freelist_count") as c:
+            return (await c.fetchone())[0]
+
+    try:
+        return await _write(job)
+    except Exception as e:
+        logger.error("❌ Error compacting database: %s", e)
+        return None
 
 
 # ================== GET STATS ==================
-def get_stats():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    try:
-        # Total pending payments
-        c.execute("SELECT COUNT(*) FROM pending_payments WHERE status='pending'")
-        pending_count = c.fetchone()[0]
-        
-        # Total paid
-        c.execute("SELECT COUNT(*) FROM verified_users WHERE payment_status='paid'")
-        paid_count = c.fetchone()[0]
-        
-        # Total agreements signed
-        c.execute("SELECT COUNT(*) FROM verified_users WHERE agreement_signed=1")
-        signed_count = c.fetchone()[0]
-        
-        return {
-            "pending_payments": pending_count,
-            "paid_users": paid_count,
-            "signed_agreements": signed_count
-        }
-        
+@timed_db
+async def get_stats():
+    """
+    Counters maintained by triggers (see migration 9), so this is a
+    three-row primary key read regardless of table size.
+    """
+    stats = {
+        "pending_payments": 0,
+        "paid_users": 0,
+        "signed_agreements": 0
+    }
+
+    try:
+        for name, value in await _fetchall("SELECT name, value FROM stats_counters"):
+            if name in stats:
+                stats[name] = value
     except Exception as e:
-        print(f"❌ Error getting stats: {e}")
-        return {
-            "pending_payments": 0,
-            "paid_users": 0,
-            "signed_agreements": 0
-        }
-    finally:
-        conn.close()
+        logger.error("❌ Error getting stats: %s", e)
+
+    return stats
+
+
+# ================== GET FUNNEL ==================
+SELECT_FUNNEL_SQL = """
+    SELECT bucket, started, paid, signed
+    FROM funnel_buckets
+    WHERE granularity=?
+    ORDER BY bucket DESC
+    LIMIT ?
+"""
+
+
+@timed_db
+async def get_funnel(granularity: str = "day", limit: int = 14):
+    """
+    Started -> paid -> signed counts for the most recent `limit` hour or
+    day buckets (bucket = unix time of the bucket start, UTC), newest first.
+    """
+    try:
+        rows = await _fetchall(SELECT_FUNNEL_SQL, (granularity, limit))
+        return [
+            {
+                "bucket": row[0],
+                "started": row[1],
+                "paid": row[2],
+                "signed": row[3]
+            }
+            for row in rows
+        ]
+    except Exception as e:
+        logger.error("❌ Error getting funnel: %s", e)
+        return []
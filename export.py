@@ -0,0 +1,72 @@
+import csv
+import datetime
+import io
+import json
+import zlib
+
+from database import EXPORT_COLUMNS, iter_export_rows
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson"
+}
+
+
+def export_filename(table: str, fmt: str) -> str:
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+    return f"{table}-{stamp}.{fmt}.gz"
+
+
+def _csv_text(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def _jsonl_text(columns, rows) -> str:
+    return "".join(
+        json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+    )
+
+
+# ================== STREAMING EXPORT ==================
+async def export_chunks(table: str, fmt: str, batch_size: int = 1000):
+    """
+    Yield `table` as gzip-compressed CSV (with a header row) or JSONL,
+    one compressed chunk per batch of rows. Memory use depends on the
+    batch size, not the table size.
+    """
+    columns = EXPORT_COLUMNS[table]
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    if fmt == "csv":
+        yield gzip.compress(_csv_text([columns]).encode())
+
+    batches = iter_export_rows(table, batch_size)
+    try:
+        async for rows in batches:
+            text = _csv_text(rows) if fmt == "csv" else _jsonl_text(columns, rows)
+            chunk = gzip.compress(text.encode())
+            if chunk:
+                yield chunk
+    finally:
+        await batches.aclose()
+
+    yield gzip.flush()
+
+
+async def write_export(path: str, table: str, fmt: str) -> int:
+    """
+    Stream an export into the file at `path`. Returns its size in bytes.
+    """
+    size = 0
+    chunks = export_chunks(table, fmt)
+    try:
+        with open(path, "wb") as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+    finally:
+        await chunks.aclose()
+    return size
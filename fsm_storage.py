@@ -0,0 +1,66 @@
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database import get_fsm_records, set_fsm_data, set_fsm_state
+
+logger = logging.getLogger(__name__)
+
+
+# ================== SQLITE STORAGE ==================
+class SqliteStorage(BaseStorage):
+    """
+    FSM storage in the fsm_states table, so states survive restarts and
+    are shared by every process using the same database. Reads are
+    served from the per-user cache in database.py.
+    """
+
+    async def _record(self, key: StorageKey) -> dict:
+        records = await get_fsm_records(key.user_id) or {}
+        return records.get((key.bot_id, key.chat_id, key.destiny)) or {"state": None, "data": {}}
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        await set_fsm_state(
+            key.bot_id, key.chat_id, key.user_id, key.destiny,
+            state.state if isinstance(state, State) else state
+        )
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))["state"]
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        await set_fsm_data(key.bot_id, key.chat_id, key.user_id, key.destiny, data)
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._record(key))["data"])
+
+    async def close(self) -> None:
+        # The connections belong to database.py and close with close_db()
+        pass
+
+
+# ================== FACTORY ==================
+def get_fsm_storage() -> BaseStorage:
+    """
+    FSM_STORAGE selects the backend: "sqlite" (default), "memory" (lost on
+    restart and private to one process) or "redis", which talks to any
+    Redis-protocol server at FSM_REDIS_URL - a local redis-server or
+    compatible stand-in in development (requires the redis package).
+    """
+    backend = os.getenv("FSM_STORAGE", "sqlite")
+    if backend == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis requires the redis package") from e
+        return RedisStorage.from_url(os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "memory":
+        if int(os.getenv("WORKERS", 1)) > 1:
+            logger.warning("⚠️ FSM_STORAGE=memory is not shared between worker processes")
+        return MemoryStorage()
+    return SqliteStorage()
@@ -0,0 +1,166 @@
+import bisect
+import functools
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Seconds; covers a cached lookup (~100µs) up to a slow Telegram call
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+REGISTRY = []
+
+
+def _label_text(labels: tuple, extra: str = None) -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# ================== METRIC TYPES ==================
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_label_text(labels)} {value}"
+
+
+class Gauge:
+    """
+    Read at scrape time from `func`, e.g. a queue depth.
+    """
+
+    def __init__(self, name: str, help: str, func):
+        self.name = name
+        self.help = help
+        self.func = func
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.func()}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_label_text(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_label_text(labels)} {series[-1]}"
+            yield f"{self.name}_count{_label_text(labels)} {cumulative}"
+
+
+def render() -> str:
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# ================== INSTRUMENTS ==================
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Time spent in bot and webhook handlers"
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Handler calls that raised"
+)
+DB_LATENCY = Histogram(
+    "bot_db_duration_seconds", "Time spent in database functions"
+)
+DB_ERRORS = Counter(
+    "bot_db_errors_total", "Database function calls that raised"
+)
+TELEGRAM_LATENCY = Histogram(
+    "bot_telegram_request_duration_seconds", "Telegram Bot API request latency"
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_request_errors_total", "Telegram Bot API requests that failed"
+)
+WEBHOOK_REJECTED = Counter(
+    "bot_webhook_rejected_total", "Korapay webhook requests rejected before processing"
+)
+
+
+def timed(histogram: Histogram, errors: Counter = None, **labels):
+    """
+    Decorator recording the duration of an async function (and raised
+    exceptions in `errors`) under `labels`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def timed_handler(func):
+    return timed(HANDLER_LATENCY, HANDLER_ERRORS, handler=func.__name__)(func)
+
+
+def timed_db(func):
+    return timed(DB_LATENCY, DB_ERRORS, function=func.__name__)(func)
+
+
+class TelegramApiMetrics(BaseRequestMiddleware):
+    """
+    Bot session middleware timing every Bot API call by method name.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method=name)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=name)
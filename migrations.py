@@ -0,0 +1,452 @@
+"""
+Versioned schema migrations, applied in order at startup by init_db().
+
+Each migration runs in its own transaction and records its version in
+schema_migrations, so applying them again is a no-op. Keep migrations
+additive (new tables, columns and indexes) so an instance still running
+the previous release keeps working while a new one migrates the file.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+MIGRATIONS = [
+    (1, "create base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS pending_payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT,
+            payment_reference TEXT UNIQUE,
+            korapay_reference TEXT,
+            status TEXT DEFAULT 'pending',
+            date_created TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS verified_users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            payment_reference TEXT,
+            korapay_reference TEXT,
+            payment_status TEXT DEFAULT 'pending',
+            date_payment_verified TEXT,
+            agreement_signed INTEGER DEFAULT 0,
+            date_agreement_signed TEXT
+        )
+        """,
+    ]),
+
+    # Unix-epoch integer timestamps replace the local-time ISO strings.
+    # The old TEXT columns stay in place (no longer written) so the
+    # previous release can still read them during a rolling restart.
+    (2, "integer timestamps", [
+        "ALTER TABLE pending_payments ADD COLUMN created_at INTEGER",
+        "ALTER TABLE verified_users ADD COLUMN payment_verified_at INTEGER",
+        "ALTER TABLE verified_users ADD COLUMN agreement_signed_at INTEGER",
+        """
+        UPDATE pending_payments
+        SET created_at = CAST(strftime('%s', date_created, 'utc') AS INTEGER)
+        WHERE date_created IS NOT NULL
+        """,
+        """
+        UPDATE verified_users
+        SET payment_verified_at = CAST(strftime('%s', date_payment_verified, 'utc') AS INTEGER),
+            agreement_signed_at = CAST(strftime('%s', date_agreement_signed, 'utc') AS INTEGER)
+        """,
+    ]),
+
+    # Covering indexes for the webhook lookups and the pending fallback
+    (3, "lookup indexes", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_pending_korapay_ref
+        ON pending_payments (korapay_reference, telegram_id, username, payment_reference, status)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_pending_status_created
+        ON pending_payments (status, created_at)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_verified_korapay_ref
+        ON verified_users (korapay_reference)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_verified_payment_ref
+        ON verified_users (payment_reference)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_verified_payment_verified_at
+        ON verified_users (payment_verified_at)
+        """,
+    ]),
+
+    # One row per Korapay delivery; the primary key is what makes webhook
+    # processing idempotent across retries and restarts.
+    (4, "webhook event log", [
+        """
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_key TEXT PRIMARY KEY,
+            event TEXT,
+            korapay_reference TEXT,
+            status TEXT DEFAULT 'received',
+            payload TEXT,
+            received_at INTEGER,
+            processed_at INTEGER
+        )
+        """,
+    ]),
+
+    # webhook_events doubles as the durable processing queue: rows in
+    # 'received' or 'retry' are picked up again after a restart.
+    (5, "webhook event retries", [
+        "ALTER TABLE webhook_events ADD COLUMN attempts INTEGER DEFAULT 0",
+        "ALTER TABLE webhook_events ADD COLUMN next_attempt_at INTEGER",
+        "ALTER TABLE webhook_events ADD COLUMN last_error TEXT",
+        """
+        CREATE INDEX IF NOT EXISTS idx_webhook_events_status
+        ON webhook_events (status)
+        """,
+    ]),
+
+    (6, "unmatched payments", [
+        """
+        CREATE TABLE IF NOT EXISTS unmatched_payments (
+            korapay_reference TEXT PRIMARY KEY,
+            amount REAL,
+            payload TEXT,
+            received_at INTEGER,
+            resolved_at INTEGER,
+            telegram_id INTEGER
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_unmatched_open
+        ON unmatched_payments (resolved_at, received_at)
+        """,
+    ]),
+
+    # Broadcast progress is checkpointed here so a restart resumes it
+    (7, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            last_telegram_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at INTEGER,
+            finished_at INTEGER
+        )
+        """,
+    ]),
+
+    # Keyset pagination for /users: (payment_verified_at, telegram_id) is a
+    # unique, totally ordered key, optionally prefixed by the signed filter.
+    (8, "verified users keyset indexes", [
+        "UPDATE verified_users SET payment_verified_at=0 WHERE payment_verified_at IS NULL",
+        """
+        CREATE INDEX IF NOT EXISTS idx_verified_keyset
+        ON verified_users (payment_verified_at, telegram_id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_verified_signed_keyset
+        ON verified_users (agreement_signed, payment_verified_at, telegram_id)
+        """,
+        "DROP INDEX IF EXISTS idx_verified_payment_verified_at",
+    ]),
+
+    # /stats counters and the started -> paid -> signed funnel, kept in
+    # sync by triggers so every write path (webhook, /resolve, jobs) is
+    # covered. The counters are seeded from the current data.
+    (9, "stats counters and funnel", [
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS funnel_buckets (
+            granularity TEXT,
+            bucket INTEGER,
+            started INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            signed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket)
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+            ('pending_payments', (SELECT COUNT(*) FROM pending_payments WHERE status='pending')),
+            ('paid_users', (SELECT COUNT(*) FROM verified_users WHERE payment_status='paid')),
+            ('signed_agreements', (SELECT COUNT(*) FROM verified_users WHERE agreement_signed=1))
+        """,
+        """
+        INSERT OR REPLACE INTO funnel_buckets (granularity, bucket, started, paid, signed)
+        SELECT granularity, bucket, SUM(started), SUM(paid), SUM(signed) FROM (
+            SELECT g.name AS granularity, COALESCE(p.created_at, 0) / g.size * g.size AS bucket,
+                   1 AS started, 0 AS paid, 0 AS signed
+            FROM pending_payments p, (SELECT 'hour' AS name, 3600 AS size
+                                      UNION ALL SELECT 'day', 86400) g
+            UNION ALL
+            SELECT g.name, COALESCE(v.payment_verified_at, 0) / g.size * g.size, 0, 1, 0
+            FROM verified_users v, (SELECT 'hour' AS name, 3600 AS size
+                                    UNION ALL SELECT 'day', 86400) g
+            WHERE v.payment_status='paid'
+            UNION ALL
+            SELECT g.name, COALESCE(v.agreement_signed_at, 0) / g.size * g.size, 0, 0, 1
+            FROM verified_users v, (SELECT 'hour' AS name, 3600 AS size
+                                    UNION ALL SELECT 'day', 86400) g
+            WHERE v.agreement_signed=1
+        )
+        GROUP BY granularity, bucket
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pending_insert
+        AFTER INSERT ON pending_payments
+        BEGIN
+            UPDATE stats_counters SET value = value + (NEW.status = 'pending')
+            WHERE name = 'pending_payments';
+            INSERT INTO funnel_buckets (granularity, bucket, started)
+            VALUES ('hour', COALESCE(NEW.created_at, 0) / 3600 * 3600, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET started = started + 1;
+            INSERT INTO funnel_buckets (granularity, bucket, started)
+            VALUES ('day', COALESCE(NEW.created_at, 0) / 86400 * 86400, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET started = started + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pending_status
+        AFTER UPDATE OF status ON pending_payments
+        WHEN (OLD.status = 'pending') != (NEW.status = 'pending')
+        BEGIN
+            UPDATE stats_counters
+            SET value = value + CASE WHEN NEW.status = 'pending' THEN 1 ELSE -1 END
+            WHERE name = 'pending_payments';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pending_delete
+        AFTER DELETE ON pending_payments
+        WHEN OLD.status = 'pending'
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'pending_payments';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_verified_insert
+        AFTER INSERT ON verified_users
+        WHEN NEW.payment_status = 'paid'
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'paid_users';
+            INSERT INTO funnel_buckets (granularity, bucket, paid)
+            VALUES ('hour', COALESCE(NEW.payment_verified_at, 0) / 3600 * 3600, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET paid = paid + 1;
+            INSERT INTO funnel_buckets (granularity, bucket, paid)
+            VALUES ('day', COALESCE(NEW.payment_verified_at, 0) / 86400 * 86400, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET paid = paid + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_verified_paid
+        AFTER UPDATE OF payment_status ON verified_users
+        WHEN OLD.payment_status IS NOT 'paid' AND NEW.payment_status = 'paid'
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'paid_users';
+            INSERT INTO funnel_buckets (granularity, bucket, paid)
+            VALUES ('hour', COALESCE(NEW.payment_verified_at, 0) / 3600 * 3600, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET paid = paid + 1;
+            INSERT INTO funnel_buckets (granularity, bucket, paid)
+            VALUES ('day', COALESCE(NEW.payment_verified_at, 0) / 86400 * 86400, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET paid = paid + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_verified_signed
+        AFTER UPDATE OF agreement_signed ON verified_users
+        WHEN OLD.agreement_signed = 0 AND NEW.agreement_signed = 1
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'signed_agreements';
+            INSERT INTO funnel_buckets (granularity, bucket, signed)
+            VALUES ('hour', COALESCE(NEW.agreement_signed_at, 0) / 3600 * 3600, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET signed = signed + 1;
+            INSERT INTO funnel_buckets (granularity, bucket, signed)
+            VALUES ('day', COALESCE(NEW.agreement_signed_at, 0) / 86400 * 86400, 1)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET signed = signed + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_verified_delete
+        AFTER DELETE ON verified_users
+        BEGIN
+            UPDATE stats_counters SET value = value - (OLD.payment_status = 'paid')
+            WHERE name = 'paid_users';
+            UPDATE stats_counters SET value = value - (OLD.agreement_signed = 1)
+            WHERE name = 'signed_agreements';
+        END
+        """,
+    ]),
+
+    # Index from user to the content-addressed agreement blobs they sent
+    (10, "agreement documents", [
+        """
+        CREATE TABLE IF NOT EXISTS agreement_documents (
+            telegram_id INTEGER,
+            version INTEGER,
+            sha256 TEXT NOT NULL,
+            size INTEGER,
+            storage_key TEXT,
+            file_unique_id TEXT,
+            uploaded_at INTEGER,
+            PRIMARY KEY (telegram_id, version)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_agreement_documents_sha256
+        ON agreement_documents (sha256)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_agreement_documents_file
+        ON agreement_documents (telegram_id, file_unique_id)
+        """,
+    ]),
+
+    # Outcome of the structural PDF check for every downloaded upload
+    (11, "agreement validations", [
+        """
+        CREATE TABLE IF NOT EXISTS agreement_validations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            file_unique_id TEXT,
+            sha256 TEXT,
+            size INTEGER,
+            valid INTEGER,
+            reason TEXT,
+            pdf_version TEXT,
+            page_count INTEGER,
+            encrypted INTEGER,
+            checked_at INTEGER
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_agreement_validations_user
+        ON agreement_validations (telegram_id, checked_at)
+        """,
+    ]),
+
+    # Several processes sharing this file: leases for leader election and
+    # instance liveness, an owner per queued webhook event so orphans of a
+    # dead instance can be adopted, and a log of user changes so every
+    # process can drop stale entries from its in-memory user cache.
+    (12, "cluster coordination", [
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            created_at INTEGER
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created
+        ON cache_invalidations (created_at)
+        """,
+        "ALTER TABLE webhook_events ADD COLUMN owner TEXT",
+    ]),
+
+    # aiogram FSM records for fsm_storage.SqliteStorage, one per (bot,
+    # chat, user, destiny), so a user's onboarding state survives restarts
+    # and is shared by every process. Indexed by user_id because reads,
+    # writes and cache invalidations all work on one user's records.
+    (13, "fsm states", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id INTEGER,
+            chat_id INTEGER,
+            user_id INTEGER,
+            destiny TEXT,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (bot_id, chat_id, user_id, destiny)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_fsm_states_user
+        ON fsm_states (user_id)
+        """,
+    ]),
+
+    # Unpaid /start references past PENDING_TTL_DAYS move here, out of the
+    # hot table; a late payment against one restores it
+    (14, "pending payments archive", [
+        """
+        CREATE TABLE IF NOT EXISTS pending_payments_archive (
+            payment_reference TEXT PRIMARY KEY,
+            telegram_id INTEGER,
+            username TEXT,
+            created_at INTEGER,
+            expired_at INTEGER
+        ) WITHOUT ROWID
+        """,
+    ]),
+
+    # The instance sending a broadcast, so a new leader only resumes
+    # broadcasts whose sender is gone
+    (15, "broadcast owners", [
+        "ALTER TABLE broadcasts ADD COLUMN owner TEXT",
+    ]),
+]
+
+
+async def apply_migrations(conn):
+    """
+    Bring the schema up to the latest version. Returns the versions applied.
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at INTEGER
+        )
+    """)
+    await conn.commit()
+
+    applied = []
+    for version, name, statements in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock before the version check,
+        # so two processes starting together can't both apply a migration.
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            async with conn.execute(
+                "SELECT 1 FROM schema_migrations WHERE version=?", (version,)
+            ) as c:
+                if await c.fetchone():
+                    await conn.rollback()
+                    continue
+
+            for sql in statements:
+                await conn.execute(sql)
+
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, int(time.time()))
+            )
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+        applied.append(version)
+        logger.info("✅ Migration applied - %s: %s", version, name)
+
+    return applied
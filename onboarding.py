@@ -0,0 +1,65 @@
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State, StatesGroup
+
+from cache import TTLCache
+from database import get_pending_payment_by_telegram_id, get_user_by_telegram_id
+
+logger = logging.getLogger(__name__)
+
+
+# ================== STATES ==================
+class Onboarding(StatesGroup):
+    # /start issued a payment reference
+    started = State()
+    # Payment confirmed, agreement instructions not delivered yet
+    paid = State()
+    # Told to upload the signed agreement
+    awaiting_agreement = State()
+    # Agreement on file
+    activated = State()
+
+
+# States in which an agreement upload is accepted
+PAID_STATES = (Onboarding.paid, Onboarding.awaiting_agreement, Onboarding.activated)
+
+
+async def restore_state(telegram_id: int):
+    """
+    Work out a user's onboarding state from their database rows.
+    """
+    user = await get_user_by_telegram_id(telegram_id)
+    if user and user["payment_status"] == "paid":
+        return Onboarding.activated if user["agreement_signed"] else Onboarding.awaiting_agreement
+    if await get_pending_payment_by_telegram_id(telegram_id):
+        return Onboarding.started
+    return None
+
+
+# ================== MIDDLEWARE ==================
+class OnboardingStateMiddleware(BaseMiddleware):
+    """
+    Message outer middleware giving users who have no FSM state yet (they
+    started before the FSM existed, or the storage was reset) the state
+    their database rows imply, before handler filters look at it.
+    Users with nothing to restore are remembered for `ttl` seconds, so
+    their messages don't repeat the lookup.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.nothing_to_restore = TTLCache(maxsize, ttl)
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is not None and data.get("raw_state") is None:
+            user_id = state.key.user_id
+            if not self.nothing_to_restore.get(user_id):
+                restored = await restore_state(user_id)
+                if restored:
+                    await state.set_state(restored)
+                    data["raw_state"] = restored.state
+                    logger.debug("🧭 Restored state %s for user %s", restored.state, user_id)
+                else:
+                    self.nothing_to_restore.set(user_id, True)
+        return await handler(event, data)
@@ -0,0 +1,151 @@
+import hashlib
+import hmac
+import json
+import re
+import time
+
+from database import (
+    get_user_by_korapay_reference,
+    get_user_by_reference,
+    get_user_by_telegram_id,
+    get_pending_payment_by_telegram_id,
+    restore_pending_payment
+)
+
+# Price of the Trading Support Service in Naira
+PAYMENT_AMOUNT = 20000
+
+REFERENCE_PREFIX = "MBG"
+REFERENCE_PATTERN = re.compile(rf"^{REFERENCE_PREFIX}-(\d+)-(\d+)$")
+
+
+# ================== PAYMENT REFERENCES ==================
+def build_payment_reference(telegram_id: int) -> str:
+    return f"{REFERENCE_PREFIX}-{telegram_id}-{int(time.time())}"
+
+
+def parse_payment_reference(reference: str):
+    """
+    Return the Telegram ID encoded in an MBG-{telegram_id}-{timestamp}
+    reference, or None if it isn't one of ours.
+    """
+    match = REFERENCE_PATTERN.match(reference or "")
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def reference_candidates(data: dict):
+    """
+    References in a Korapay charge payload that may be the one we issued,
+    including those echoed back in the metadata.
+    """
+    metadata = data.get("metadata") or {}
+    candidates = [
+        data.get("reference"),
+        data.get("payment_reference"),
+        metadata.get("reference"),
+        metadata.get("payment_reference"),
+    ]
+    seen = []
+    for reference in candidates:
+        if reference and reference not in seen:
+            seen.append(reference)
+    return seen
+
+
+def webhook_event_key(event: str, data: dict) -> str:
+    """
+    Deduplication key for a Korapay event: the first reference in the
+    payload, or a hash of the whole payload if it carries none.
+    """
+    references = reference_candidates(data)
+    if references:
+        return f"{event}:{references[0]}"
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return f"{event}:sha256:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+
+# ================== PAYMENT MATCHING ==================
+async def match_payment(data: dict):
+    """
+    Find the user a Korapay charge belongs to using only exact, indexed
+    lookups. Returns None if there is no deterministic match; callers
+    should queue the payment as unmatched rather than guess.
+    """
+    korapay_reference = data.get("reference") or data.get("payment_reference")
+
+    # Already linked (e.g. a retried delivery)
+    user = await get_user_by_korapay_reference(korapay_reference)
+    if user:
+        return user
+
+    # The reference we issued in /start
+    candidates = reference_candidates(data)
+    for reference in candidates:
+        user = await get_user_by_reference(reference)
+        if user:
+            return user
+
+    # A reference of ours that has since been replaced by a newer /start
+    # still names its user
+    metadata = data.get("metadata") or {}
+    telegram_ids = [parse_payment_reference(reference) for reference in candidates]
+    if str(metadata.get("telegram_id", "")).isdigit():
+        telegram_ids.append(int(metadata["telegram_id"]))
+
+    for telegram_id in telegram_ids:
+        if not telegram_id:
+            continue
+        user = (await get_pending_payment_by_telegram_id(telegram_id)
+                or await get_user_by_telegram_id(telegram_id))
+        if user:
+            return user
+
+    # A reference of ours that expired before the payment arrived
+    for reference in candidates:
+        if parse_payment_reference(reference):
+            user = await restore_pending_payment(reference)
+            if user:
+                return user
+
+    return None
+
+
+# ================== WEBHOOK SIGNATURES ==================
+def _js_number(text: str):
+    # JSON.stringify writes 20000.0 as 20000; keep whole numbers as ints
+    # so they're re-encoded the way Korapay signed them
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+def parse_webhook_body(raw):
+    """
+    json.loads for Korapay webhook bodies, keeping numbers in the form
+    SignatureVerifier.sign must reproduce.
+    """
+    return json.loads(raw, parse_float=_js_number)
+
+
+class SignatureVerifier:
+    """
+    Checks Korapay's x-korapay-signature header: a hex HMAC-SHA256 of the
+    JSON-encoded `data` object, keyed with the secret key.
+    """
+
+    def __init__(self, secret_key: str):
+        # Keyed once; each check copies this state instead of hashing
+        # the padded key again
+        self._mac = hmac.new(secret_key.encode(), digestmod=hashlib.sha256)
+
+    def sign(self, data: dict) -> str:
+        mac = self._mac.copy()
+        # JSON.stringify's output for payloads parsed by parse_webhook_body
+        # (compact separators, raw Unicode, whole numbers without ".0")
+        mac.update(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode())
+        return mac.hexdigest()
+
+    def verify(self, data: dict, signature: str) -> bool:
+        return hmac.compare_digest(self.sign(data).encode(), (signature or "").encode())
+
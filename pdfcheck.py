@@ -0,0 +1,114 @@
+import asyncio
+import mmap
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Readers accept the header anywhere in the first 1 KB and the
+# end-of-file marker anywhere in the last 1 KB, so we do the same.
+HEADER_WINDOW = 1024
+TRAILER_WINDOW = 1024
+# Cap on inflated object-stream bytes, so a compression bomb can't exhaust memory
+MAX_INFLATED_BYTES = 16 * 1024 * 1024
+
+HEADER_RE = re.compile(rb"%PDF-(\d\.\d)")
+STARTXREF_RE = re.compile(rb"startxref\s+(\d+)\s+%%EOF")
+PAGE_RE = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+ENCRYPT_RE = re.compile(rb"/Encrypt\s*(?:\d+\s+\d+\s+R|<<)")
+OBJSTM_RE = re.compile(rb"<<[^<>]*/Type\s*/ObjStm[^<>]*>>\s*stream\r?\n")
+
+REJECTION_REASONS = {
+    "empty": "The file is empty.",
+    "not_pdf": "The file is not a PDF document.",
+    "truncated": "The PDF is incomplete or damaged.",
+    "encrypted": "The PDF is password-protected.",
+    "no_pages": "The PDF has no pages."
+}
+
+
+# ================== STRUCTURAL CHECK ==================
+def validate_pdf(path: str) -> dict:
+    """
+    Structural check of the PDF at `path`: header magic, trailer, page
+    count and encryption. CPU-bound, so run it through PdfValidator.
+    Returns {"valid", "reason", "pdf_version", "page_count", "encrypted"}.
+    """
+    result = {
+        "valid": False,
+        "reason": None,
+        "pdf_version": None,
+        "page_count": None,
+        "encrypted": False
+    }
+
+    if os.path.getsize(path) == 0:
+        result["reason"] = "empty"
+        return result
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header = HEADER_RE.search(data, 0, HEADER_WINDOW)
+        if not header:
+            result["reason"] = "not_pdf"
+            return result
+        result["pdf_version"] = header.group(1).decode()
+
+        tail_start = max(0, len(data) - TRAILER_WINDOW)
+        startxref = STARTXREF_RE.search(data, tail_start)
+        if not startxref or int(startxref.group(1)) >= len(data):
+            result["reason"] = "truncated"
+            return result
+
+        if ENCRYPT_RE.search(data):
+            result["encrypted"] = True
+            result["reason"] = "encrypted"
+            return result
+
+        pages = sum(1 for _ in PAGE_RE.finditer(data))
+        if not pages:
+            # PDF 1.5+ writers usually put page objects in compressed object streams
+            pages = _count_compressed_pages(data)
+        if not pages:
+            result["reason"] = "no_pages"
+            return result
+        result["page_count"] = pages
+
+    result["valid"] = True
+    return result
+
+
+def _count_compressed_pages(data) -> int:
+    pages = 0
+    for stream in OBJSTM_RE.finditer(data):
+        if b"/FlateDecode" not in stream.group(0):
+            continue
+        end = data.find(b"endstream", stream.end())
+        try:
+            inflated = zlib.decompressobj().decompress(
+                data[stream.end():end], MAX_INFLATED_BYTES
+            )
+        except zlib.error:
+            continue
+        pages += sum(1 for _ in PAGE_RE.finditer(inflated))
+    return pages
+
+
+# ================== VALIDATOR POOL ==================
+class PdfValidator:
+    """
+    Runs validate_pdf in a process (default) or thread pool so parsing
+    large uploads never blocks the event loop.
+    """
+
+    def __init__(self, mode: str = "process", workers: int = 2):
+        if mode == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    async def validate(self, path: str) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, validate_pdf, path)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
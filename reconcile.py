@@ -0,0 +1,279 @@
+"""
+Reconcile pending payments against a Korapay transactions export.
+
+Successful transactions in the export are joined against unpaid
+pending_payments rows by reference. Matches are marked paid in batched
+transactions, and every transaction's outcome is written to a CSV diff
+report.
+
+    python reconcile.py transactions.csv --report report.csv [--dry-run]
+
+The bot runs the same job on files dropped into RECONCILE_INBOX.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+
+from dotenv import load_dotenv
+
+from database import (
+    init_db,
+    close_db,
+    add_unmatched_payment,
+    iter_paid_references,
+    iter_unpaid_pending_payments,
+    mark_payments_paid,
+    restore_pending_payment
+)
+from logs import setup_logging
+from payments import PAYMENT_AMOUNT, parse_payment_reference
+
+logger = logging.getLogger(__name__)
+
+SETTLEMENT_SUFFIXES = (".csv", ".json", ".jsonl")
+SUCCESS_STATUSES = {"success", "successful", "paid", "completed"}
+
+# Column / key names used by Korapay exports for the fields we need
+FIELD_ALIASES = {
+    "reference": ("reference", "transaction_reference", "korapay_reference"),
+    "payment_reference": ("payment_reference", "merchant_reference"),
+    "amount": ("amount", "amount_paid"),
+    "status": ("status", "transaction_status"),
+}
+
+# A currency code or sign may lead or trail the number
+CURRENCY_RE = re.compile(r"^(?:[A-Za-z]{3}|₦)\s*|\s*[A-Za-z]{3}$")
+AMOUNT_RE = re.compile(r"-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?")
+
+REPORT_COLUMNS = ("outcome", "korapay_reference", "payment_reference", "telegram_id", "amount", "status")
+
+
+# ================== SETTLEMENT FILE ==================
+def _iter_json_values(f, chunk_size: int = 65536):
+    """
+    Yield the values of a JSON array, or of JSON Lines, reading the file
+    a chunk at a time.
+    """
+    decoder = json.JSONDecoder()
+    buffer, eof = "", False
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,[]")
+        if not buffer:
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield value
+
+
+def _normalize(record: dict) -> dict:
+    fields = {str(key).strip().lower().replace(" ", "_"): value for key, value in record.items()}
+    normalized = {}
+    for field, aliases in FIELD_ALIASES.items():
+        normalized[field] = next(
+            (fields[alias] for alias in aliases if fields.get(alias) not in (None, "")), None
+        )
+    return normalized
+
+
+def parse_amount(value) -> float:
+    """
+    20000, "20000.00", "20,000.00", "₦20,000" or "NGN 20,000.00" -> 20000.0.
+    Raises ValueError for anything else.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = CURRENCY_RE.sub("", str(value or "").strip())
+    if not AMOUNT_RE.fullmatch(text):
+        raise ValueError(f"unparseable amount: {value!r}")
+    return float(text.replace(",", ""))
+
+
+def iter_settlement_records(path: str):
+    """
+    Stream transactions from a Korapay export (CSV, JSON array, JSON Lines,
+    or a {"data": [...]} document), normalized to the FIELD_ALIASES keys.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield _normalize(row)
+            return
+
+        for value in _iter_json_values(f):
+            records = value["data"] if isinstance(value, dict) and isinstance(value.get("data"), list) else [value]
+            for record in records:
+                if isinstance(record, dict):
+                    yield _normalize(record)
+
+
+# ================== RECONCILER ==================
+class Reconciler:
+    """
+    Joins settlement records against an in-memory index of unpaid pending
+    payments. `on_paid(telegram_id)` runs for every user marked paid.
+    """
+
+    def __init__(self, batch_size: int = 500, dry_run: bool = False, on_paid=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.on_paid = on_paid
+
+    async def _load_index(self):
+        # payment_reference -> telegram_id, and the reverse for references
+        # that were replaced by a later /start
+        self.pending = {}
+        self.pending_by_user = {}
+        async for rows in iter_unpaid_pending_payments():
+            for telegram_id, payment_reference in rows:
+                self.pending[payment_reference] = telegram_id
+                self.pending_by_user[telegram_id] = payment_reference
+
+        self.paid = set()
+        async for rows in iter_paid_references():
+            for korapay_reference, payment_reference in rows:
+                self.paid.update(ref for ref in (korapay_reference, payment_reference) if ref)
+
+    def _match(self, record: dict):
+        for reference in (record["payment_reference"], record["reference"]):
+            if reference in self.pending:
+                return self.pending[reference]
+        for reference in (record["payment_reference"], record["reference"]):
+            telegram_id = parse_payment_reference(reference)
+            if telegram_id in self.pending_by_user:
+                return telegram_id
+        return None
+
+    def _outcome(self, record: dict):
+        """
+        Returns (outcome, telegram_id) for one settlement record.
+        """
+        if str(record["status"] or "").lower() not in SUCCESS_STATUSES:
+            return "skipped", None
+        try:
+            amount = parse_amount(record["amount"])
+        except ValueError as e:
+            # A successful payment we can't read needs a human, not a skip
+            logger.warning("⚠️ Transaction %s: %s", record["reference"], e)
+            return "error", None
+        if amount < PAYMENT_AMOUNT:
+            return "skipped", None
+        if record["reference"] in self.paid or record["payment_reference"] in self.paid:
+            return "already_paid", None
+
+        telegram_id = self._match(record)
+        if telegram_id is None:
+            return "unmatched", None
+
+        # Claimed: later records for this payment count as already paid
+        del self.pending[self.pending_by_user.pop(telegram_id)]
+        self.paid.update(ref for ref in (record["reference"], record["payment_reference"]) if ref)
+        return "marked_paid", telegram_id
+
+    async def _restore(self, record: dict):
+        """
+        Match a payment whose reference expired out of pending_payments.
+        """
+        reference = record["payment_reference"]
+        if parse_payment_reference(reference):
+            user = await restore_pending_payment(reference)
+            if user:
+                self.paid.update(ref for ref in (record["reference"], reference) if ref)
+                return "marked_paid", user["telegram_id"]
+        return "unmatched", None
+
+    async def _apply(self, batch):
+        if self.dry_run or not batch:
+            return
+        marked = await mark_payments_paid(batch)
+        if self.on_paid:
+            results = await asyncio.gather(
+                *(self.on_paid(telegram_id) for telegram_id in marked), return_exceptions=True
+            )
+            for telegram_id, result in zip(marked, results):
+                if isinstance(result, Exception):
+                    logger.error("❌ Post-reconcile hook failed for user %s: %s", telegram_id, result)
+
+    async def run(self, source: str, report: str) -> dict:
+        """
+        Reconcile the export at `source`, writing the diff report to
+        `report`. Returns the count of records per outcome, plus
+        "still_pending" for unpaid pending payments the export didn't cover.
+        """
+        await self._load_index()
+        summary = {"marked_paid": 0, "already_paid": 0, "unmatched": 0, "skipped": 0, "error": 0}
+        batch = []
+
+        with open(report, "w", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(REPORT_COLUMNS)
+
+            for count, record in enumerate(iter_settlement_records(source), 1):
+                outcome, telegram_id = self._outcome(record)
+                if outcome == "unmatched" and not self.dry_run:
+                    outcome, telegram_id = await self._restore(record)
+                summary[outcome] += 1
+                writer.writerow((
+                    outcome, record["reference"], record["payment_reference"],
+                    telegram_id, record["amount"], record["status"]
+                ))
+
+                if outcome == "marked_paid":
+                    batch.append((record["reference"], telegram_id))
+                elif outcome == "unmatched" and record["reference"] and not self.dry_run:
+                    await add_unmatched_payment(
+                        record["reference"], parse_amount(record["amount"]), json.dumps(record)
+                    )
+
+                if len(batch) >= self.batch_size:
+                    await self._apply(batch)
+                    batch = []
+                elif count % self.batch_size == 0:
+                    # Let other tasks run while a large file is read
+                    await asyncio.sleep(0)
+
+            await self._apply(batch)
+
+        summary["still_pending"] = len(self.pending)
+        logger.info("🧾 Reconciled %s: %s", os.path.basename(source), summary)
+        return summary
+
+
+# ================== CLI ==================
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("source", help="Korapay transactions export (.csv, .json or .jsonl)")
+    parser.add_argument("--report", default="reconcile-report.csv")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="write the report without changing anything")
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text"))
+
+    await init_db()
+    try:
+        summary = await Reconciler(args.batch_size, args.dry_run).run(args.source, args.report)
+    finally:
+        await close_db()
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
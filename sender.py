@@ -0,0 +1,234 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lowest value is sent first
+PRIORITY_PAYMENT = 0
+PRIORITY_USER = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BULK = 3
+
+
+# ================== TOKEN BUCKET ==================
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and time.monotonic() >= self.blocked_until
+
+
+class KeyedRateLimiter:
+    """
+    One TokenBucket per key (e.g. client IP). Idle buckets are dropped
+    once more than `max_keys` are tracked.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, max_keys: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def allow(self, key) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets = {k: v for k, v in self.buckets.items() if not v.idle}
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        if bucket.delay() > 0:
+            return False
+        bucket.consume()
+        return True
+
+
+# ================== SEND SCHEDULER ==================
+class SendScheduler:
+    """
+    Central queue for outbound Telegram calls.
+
+    Calls are ordered by priority lane, then FIFO. A global bucket keeps
+    us under Telegram's overall limit and per-chat buckets under the
+    per-chat one; a call for a throttled chat is parked instead of
+    holding up a worker. TelegramRetryAfter pauses the affected bucket
+    and re-queues the call.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = 30, chat_rate: float = 1,
+                 workers: int = 8, max_retries: int = 3, max_chat_buckets: int = 10000):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.max_chat_buckets = max_chat_buckets
+        self.workers = workers
+        self.max_retries = max_retries
+        self.queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+        self._parked = 0
+
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain: float = 0):
+        """
+        Stop the workers, first giving queued and parked calls up to
+        `drain` seconds to go out.
+        """
+        if drain > 0:
+            try:
+                await asyncio.wait_for(self._drain(), drain)
+            except asyncio.TimeoutError:
+                logger.warning("⚠️ %s Telegram calls dropped at shutdown", self.queue.qsize() + self._parked)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _drain(self):
+        while True:
+            await self.queue.join()
+            if not self._parked:
+                return
+            await asyncio.sleep(0.1)
+
+    def submit(self, method: TelegramMethod, priority: int = PRIORITY_USER) -> asyncio.Future:
+        """
+        Queue a Telegram method call; the returned future resolves to its result.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._put(priority, method, future, 0, time.monotonic())
+        return future
+
+    async def send(self, method: TelegramMethod, priority: int = PRIORITY_USER):
+        return await self.submit(method, priority)
+
+    def _put(self, priority, method, future, attempts, queued_at):
+        self.queue.put_nowait((priority, next(self._seq), method, future, attempts, queued_at))
+
+    def _park(self, delay, item):
+        self._parked += 1
+
+        def release():
+            self._parked -= 1
+            self.queue.put_nowait(item)
+
+        asyncio.get_running_loop().call_later(delay, release)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.idle
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, _, method, future, attempts, queued_at = item
+            try:
+                if future.cancelled():
+                    continue
+
+                chat_bucket = self._chat_bucket(getattr(method, "chat_id", None))
+                delay = chat_bucket.delay()
+                if delay > 0:
+                    self._park(delay, item)
+                    continue
+
+                while (delay := self.global_bucket.delay()) > 0:
+                    await asyncio.sleep(delay)
+                self.global_bucket.consume()
+                chat_bucket.consume()
+
+                await self._call(item, chat_bucket)
+            finally:
+                self.queue.task_done()
+
+    async def _call(self, item, chat_bucket):
+        priority, _, method, future, attempts, queued_at = item
+        try:
+            result = await self.bot(method)
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            chat_bucket.block(e.retry_after)
+            if attempts < self.max_retries:
+                logger.info("⏳ Telegram flood control, retrying in %ss", e.retry_after)
+                self._put(priority, method, future, attempts + 1, queued_at)
+                return
+            self._fail(future, e)
+            return
+        except Exception as e:
+            self._fail(future, e)
+            return
+
+        latency = time.monotonic() - queued_at
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if not future.done():
+            future.set_result(result)
+
+    def _fail(self, future, error):
+        self.failed += 1
+        if not future.done():
+            future.set_exception(error)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() + self._parked,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "avg_latency": self.latency_total / self.sent if self.sent else 0,
+            "max_latency": self.latency_max
+        }
@@ -0,0 +1,185 @@
+import abc
+import asyncio
+import datetime
+import hashlib
+import hmac
+import os
+import shutil
+from urllib.parse import quote, urlparse
+
+import aiohttp
+
+
+# ================== BLOB STORE ==================
+class BlobStore(abc.ABC):
+    """
+    Content-addressed storage for signed agreements. Blobs are keyed by
+    their SHA-256 and sharded two levels deep (ab/cd/abcd...), so storing
+    the same bytes twice is a no-op and no directory grows unbounded.
+    """
+
+    def __init__(self, extension: str = ".pdf"):
+        self.extension = extension
+
+    def key_for(self, sha256: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{self.extension}"
+
+    @abc.abstractmethod
+    async def exists(self, sha256: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def put(self, sha256: str, source_path: str) -> str:
+        """
+        Move the file at `source_path` into the store under its hash.
+        The source is consumed either way. Returns the storage key.
+        """
+
+    @abc.abstractmethod
+    async def fetch(self, sha256: str, destination: str):
+        ...
+
+    async def close(self):
+        pass
+
+
+# ================== LOCAL FILESYSTEM ==================
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str, extension: str = ".pdf"):
+        super().__init__(extension)
+        self.root = root
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, self.key_for(sha256))
+
+    async def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    async def put(self, sha256: str, source_path: str) -> str:
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(source_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source_path, path)
+        return self.key_for(sha256)
+
+    async def fetch(self, sha256: str, destination: str):
+        await asyncio.to_thread(shutil.copyfile, self.path_for(sha256), destination)
+
+
+# ================== S3-COMPATIBLE ==================
+class S3BlobStore(BlobStore):
+    """
+    Minimal S3 client (path-style URLs, SigV4) over aiohttp. Works with AWS
+    S3 and S3-compatible servers such as MinIO, which can stand in locally:
+
+        STORAGE_BACKEND=s3 S3_ENDPOINT=http://localhost:9000 S3_BUCKET=agreements
+    """
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = "us-east-1", extension: str = ".pdf"):
+        super().__init__(extension)
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlparse(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.region = region
+        self._secret_key = secret_key
+        self._session = None
+
+    async def _request(self, method: str, sha256: str, payload_hash: str = "UNSIGNED-PAYLOAD",
+                       data=None):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        path = quote(f"/{self.bucket}/{self.key_for(sha256)}")
+        headers = sign_v4(
+            method, self.host, path, payload_hash,
+            self.access_key, self._secret_key, self.region
+        )
+        return self._session.request(method, self.endpoint + path, headers=headers, data=data)
+
+    async def exists(self, sha256: str) -> bool:
+        async with await self._request("HEAD", sha256) as resp:
+            if resp.status == 404:
+                return False
+            resp.raise_for_status()
+            return True
+
+    async def put(self, sha256: str, source_path: str) -> str:
+        try:
+            if not await self.exists(sha256):
+                with open(source_path, "rb") as f:
+                    # The content hash is the object name, so sign it as the payload hash
+                    async with await self._request("PUT", sha256, sha256, data=f) as resp:
+                        resp.raise_for_status()
+        finally:
+            os.remove(source_path)
+        return self.key_for(sha256)
+
+    async def fetch(self, sha256: str, destination: str):
+        async with await self._request("GET", sha256) as resp:
+            resp.raise_for_status()
+            with open(destination, "wb") as f:
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    f.write(chunk)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+
+def sign_v4(method: str, host: str, path: str, payload_hash: str, access_key: str,
+            secret_key: str, region: str, service: str = "s3", extra_headers: dict = None,
+            now: datetime.datetime = None) -> dict:
+    """
+    AWS Signature Version 4 headers for a request without a query string.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    datestamp = now.strftime("%Y%m%d")
+
+    headers = {
+        "host": host,
+        "x-amz-content-sha256": payload_hash,
+        "x-amz-date": amz_date,
+        **{k.lower(): v for k, v in (extra_headers or {}).items()}
+    }
+    signed_headers = ";".join(sorted(headers))
+    canonical_headers = "".join(f"{k}:{headers[k].strip()}\n" for k in sorted(headers))
+    canonical_request = "\n".join([
+        method, path, "", canonical_headers, signed_headers, payload_hash
+    ])
+
+    scope = f"{datestamp}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope,
+        hashlib.sha256(canonical_request.encode()).hexdigest()
+    ])
+
+    key = f"AWS4{secret_key}".encode()
+    for part in (datestamp, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    del headers["host"]
+    return headers
+
+
+# ================== FACTORY ==================
+def get_blob_store(default_root: str) -> BlobStore:
+    backend = os.getenv("STORAGE_BACKEND", "local")
+    if backend == "s3":
+        return S3BlobStore(
+            endpoint=os.getenv("S3_ENDPOINT", "https://s3.amazonaws.com"),
+            bucket=os.getenv("S3_BUCKET"),
+            access_key=os.getenv("S3_ACCESS_KEY"),
+            secret_key=os.getenv("S3_SECRET_KEY"),
+            region=os.getenv("S3_REGION", "us-east-1")
+        )
+    return LocalBlobStore(os.getenv("STORAGE_ROOT", default_root))
@@ -0,0 +1,62 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# ================== TELEGRAM WEBHOOK HANDLER ==================
+class TelegramWebhookHandler(SimpleRequestHandler):
+    """
+    Feeds Telegram webhook updates into the dispatcher.
+
+    Requests without the secret token configured in setWebhook are
+    rejected before the body is read. Updates are acknowledged right away
+    and processed in background tasks, at most `concurrency` at a time.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str,
+                 concurrency: int = 100, **data):
+        if not secret_token:
+            # Anyone could post updates as any user, the admin included
+            raise ValueError("Telegram webhook mode requires a secret token")
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.secret_token = secret_token
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    def verify_secret(self, request: web.Request) -> bool:
+        received = request.headers.get(SECRET_HEADER, "")
+        return hmac.compare_digest(received.encode(), self.secret_token.encode())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request):
+            logger.warning("⚠️ Rejected Telegram webhook with bad secret from %s", request.remote)
+            return web.Response(text="unauthorized", status=401)
+        return await super().handle(request)
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        async with self._semaphore:
+            try:
+                await super()._background_feed_update(bot=bot, update=update)
+            except Exception as e:
+                logger.error("❌ Error processing Telegram update: %s", e)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        # Keep a strong reference until the task finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().close()
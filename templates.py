@@ -0,0 +1,426 @@
+"""
+User-facing texts and keyboards, rendered once at startup.
+
+Templates use two kinds of placeholders: $name fields (links, limits)
+are filled from the registry's context when it is built, and {name}
+fields are formatted per request. Texts without {name} fields are
+returned as-is, and keyboards whose URLs are fully known at startup are
+built once and shared.
+"""
+import logging
+import re
+from string import Template
+
+from aiogram import BaseMiddleware
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANGUAGE = "en"
+LANGUAGE_NAMES = {
+    "en": "🇬🇧 English",
+    "pcm": "🇳🇬 Pidgin",
+    "yo": "🇳🇬 Yorùbá",
+}
+
+
+# ================== TEXTS ==================
+# Keys missing from a language fall back to English
+TEXTS = {
+    "en": {
+        "welcome": (
+            "👋 *Welcome to MakeBankGuru*\n\n"
+            "To activate your Trading Support Service:\n"
+            "1️⃣ Complete payment\n"
+            "2️⃣ Payment is auto-confirmed\n"
+            "3️⃣ Upload signed agreement\n\n"
+            "No manual verification required."
+        ),
+        "status_unpaid": (
+            "⚠️ *Payment Status: Not Verified*\n\n"
+            "Please complete your payment first.\n"
+            "Use /start to get the payment link."
+        ),
+        "status_activated": (
+            "✅ *Status: Fully Activated*\n\n"
+            "🔗 Register for your Naira Trading Account:\n$naira_trader_link\n\n"
+            "👥 Join our private group:\n$private_group_link"
+        ),
+        "status_awaiting_agreement": (
+            "✅ *Payment: Verified*\n"
+            "⏳ *Agreement: Pending*\n\n"
+            "📋 *Next Step: Upload Signed Agreement*\n\n"
+            "1️⃣ Download the agreement template below\n"
+            "2️⃣ Fill in your details and sign it\n"
+            "3️⃣ Scan/photograph and convert to PDF\n"
+            "4️⃣ Send the PDF file here in this chat\n\n"
+            "⚠️ *Important:* Only PDF files are accepted."
+        ),
+        "help": (
+            "ℹ️ *MakeBankGuru Bot Help*\n\n"
+            "*Available Commands:*\n"
+            "/start - Begin registration & payment\n"
+            "/status - Check your activation status\n"
+            "/language - Change the bot's language\n"
+            "/help - Show this help message\n\n"
+            "*How It Works:*\n"
+            "1️⃣ Use /start to get your payment link\n"
+            "2️⃣ Pay ₦20,000 via the link\n"
+            "3️⃣ Payment is auto-verified\n"
+            "4️⃣ Upload your signed agreement PDF\n"
+            "5️⃣ Get access to Naira Trader & private group\n\n"
+            "*Need Support?*\n"
+            "Contact: @MakeBankGuru"
+        ),
+        "choose_language": "🌐 Choose your language:",
+        "language_set": "✅ Language set to English.",
+        "throttled": "⏳ Too many messages. Please wait {seconds}s and try again.",
+        "agreement_duplicate": (
+            "✅ *Agreement Already Received*\n\n"
+            "We already have this document on file, no need to send it again.\n\n"
+            "🔗 Naira Trading account:\n$naira_trader_link\n\n"
+            "👥 Private group:\n$private_group_link"
+        ),
+        "agreement_not_pdf": (
+            "❌ *Invalid File Format*\n\n"
+            "Only PDF files are accepted.\n\n"
+            "Please convert your agreement to PDF and try again."
+        ),
+        "agreement_too_large": (
+            "❌ *File Too Large*\n\n"
+            "The maximum size is $max_agreement_mb MB.\n\n"
+            "Please compress your PDF and try again."
+        ),
+        "agreement_processing": "⏳ Processing your agreement...",
+        "agreement_invalid": (
+            "❌ *Invalid Agreement File*\n\n"
+            "{reason}\n\n"
+            "Please upload the signed agreement as a normal, "
+            "unprotected PDF and try again."
+        ),
+        "agreement_received": (
+            "✅ *Agreement Received Successfully!*\n\n"
+            "🎉 Your account is now fully activated!\n\n"
+            "📌 *Next Steps:*\n\n"
+            "1️⃣ Register for a  Naira Trading account:\n$naira_trader_link\n\n"
+            "2️⃣ Join our private group:\n$private_group_link\n\n"
+            "Welcome to MakeBankGuru! 🚀"
+        ),
+        "agreement_failed": (
+            "❌ *Failed to Process Agreement*\n\n"
+            "There was an error processing your file.\n"
+            "Please try again or contact support."
+        ),
+        "payment_not_confirmed": (
+            "⚠️ *Payment Not Confirmed*\n\n"
+            "Please complete your payment first before uploading the agreement.\n\n"
+            "Use /start to get your payment link."
+        ),
+        "payment_confirmed": (
+            "✅ *Payment Confirmed Successfully!*\n\n"
+            "📋 *Next Step: Upload Signed Agreement*\n\n"
+            "1️⃣ Download the agreement template below\n"
+            "2️⃣ Fill in your details and sign it\n"
+            "3️⃣ Scan/photograph and convert to PDF\n"
+            "4️⃣ Send the PDF file here in this chat\n\n"
+            "⚠️ *Important:* Only PDF files are accepted."
+        ),
+        "button_pay": "💳 Pay ₦20,000",
+        "button_make_payment": "💳 Make Payment",
+        "button_download_agreement": "📄 Download Agreement Template",
+    },
+    "pcm": {
+        "welcome": (
+            "👋 *Welcome to MakeBankGuru*\n\n"
+            "To start your Trading Support Service:\n"
+            "1️⃣ Pay your money\n"
+            "2️⃣ We go confirm the payment by ourself\n"
+            "3️⃣ Upload the agreement wey you don sign\n\n"
+            "Nobody go need check am by hand."
+        ),
+        "status_unpaid": (
+            "⚠️ *Payment Status: We never see am*\n\n"
+            "Abeg pay first.\n"
+            "Use /start make you collect the payment link."
+        ),
+        "status_activated": (
+            "✅ *Status: Everything don set*\n\n"
+            "🔗 Register your Naira Trading Account:\n$naira_trader_link\n\n"
+            "👥 Join our private group:\n$private_group_link"
+        ),
+        "status_awaiting_agreement": (
+            "✅ *Payment: We don confirm am*\n"
+            "⏳ *Agreement: E never reach us*\n\n"
+            "📋 *Wetin you go do next: Upload the agreement wey you don sign*\n\n"
+            "1️⃣ Download the agreement template for down\n"
+            "2️⃣ Fill your details and sign am\n"
+            "3️⃣ Scan or snap am, then turn am to PDF\n"
+            "4️⃣ Send the PDF file for this chat\n\n"
+            "⚠️ *Note am well:* Na only PDF file we dey collect."
+        ),
+        "help": (
+            "ℹ️ *MakeBankGuru Bot Help*\n\n"
+            "*Commands wey you fit use:*\n"
+            "/start - Register and pay\n"
+            "/status - Check where you reach\n"
+            "/language - Change the bot language\n"
+            "/help - Show this message\n\n"
+            "*How e dey work:*\n"
+            "1️⃣ Use /start collect your payment link\n"
+            "2️⃣ Pay ₦20,000 with the link\n"
+            "3️⃣ We go confirm the payment by ourself\n"
+            "4️⃣ Upload the agreement PDF wey you don sign\n"
+            "5️⃣ Enter Naira Trader and the private group\n\n"
+            "*You need help?*\n"
+            "Message: @MakeBankGuru"
+        ),
+        "choose_language": "🌐 Pick the language wey you want:",
+        "language_set": "✅ We go dey yarn you for Pidgin now.",
+        "throttled": "⏳ You don send too many messages. Abeg wait {seconds}s before you try again.",
+        "agreement_duplicate": (
+            "✅ *We don get your Agreement before*\n\n"
+            "This document don already reach us, you no need send am again.\n\n"
+            "🔗 Naira Trading account:\n$naira_trader_link\n\n"
+            "👥 Private group:\n$private_group_link"
+        ),
+        "agreement_not_pdf": (
+            "❌ *Wrong File Type*\n\n"
+            "Na only PDF file we dey collect.\n\n"
+            "Abeg turn your agreement to PDF come send am again."
+        ),
+        "agreement_too_large": (
+            "❌ *The File Too Big*\n\n"
+            "E no fit pass $max_agreement_mb MB.\n\n"
+            "Abeg make the PDF small come send am again."
+        ),
+        "agreement_processing": "⏳ We dey check your agreement...",
+        "agreement_invalid": (
+            "❌ *This Agreement File No Correct*\n\n"
+            "{reason}\n\n"
+            "Abeg upload the agreement wey you sign as normal PDF "
+            "wey no get password, then try again."
+        ),
+        "agreement_received": (
+            "✅ *We don collect your Agreement!*\n\n"
+            "🎉 Your account don dey active finish!\n\n"
+            "📌 *Wetin you go do next:*\n\n"
+            "1️⃣ Register for Naira Trading account:\n$naira_trader_link\n\n"
+            "2️⃣ Join our private group:\n$private_group_link\n\n"
+            "Welcome to MakeBankGuru! 🚀"
+        ),
+        "agreement_failed": (
+            "❌ *We no fit process the Agreement*\n\n"
+            "Something go wrong as we dey check your file.\n"
+            "Abeg try again or message support."
+        ),
+        "payment_not_confirmed": (
+            "⚠️ *We never confirm your Payment*\n\n"
+            "Abeg pay first before you upload the agreement.\n\n"
+            "Use /start make you collect your payment link."
+        ),
+        "payment_confirmed": (
+            "✅ *We don confirm your Payment!*\n\n"
+            "📋 *Wetin you go do next: Upload the agreement wey you don sign*\n\n"
+            "1️⃣ Download the agreement template for down\n"
+            "2️⃣ Fill your details and sign am\n"
+            "3️⃣ Scan or snap am, then turn am to PDF\n"
+            "4️⃣ Send the PDF file for this chat\n\n"
+            "⚠️ *Note am well:* Na only PDF file we dey collect."
+        ),
+        "button_pay": "💳 Pay ₦20,000",
+        "button_make_payment": "💳 Pay Now",
+        "button_download_agreement": "📄 Download the Agreement",
+    },
+    "yo": {
+        "welcome": (
+            "👋 *Ẹ kú àbọ̀ sí MakeBankGuru*\n\n"
+            "Láti bẹ̀rẹ̀ Iṣẹ́ Ìrànlọ́wọ́ Ìṣòwò yín:\n"
+            "1️⃣ Ẹ san owó\n"
+            "2️⃣ A ó fìdí ìsanwó múlẹ̀ fúnra wa\n"
+            "3️⃣ Ẹ fi àdéhùn tí ẹ ti buwọ́lù ránṣẹ́\n\n"
+            "Kò sí àyẹ̀wò ọwọ́ kankan."
+        ),
+        "status_unpaid": (
+            "⚠️ *Ipò Ìsanwó: A kò tíì rí i*\n\n"
+            "Ẹ jọ̀wọ́ ẹ kọ́kọ́ san owó.\n"
+            "Ẹ lo /start láti gba ìlànà ìsanwó."
+        ),
+        "status_activated": (
+            "✅ *Ipò: Ohun gbogbo ti ṣetán*\n\n"
+            "🔗 Ẹ forúkọ sílẹ̀ fún Naira Trading Account yín:\n$naira_trader_link\n\n"
+            "👥 Ẹ darapọ̀ mọ́ ẹgbẹ́ àdáni wa:\n$private_group_link"
+        ),
+        "status_awaiting_agreement": (
+            "✅ *Ìsanwó: A ti fìdí rẹ̀ múlẹ̀*\n"
+            "⏳ *Àdéhùn: Kò tíì dé*\n\n"
+            "📋 *Ìgbésẹ̀ tó kàn: Ẹ fi àdéhùn tí ẹ ti buwọ́lù ránṣẹ́*\n\n"
+            "1️⃣ Ẹ gba fọ́ọ̀mù àdéhùn nísàlẹ̀\n"
+            "2️⃣ Ẹ kọ àlàyé yín síi kí ẹ sì buwọ́lù ú\n"
+            "3️⃣ Ẹ yà á ní fọ́tò kí ẹ sì sọ ọ́ di PDF\n"
+            "4️⃣ Ẹ fi fáìlì PDF náà ránṣẹ́ síbí\n\n"
+            "⚠️ *Ẹ kíyèsí:* Fáìlì PDF nìkan ni a ń gbà."
+        ),
+        "help": (
+            "ℹ️ *Ìrànlọ́wọ́ MakeBankGuru Bot*\n\n"
+            "*Àwọn àṣẹ tí ẹ lè lò:*\n"
+            "/start - Ẹ forúkọ sílẹ̀ kí ẹ sì sanwó\n"
+            "/status - Ẹ wo ibi tí ẹ dé\n"
+            "/language - Ẹ yí èdè bot padà\n"
+            "/help - Ẹ wo ìrànlọ́wọ́ yìí\n\n"
+            "*Bí ó ṣe ń ṣiṣẹ́:*\n"
+            "1️⃣ Ẹ lo /start láti gba ìlànà ìsanwó\n"
+            "2️⃣ Ẹ san ₦20,000 níbẹ̀\n"
+            "3️⃣ A ó fìdí ìsanwó múlẹ̀ fúnra wa\n"
+            "4️⃣ Ẹ fi PDF àdéhùn tí ẹ ti buwọ́lù ránṣẹ́\n"
+            "5️⃣ Ẹ wọ Naira Trader àti ẹgbẹ́ àdáni wa\n\n"
+            "*Ṣé ẹ nílò ìrànlọ́wọ́?*\n"
+            "Ẹ kàn sí: @MakeBankGuru"
+        ),
+        "choose_language": "🌐 Ẹ yan èdè yín:",
+        "language_set": "✅ A ó máa bá yín sọ̀rọ̀ ní Yorùbá.",
+        "throttled": "⏳ Ẹ ti fi ọ̀pọ̀ ìfiránṣẹ́ ránṣẹ́ jù. Ẹ jọ̀wọ́ ẹ dúró fún {seconds}s kí ẹ tó tún gbìyànjú.",
+        "agreement_duplicate": (
+            "✅ *A ti gba Àdéhùn yín tẹ́lẹ̀*\n\n"
+            "Ìwé yìí ti wà lọ́dọ̀ wa, ẹ kò nílò láti tún un fi ránṣẹ́.\n\n"
+            "🔗 Naira Trading account:\n$naira_trader_link\n\n"
+            "👥 Ẹgbẹ́ àdáni:\n$private_group_link"
+        ),
+        "agreement_not_pdf": (
+            "❌ *Irú Fáìlì Tí Kò Tọ́*\n\n"
+            "Fáìlì PDF nìkan ni a ń gbà.\n\n"
+            "Ẹ jọ̀wọ́ ẹ sọ àdéhùn yín di PDF kí ẹ sì tún gbìyànjú."
+        ),
+        "agreement_too_large": (
+            "❌ *Fáìlì Ti Tóbi Jù*\n\n"
+            "Kò gbọdọ̀ ju $max_agreement_mb MB lọ.\n\n"
+            "Ẹ jọ̀wọ́ ẹ dín PDF náà kù kí ẹ sì tún gbìyànjú."
+        ),
+        "agreement_processing": "⏳ A ń ṣàyẹ̀wò àdéhùn yín...",
+        "agreement_invalid": (
+            "❌ *Fáìlì Àdéhùn Kò Tọ́*\n\n"
+            "{reason}\n\n"
+            "Ẹ jọ̀wọ́ ẹ fi àdéhùn tí ẹ buwọ́lù ránṣẹ́ gẹ́gẹ́ bí PDF "
+            "lásán tí kò ní ọ̀rọ̀ aṣínà, kí ẹ sì tún gbìyànjú."
+        ),
+        "agreement_received": (
+            "✅ *A ti gba Àdéhùn yín!*\n\n"
+            "🎉 Àkáǹtì yín ti ṣiṣẹ́ pátápátá!\n\n"
+            "📌 *Àwọn ìgbésẹ̀ tó kàn:*\n\n"
+            "1️⃣ Ẹ forúkọ sílẹ̀ fún Naira Trading account:\n$naira_trader_link\n\n"
+            "2️⃣ Ẹ darapọ̀ mọ́ ẹgbẹ́ àdáni wa:\n$private_group_link\n\n"
+            "Ẹ kú àbọ̀ sí MakeBankGuru! 🚀"
+        ),
+        "agreement_failed": (
+            "❌ *A kò lè ṣàyẹ̀wò Àdéhùn náà*\n\n"
+            "Àṣìṣe kan ṣẹlẹ̀ nígbà tí a ń ṣàyẹ̀wò fáìlì yín.\n"
+            "Ẹ jọ̀wọ́ ẹ tún gbìyànjú tàbí kí ẹ kàn sí wa."
+        ),
+        "payment_not_confirmed": (
+            "⚠️ *A kò tíì fìdí Ìsanwó yín múlẹ̀*\n\n"
+            "Ẹ jọ̀wọ́ ẹ kọ́kọ́ sanwó kí ẹ tó fi àdéhùn ránṣẹ́.\n\n"
+            "Ẹ lo /start láti gba ìlànà ìsanwó yín."
+        ),
+        "payment_confirmed": (
+            "✅ *A ti fìdí Ìsanwó yín múlẹ̀!*\n\n"
+            "📋 *Ìgbésẹ̀ tó kàn: Ẹ fi àdéhùn tí ẹ ti buwọ́lù ránṣẹ́*\n\n"
+            "1️⃣ Ẹ gba fọ́ọ̀mù àdéhùn nísàlẹ̀\n"
+            "2️⃣ Ẹ kọ àlàyé yín síi kí ẹ sì buwọ́lù ú\n"
+            "3️⃣ Ẹ yà á ní fọ́tò kí ẹ sì sọ ọ́ di PDF\n"
+            "4️⃣ Ẹ fi fáìlì PDF náà ránṣẹ́ síbí\n\n"
+            "⚠️ *Ẹ kíyèsí:* Fáìlì PDF nìkan ni a ń gbà."
+        ),
+        "button_pay": "💳 Ẹ san ₦20,000",
+        "button_make_payment": "💳 Ẹ sanwó",
+        "button_download_agreement": "📄 Ẹ gba fọ́ọ̀mù Àdéhùn",
+    },
+}
+
+# Keyboard name -> rows of (button text key, URL template)
+KEYBOARDS = {
+    "pay": [[("button_pay", "{url}")]],
+    "make_payment": [[("button_make_payment", "$payment_link?amount=$payment_amount")]],
+    "download_agreement": [[("button_download_agreement", "$agreement_link")]],
+}
+
+
+# ================== REGISTRY ==================
+class TemplateRegistry:
+    """
+    Every language's texts and keyboards with the startup context
+    substituted. Lookups for an unknown language use the default one.
+    """
+
+    def __init__(self, context: dict, default_language: str = DEFAULT_LANGUAGE):
+        self.default_language = default_language if default_language in TEXTS else DEFAULT_LANGUAGE
+        self._texts = {}
+        self._keyboards = {}
+
+        for lang in TEXTS:
+            texts = {**TEXTS[DEFAULT_LANGUAGE], **TEXTS[lang]}
+            self._texts[lang] = {
+                key: Template(text).safe_substitute(context) for key, text in texts.items()
+            }
+            self._keyboards[lang] = {}
+            for name, rows in KEYBOARDS.items():
+                rows = [
+                    [(self._texts[lang][label], Template(url).safe_substitute(context)) for label, url in row]
+                    for row in rows
+                ]
+                # Keyboards with per-request URLs are built on each lookup
+                if any("{" in url for row in rows for _, url in row):
+                    self._keyboards[lang][name] = rows
+                else:
+                    self._keyboards[lang][name] = self._markup(rows)
+
+        logger.info("🌐 Templates rendered for %s", ", ".join(TEXTS))
+
+    def language(self, lang: str = None) -> str:
+        return lang if lang in self._texts else self.default_language
+
+    def text(self, key: str, lang: str = None, **fields) -> str:
+        text = self._texts[self.language(lang)][key]
+        return text.format(**fields) if fields else text
+
+    def keyboard(self, name: str, lang: str = None, **fields) -> InlineKeyboardMarkup:
+        keyboard = self._keyboards[self.language(lang)][name]
+        if isinstance(keyboard, InlineKeyboardMarkup):
+            return keyboard
+        return self._markup([[(text, url.format(**fields)) for text, url in row] for row in keyboard])
+
+    @staticmethod
+    def _markup(rows) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=text, url=url) for text, url in row] for row in rows
+        ])
+
+
+def language_for(data: dict, user=None) -> str:
+    """
+    A user's language: their /language choice from the FSM data, else
+    their Telegram client's language if we have it, else None.
+    """
+    if data.get("lang") in TEXTS:
+        return data["lang"]
+    code = (getattr(user, "language_code", None) or "").split("-")[0].lower()
+    return code if code in TEXTS else None
+
+
+def escape_markdown(text) -> str:
+    """
+    Escape user-supplied text (usernames and the like) for parse_mode="Markdown".
+    """
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+# ================== MIDDLEWARE ==================
+class LanguageMiddleware(BaseMiddleware):
+    """
+    Message outer middleware passing the sender's language to handlers
+    as `lang`.
+    """
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        stored = await state.get_data() if state is not None else {}
+        data["lang"] = language_for(stored, data.get("event_from_user"))
+        return await handler(event, data)
@@ -0,0 +1,18 @@
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db_path(monkeypatch, tmp_path) -> str:
+    """
+    Point the database module at a fresh file. init_db() is left to the test.
+    """
+    path = str(tmp_path / "users.db")
+    monkeypatch.setattr(database, "DB_PATH", path)
+    # Synced by hand rather than by the background loop
+    monkeypatch.setattr(database, "USER_CACHE_SYNC_SECONDS", 0)
+    # Nothing cached from another test's database
+    database._user_cache.clear()
+    database._fsm_cache.clear()
+    return path
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import cache
+import database
+from cache import TTLCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Marks user 42 paid from a separate process sharing the database file
+OTHER_PROCESS = """
+import asyncio
+import database
+
+async def main():
+    await database.init_db()
+    assert await database.mark_payment_paid("KPY-42", telegram_id=42)
+    await database.close_db()
+
+asyncio.run(main())
+"""
+
+
+def test_expires_and_evicts(monkeypatch):
+    clock = SimpleNamespace(monotonic=lambda: now)
+    monkeypatch.setattr(cache, "time", clock)
+    now = 1000.0
+    users = TTLCache(maxsize=2, ttl=60)
+
+    users.set("a", 1)
+    users.set("b", 2)
+    users.get("a")
+    users.set("c", 3)
+    # "b" was the least recently used
+    assert users.get("b") is None
+    now += 61
+    assert users.get("a") is None
+    assert users.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_fill_started_before_invalidate_is_refused():
+    users = TTLCache()
+    users.set(42, "unpaid")
+
+    # A read starts, the payment lands, then the read tries to fill
+    ticket = users.ticket()
+    users.invalidate(42)
+    users.set(42, "unpaid", ticket)
+    assert users.get(42) is None
+
+    # A read started after the invalidation fills normally
+    users.set(42, "paid", users.ticket())
+    assert users.get(42) == "paid"
+
+
+def test_invalidate_only_refuses_fills_for_its_key():
+    users = TTLCache()
+    ticket = users.ticket()
+    users.invalidate(42)
+    users.set(7, "other", ticket)
+    assert users.get(7) == "other"
+
+
+def test_forgotten_invalidations_refuse_older_fills():
+    users = TTLCache(maxsize=2)
+    ticket = users.ticket()
+    for key in (1, 2, 3):
+        users.invalidate(key)
+    # Key 1's invalidation was forgotten, but the floor still covers it
+    users.set(1, "stale", ticket)
+    assert users.get(1) is None
+
+
+def test_clear_refuses_fills_in_flight():
+    users = TTLCache()
+    ticket = users.ticket()
+    users.clear()
+    users.set(42, "stale", ticket)
+    assert users.get(42) is None
+
+
+def test_payment_is_not_read_stale_from_cache(db_path):
+    async def run():
+        await database.init_db()
+        try:
+            await database.create_pending_payment(42, "ada", "MBG-42-1")
+            assert not await database.is_payment_paid(42)
+            assert await database.mark_payment_paid("KPY-42", telegram_id=42)
+            return await database.is_payment_paid(42)
+        finally:
+            await database.close_db()
+
+    assert asyncio.run(run())
+
+
+def test_invalidation_from_another_process(db_path, tmp_path):
+    async def run():
+        await database.init_db()
+        try:
+            await database.create_pending_payment(42, "ada", "MBG-42-1")
+            await database.flush_pending_payments()
+            # Cached as not paid
+            assert not await database.is_payment_paid(42)
+
+            subprocess.run(
+                [sys.executable, "-c", OTHER_PROCESS], check=True, cwd=tmp_path,
+                env={**os.environ, "DB_PATH": db_path, "PYTHONPATH": ROOT}
+            )
+            assert not await database.is_payment_paid(42)
+
+            await database.sync_user_cache()
+            return await database.is_payment_paid(42)
+        finally:
+            await database.close_db()
+
+    assert asyncio.run(run())
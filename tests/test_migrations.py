@@ -0,0 +1,174 @@
+import asyncio
+import datetime
+import sqlite3
+
+import aiosqlite
+
+from migrations import MIGRATIONS, apply_migrations
+
+# The schema init_db() created before migrations existed
+BASELINE_SCHEMA = """
+    CREATE TABLE pending_payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        username TEXT,
+        payment_reference TEXT UNIQUE,
+        korapay_reference TEXT,
+        status TEXT DEFAULT 'pending',
+        date_created TEXT
+    );
+    CREATE TABLE verified_users (
+        telegram_id INTEGER PRIMARY KEY,
+        username TEXT,
+        payment_reference TEXT,
+        korapay_reference TEXT,
+        payment_status TEXT DEFAULT 'pending',
+        date_payment_verified TEXT,
+        agreement_signed INTEGER DEFAULT 0,
+        date_agreement_signed TEXT
+    );
+"""
+
+# Local-time isoformat() strings, as the baseline wrote them
+STARTED = "2026-01-15T10:30:00.123456"
+PAID = "2026-01-15T11:05:00.000001"
+SIGNED = "2026-01-16T09:00:00"
+
+
+def epoch(local_iso: str) -> int:
+    return int(datetime.datetime.fromisoformat(local_iso).timestamp())
+
+
+def day(local_iso: str) -> int:
+    return epoch(local_iso) // 86400 * 86400
+
+
+def baseline_db(path: str):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO pending_payments (telegram_id, username, payment_reference, status, date_created) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [
+            (1, "ada", "MBG-1-1", "pending", STARTED),
+            (2, "bola", "MBG-2-1", "paid", STARTED),
+            (3, "chidi", "MBG-3-1", "paid", STARTED),
+        ]
+    )
+    conn.executemany(
+        "INSERT INTO verified_users (telegram_id, username, payment_reference, korapay_reference, "
+        "payment_status, date_payment_verified, agreement_signed, date_agreement_signed) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (2, "bola", "MBG-2-1", "KPY-2", "paid", PAID, 1, SIGNED),
+            (3, "chidi", "MBG-3-1", "KPY-3", "paid", PAID, 0, None),
+            # Verified before the payment date was recorded
+            (4, "dayo", "MBG-4-1", "KPY-4", "paid", None, 0, None),
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+
+def migrate(path: str, *statements):
+    """
+    Apply the migrations to the database at `path`, then run `statements`.
+    Returns the versions applied.
+    """
+    async def run():
+        async with aiosqlite.connect(path) as conn:
+            applied = await apply_migrations(conn)
+            for sql in statements:
+                await conn.execute(sql)
+            await conn.commit()
+            return applied
+    return asyncio.run(run())
+
+
+def query(path: str, sql: str, params=()):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def counters(path: str) -> dict:
+    return dict(query(path, "SELECT name, value FROM stats_counters"))
+
+
+def funnel_day(path: str, bucket: int):
+    return query(
+        path,
+        "SELECT started, paid, signed FROM funnel_buckets WHERE granularity='day' AND bucket=?",
+        (bucket,)
+    )[0]
+
+
+def test_applies_every_migration_once(tmp_path):
+    path = str(tmp_path / "users.db")
+    baseline_db(path)
+
+    assert migrate(path) == [version for version, _, _ in MIGRATIONS]
+    assert len(MIGRATIONS) == 15
+    assert migrate(path) == []
+
+
+def test_converts_baseline_data(tmp_path):
+    path = str(tmp_path / "users.db")
+    baseline_db(path)
+    migrate(path)
+
+    assert query(path, "SELECT created_at FROM pending_payments WHERE telegram_id=1") == [
+        (epoch(STARTED),)
+    ]
+    assert query(
+        path,
+        "SELECT telegram_id, payment_verified_at, agreement_signed_at FROM verified_users ORDER BY telegram_id"
+    ) == [
+        (2, epoch(PAID), epoch(SIGNED)),
+        (3, epoch(PAID), None),
+        # Missing dates sort first in the /users keyset
+        (4, 0, None),
+    ]
+    # The old columns are kept for the previous release
+    assert query(path, "SELECT date_created FROM pending_payments WHERE telegram_id=1") == [(STARTED,)]
+
+
+def test_seeds_stats_and_funnel(tmp_path):
+    path = str(tmp_path / "users.db")
+    baseline_db(path)
+    migrate(path)
+
+    assert counters(path) == {"pending_payments": 1, "paid_users": 3, "signed_agreements": 1}
+    assert funnel_day(path, day(STARTED)) == (3, 2, 0)
+    assert funnel_day(path, day(SIGNED)) == (0, 0, 1)
+    assert funnel_day(path, 0) == (0, 1, 0)
+
+
+def test_triggers_keep_stats_and_funnel_in_sync(tmp_path):
+    path = str(tmp_path / "users.db")
+    baseline_db(path)
+    now = epoch(SIGNED)
+    migrate(
+        path,
+        # A new user starts and pays
+        f"INSERT INTO pending_payments (telegram_id, payment_reference, status, created_at) "
+        f"VALUES (5, 'MBG-5-1', 'pending', {now})",
+        "UPDATE pending_payments SET status='paid' WHERE telegram_id=5",
+        f"INSERT INTO verified_users (telegram_id, payment_status, payment_verified_at) "
+        f"VALUES (5, 'paid', {now})",
+        # An earlier user signs, and the unpaid one's reference expires
+        f"UPDATE verified_users SET agreement_signed=1, agreement_signed_at={now} WHERE telegram_id=3",
+        "DELETE FROM pending_payments WHERE telegram_id=1",
+        # Updates that change nothing the stats count
+        "UPDATE verified_users SET payment_status='paid' WHERE telegram_id=2",
+        "UPDATE pending_payments SET status='paid' WHERE telegram_id=2",
+    )
+
+    assert counters(path) == {"pending_payments": 0, "paid_users": 4, "signed_agreements": 2}
+    assert funnel_day(path, day(SIGNED)) == (1, 1, 2)
+    assert funnel_day(path, day(STARTED)) == (3, 2, 0)
+
+    migrate(path, "DELETE FROM verified_users WHERE telegram_id=2")
+    assert counters(path) == {"pending_payments": 0, "paid_users": 3, "signed_agreements": 1}
@@ -0,0 +1,56 @@
+from payments import SignatureVerifier, parse_webhook_body, webhook_event_key
+
+SECRET_KEY = "sk_test_reviewkey"
+
+# Shaped like a Korapay charge.success webhook: whole-number amounts and
+# fees sent as floats, and non-ASCII names
+KORAPAY_WEBHOOK = (
+    '{"event":"charge.success","data":{"reference":"KPY-CA-9kPq2XfWzR4bTm1",'
+    '"currency":"NGN","amount":20000.0,"amount_expected":20000.00,"fee":300.0,'
+    '"status":"success","payment_method":"bank_transfer",'
+    '"payment_reference":"MBG-123456789-1760659200",'
+    '"transaction_date":"2026-10-17 02:15:42",'
+    '"virtual_bank_account_details":{"payer_bank_account":{"account_name":"Adébáyọ̀ Ọlá",'
+    '"account_number":"0123456789","bank_name":"Access Bank"},'
+    '"virtual_bank_account":{"account_name":"MakeBankGuru","account_number":"9977581536",'
+    '"bank_name":"Wema Bank","bank_code":"035"}},'
+    '"metadata":{"telegram_id":"123456789"}}}'
+)
+
+# HMAC-SHA256 of JSON.stringify(body.data), computed with Node.js
+KORAPAY_SIGNATURE = "bb1326dc4089d75194e9195bc8ba17f87a1285bd7421f564d89319b98f5fea42"
+
+
+def test_verifies_korapay_signature():
+    body = parse_webhook_body(KORAPAY_WEBHOOK)
+    assert SignatureVerifier(SECRET_KEY).verify(body["data"], KORAPAY_SIGNATURE)
+
+
+def test_rejects_tampered_payload():
+    body = parse_webhook_body(KORAPAY_WEBHOOK)
+    body["data"]["amount"] = 200
+    assert not SignatureVerifier(SECRET_KEY).verify(body["data"], KORAPAY_SIGNATURE)
+
+
+def test_numbers_encode_like_json_stringify():
+    data = parse_webhook_body('{"amount":20000.0,"fee":150.75,"vat":-0.0}')
+    # JSON.stringify gives {"amount":20000,"fee":150.75,"vat":0}
+    assert SignatureVerifier(SECRET_KEY).sign(data) == (
+        "037acd1e2815eaeb2302dc4813a8f642c9b37b6476eef6fa0e9868861500eb7b"
+    )
+
+
+def test_event_key_falls_back_to_merchant_reference_then_payload_hash():
+    assert webhook_event_key("charge.success", {"reference": "KPY-1", "payment_reference": "MBG-1-2"}) == (
+        "charge.success:KPY-1"
+    )
+    assert webhook_event_key("charge.success", {"metadata": {"payment_reference": "MBG-1-2"}}) == (
+        "charge.success:MBG-1-2"
+    )
+
+    first = webhook_event_key("charge.success", {"amount": 20000, "customer": {"email": "a@example.com"}})
+    second = webhook_event_key("charge.success", {"amount": 20000, "customer": {"email": "b@example.com"}})
+    assert first.startswith("charge.success:sha256:")
+    assert first != second
+    # Key order doesn't matter
+    assert first == webhook_event_key("charge.success", {"customer": {"email": "a@example.com"}, "amount": 20000})
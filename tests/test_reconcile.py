@@ -0,0 +1,116 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+import database
+from reconcile import Reconciler, parse_amount
+
+CSV_EXPORT = """\
+Transaction Reference,Merchant Reference,Amount,Status
+KPY-1,MBG-1-100,"20,000.00",success
+KPY-2,MBG-2-100,"NGN 20,000",Successful
+KPY-5,MBG-5-100,20000,success
+KPY-9,MBG-999-1,20000,success
+KPY-3,MBG-3-100,twenty thousand,success
+KPY-6,MBG-3-100,20000,failed
+KPY-7,MBG-4-100,500,success
+KPY-1,MBG-1-100,20000,success
+"""
+
+JSON_EXPORT = {"data": [
+    {"reference": "KPY-3", "payment_reference": "MBG-3-100", "amount": 20000.0, "status": "success"},
+    {"reference": "KPY-8", "payment_reference": "MBG-4-100", "amount": "₦20,000.00", "status": "failed"},
+]}
+
+
+def test_parses_amounts():
+    assert parse_amount(20000) == 20000.0
+    assert parse_amount("20,000.00") == 20000.0
+    assert parse_amount("₦20,000") == 20000.0
+    assert parse_amount("NGN 20,000.50") == 20000.5
+    assert parse_amount("20000 NGN") == 20000.0
+    for value in ("", None, "abc", "20.000,00", "2,00,000"):
+        with pytest.raises(ValueError):
+            parse_amount(value)
+
+
+async def seed():
+    await database.init_db()
+    for telegram_id in (1, 2, 3, 4, 5):
+        await database.create_pending_payment(telegram_id, f"user{telegram_id}", f"MBG-{telegram_id}-100")
+    assert await database.mark_payment_paid("KPY-5", telegram_id=5)
+
+
+def reconcile(source, report, **kwargs):
+    paid_hook = []
+
+    async def on_paid(telegram_id):
+        paid_hook.append(telegram_id)
+
+    async def run():
+        await seed()
+        try:
+            summary = await Reconciler(batch_size=2, on_paid=on_paid, **kwargs).run(str(source), str(report))
+            paid = [telegram_id for telegram_id in (1, 2, 3, 4) if await database.is_payment_paid(telegram_id)]
+            unmatched = [payment["korapay_reference"] for payment in await database.get_unmatched_payments()]
+            return summary, paid, unmatched
+        finally:
+            await database.close_db()
+
+    summary, paid, unmatched = asyncio.run(run())
+    return summary, paid, unmatched, paid_hook
+
+
+def read_report(path):
+    with open(path, newline="") as f:
+        return [(row["outcome"], row["korapay_reference"], row["telegram_id"]) for row in csv.DictReader(f)]
+
+
+def test_reconciles_csv_export(db_path, tmp_path):
+    source, report = tmp_path / "export.csv", tmp_path / "report.csv"
+    source.write_text(CSV_EXPORT, encoding="utf-8")
+
+    summary, paid, unmatched, paid_hook = reconcile(source, report)
+
+    assert summary == {
+        "marked_paid": 2, "already_paid": 2, "unmatched": 1, "skipped": 2, "error": 1,
+        "still_pending": 2,
+    }
+    assert read_report(report) == [
+        ("marked_paid", "KPY-1", "1"),
+        ("marked_paid", "KPY-2", "2"),
+        ("already_paid", "KPY-5", ""),
+        ("unmatched", "KPY-9", ""),
+        ("error", "KPY-3", ""),
+        ("skipped", "KPY-6", ""),
+        ("skipped", "KPY-7", ""),
+        ("already_paid", "KPY-1", ""),
+    ]
+    assert paid == [1, 2]
+    assert sorted(paid_hook) == [1, 2]
+    assert unmatched == ["KPY-9"]
+
+
+def test_reconciles_json_export(db_path, tmp_path):
+    source, report = tmp_path / "export.json", tmp_path / "report.csv"
+    source.write_text(json.dumps(JSON_EXPORT), encoding="utf-8")
+
+    summary, paid, unmatched, _ = reconcile(source, report)
+
+    assert summary["marked_paid"] == 1
+    assert summary["skipped"] == 1
+    assert read_report(report) == [("marked_paid", "KPY-3", "3"), ("skipped", "KPY-8", "")]
+    assert paid == [3]
+    assert unmatched == []
+
+
+def test_dry_run_changes_nothing(db_path, tmp_path):
+    source, report = tmp_path / "export.csv", tmp_path / "report.csv"
+    source.write_text(CSV_EXPORT, encoding="utf-8")
+
+    summary, paid, unmatched, paid_hook = reconcile(source, report, dry_run=True)
+
+    assert summary["marked_paid"] == 2
+    assert paid == [] and unmatched == [] and paid_hook == []
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.types import Chat, Message, Update, User
+
+import throttle
+from throttle import SlidingWindowLog, ThrottleMiddleware, parse_throttle_rules
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def test_parses_throttle_rules():
+    assert parse_throttle_rules(" /Start=3/60, document=5/30.5,") == {
+        "start": (3, 60.0),
+        "document": (5, 30.5),
+    }
+    assert parse_throttle_rules(None) == {}
+    assert parse_throttle_rules("") == {}
+
+
+def test_window_allows_limit_then_reports_retry_after(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    log = SlidingWindowLog()
+
+    assert [log.hit("user", 3, 60) for _ in range(3)] == [0, 0, 0]
+    clock.now += 20
+    assert log.hit("user", 3, 60) == 40
+    # Other keys have their own window
+    assert log.hit("other", 3, 60) == 0
+
+
+def test_window_slides(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    log = SlidingWindowLog()
+
+    log.hit("user", 2, 10)
+    clock.now += 6
+    log.hit("user", 2, 10)
+    clock.now += 5
+    # The first hit has left the window, the second hasn't
+    assert log.hit("user", 2, 10) == 0
+    assert log.hit("user", 2, 10) == 5
+
+
+def test_sweeps_idle_keys(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    log = SlidingWindowLog(sweep_interval=30)
+
+    log.hit("idle", 1, 10)
+    clock.now += 25
+    log.hit("active", 1, 10)
+    clock.now += 6
+    log.hit("new", 1, 10)
+    assert len(log) == 2
+    assert log.hit("idle", 1, 10) == 0
+
+
+def test_evicts_oldest_key_when_full(monkeypatch):
+    fake_clock(monkeypatch)
+    log = SlidingWindowLog(max_keys=2)
+
+    for key in ("a", "b", "c"):
+        log.hit(key, 1, 60)
+    assert len(log) == 2
+    # "a" was forgotten, so it's allowed again
+    assert log.hit("a", 1, 60) == 0
+
+
+def make_update(update_id: int, text: str) -> Update:
+    user = User(id=42, is_bot=False, first_name="Ada")
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=0, chat=Chat(id=42, type="private"), from_user=user, text=text
+    ))
+
+
+def test_middleware_drops_excess_messages_and_notifies_once(monkeypatch):
+    fake_clock(monkeypatch)
+    notices = []
+
+    async def on_throttled(message, data, retry_after):
+        notices.append(retry_after)
+
+    async def handler(event, data):
+        return "handled"
+
+    middleware = ThrottleMiddleware(
+        {"start": (2, 60)}, exempt={1}, on_throttled=on_throttled, log=SlidingWindowLog()
+    )
+
+    async def feed(text):
+        update = make_update(1, text)
+        return await middleware(handler, update, {"event_from_user": update.message.from_user})
+
+    async def run():
+        return [await feed("/start") for _ in range(4)] + [await feed("hello")]
+
+    assert asyncio.run(run()) == ["handled", "handled", None, None, "handled"]
+    assert notices == [60]
+
+
+def test_middleware_splits_limits_between_processes():
+    middleware = ThrottleMiddleware({"start": (3, 60)}, processes=2)
+    assert middleware.rules["start"] == (2, 60)
+    assert middleware.rules["message"] == (10, 10)
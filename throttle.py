@@ -0,0 +1,142 @@
+import logging
+import math
+import time
+from collections import deque
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, Update
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+THROTTLED_MESSAGES = Counter(
+    "bot_throttled_messages_total", "User messages dropped by the anti-flood middleware"
+)
+
+# Bucket -> (messages, window seconds). Buckets are command names,
+# "document" for uploads and "message" for everything else.
+DEFAULT_THROTTLE_RULES = {
+    "start": (3, 60),
+    "status": (10, 60),
+    "document": (5, 60),
+    "message": (20, 10),
+}
+
+
+def parse_throttle_rules(spec: str) -> dict:
+    """
+    "start=3/60,document=5/60" -> {"start": (3, 60.0), "document": (5, 60.0)}
+    """
+    rules = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        bucket, _, limit = item.partition("=")
+        count, _, window = limit.partition("/")
+        rules[bucket.strip().lstrip("/").lower()] = (int(count), float(window))
+    return rules
+
+
+# ================== SLIDING WINDOW LOG ==================
+class SlidingWindowLog:
+    """
+    Timestamps of each key's recent hits, at most `limit` per key. Keys
+    idle for longer than the longest window seen are swept every
+    `sweep_interval` seconds, and once more than `max_keys` are tracked.
+    """
+
+    def __init__(self, max_keys: int = 100000, sweep_interval: float = 60):
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self.max_window = 0
+        self.swept_at = time.monotonic()
+        self._hits = {}
+
+    def hit(self, key, limit: int, window: float) -> float:
+        """
+        Record a hit for `key` if fewer than `limit` happened in the last
+        `window` seconds. Returns 0 if it was recorded, otherwise the
+        seconds until the oldest hit leaves the window.
+        """
+        now = time.monotonic()
+        self.max_window = max(self.max_window, window)
+        if now - self.swept_at >= self.sweep_interval:
+            self.sweep(now)
+
+        hits = self._hits.get(key)
+        if hits is None:
+            if len(self._hits) >= self.max_keys:
+                self.sweep(now)
+                if len(self._hits) >= self.max_keys:
+                    # Still full of active keys: forget the oldest one
+                    del self._hits[next(iter(self._hits))]
+            hits = self._hits[key] = deque(maxlen=limit)
+
+        if len(hits) >= limit and now - hits[0] < window:
+            return window - (now - hits[0])
+        hits.append(now)
+        return 0
+
+    def sweep(self, now: float = None):
+        now = now or time.monotonic()
+        self._hits = {
+            key: hits for key, hits in self._hits.items()
+            if hits and now - hits[-1] < self.max_window
+        }
+        self.swept_at = now
+
+    def __len__(self):
+        return len(self._hits)
+
+
+# ================== MIDDLEWARE ==================
+class ThrottleMiddleware(BaseMiddleware):
+    """
+    Update outer middleware dropping a user's messages once they exceed
+    their bucket's rule. Registered after aiogram's user context and
+    before its FSM context, so a dropped message costs no storage or
+    database lookup. Other update types pass through.
+    `on_throttled(message, data, retry_after)` runs for the first
+    dropped message of each window, e.g. to tell the user to slow down.
+
+    When a user's updates are spread over `processes` processes, each
+    allows its share of every limit (rounded up), so the user can't get
+    more than `processes - 1` messages past it in total.
+    """
+
+    def __init__(self, rules: dict = None, exempt=(), on_throttled=None, log: SlidingWindowLog = None,
+                 processes: int = 1):
+        self.rules = {
+            bucket: (math.ceil(limit / processes), window)
+            for bucket, (limit, window) in {**DEFAULT_THROTTLE_RULES, **(rules or {})}.items()
+        }
+        self.exempt = set(exempt)
+        self.on_throttled = on_throttled
+        self.log = log if log is not None else SlidingWindowLog()
+
+    def bucket(self, message: Message) -> str:
+        if message.document:
+            return "document"
+        text = message.text or ""
+        if text.startswith("/"):
+            command = text.split(maxsplit=1)[0][1:].split("@")[0].lower()
+            if command in self.rules:
+                return command
+        return "message"
+
+    async def __call__(self, handler, event: Update, data):
+        message = event.message
+        user = data.get("event_from_user")
+        if message is None or user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        bucket = self.bucket(message)
+        limit, window = self.rules.get(bucket, self.rules["message"])
+        retry_after = self.log.hit((user.id, bucket), limit, window)
+        if not retry_after:
+            return await handler(event, data)
+
+        THROTTLED_MESSAGES.inc(bucket=bucket)
+        logger.debug("🚦 Dropped %s message from user %s", bucket, user.id)
+        # One notice per window, however hard the user keeps trying
+        if self.on_throttled and not self.log.hit((user.id, "notice"), 1, window):
+            await self.on_throttled(message, data, retry_after)
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import os
+
+from aiogram import Bot, types
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+# ================== HASHING WRITER ==================
+class HashingWriter:
+    """
+    File-like sink for Bot.download_file: hashes chunks as they arrive and
+    aborts the download once more than `max_bytes` have been received.
+    """
+
+    def __init__(self, fileobj, max_bytes: int):
+        self.fileobj = fileobj
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk: bytes) -> int:
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"file exceeds {self.max_bytes} bytes")
+        self.sha256.update(chunk)
+        return self.fileobj.write(chunk)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def seek(self, *args):
+        return self.fileobj.seek(*args)
+
+
+# ================== UPLOAD PIPELINE ==================
+class AgreementUploadPipeline:
+    """
+    Streams uploaded documents to disk in chunks, hashing on the fly.
+
+    At most `workers` downloads run at once, so a burst of uploads can't
+    exhaust memory or file descriptors; extra uploads wait their turn.
+    Files are written to a `.part` path and renamed once complete.
+    """
+
+    def __init__(self, bot: Bot, max_bytes: int = 10 * 1024 * 1024, workers: int = 4,
+                 chunk_size: int = 64 * 1024):
+        self.bot = bot
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._semaphore = asyncio.Semaphore(workers)
+
+    def check_size(self, document: types.Document):
+        # Telegram reports the size up front; reject before downloading
+        if document.file_size and document.file_size > self.max_bytes:
+            raise UploadTooLarge(f"file is {document.file_size} bytes, limit {self.max_bytes}")
+
+    async def download(self, document: types.Document, destination: str) -> dict:
+        """
+        Download `document` to `destination`.
+        Returns {"path", "size", "sha256"}.
+        """
+        self.check_size(document)
+
+        async with self._semaphore:
+            file = await self.bot.get_file(document.file_id)
+            partial = destination + ".part"
+            try:
+                with open(partial, "wb") as f:
+                    writer = HashingWriter(f, self.max_bytes)
+                    await self.bot.download_file(
+                        file.file_path, writer, chunk_size=self.chunk_size, seek=False
+                    )
+                os.replace(partial, destination)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+
+        return {
+            "path": destination,
+            "size": writer.size,
+            "sha256": writer.sha256.hexdigest()
+        }
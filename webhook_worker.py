@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from database import (
+    set_webhook_event_status,
+    schedule_webhook_event_retry,
+    adopt_orphaned_webhook_events
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ================== WEBHOOK WORKER POOL ==================
+class WebhookWorkerPool:
+    """
+    Drains accepted webhook events in the background.
+
+    `process(data)` does the actual work on the charge `data` payload and returns the final
+    event status. Failures are retried with exponential backoff (plus
+    jitter) up to `max_attempts`; every state change is written to
+    webhook_events, so queued and retrying events survive a restart:
+    the leader instance adopts events whose owner is gone.
+    `on_give_up(event_key)` runs when an event is marked failed.
+    """
+
+    def __init__(self, process, workers: int = 4, max_attempts: int = 5,
+                 base_delay: float = 2, max_delay: float = 300, on_give_up=None):
+        self.process = process
+        self.on_give_up = on_give_up
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self._tasks = []
+        self._timers = set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("👷 Webhook workers started: %s", self.workers)
+
+    async def adopt_orphans(self):
+        """
+        Queue events that were accepted but not finished by an instance
+        that has since stopped (including this process's previous run).
+        """
+        events = await adopt_orphaned_webhook_events()
+        for event in events:
+            delay = max(0, (event["next_attempt_at"] or 0) - time.time())
+            data = json.loads(event["payload"] or "{}").get("data") or {}
+            self.enqueue(event["event_key"], data, event["attempts"], delay)
+        if events:
+            logger.info("📥 Adopted %s orphaned webhook events", len(events))
+
+    async def stop(self, drain: float = 0):
+        """
+        Stop the workers, first giving queued events up to `drain` seconds
+        to finish. Events still queued or waiting to retry stay in
+        webhook_events for the leader to adopt.
+        """
+        for timer in self._timers:
+            timer.cancel()
+        if drain > 0:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain)
+            except asyncio.TimeoutError:
+                logger.warning("⚠️ %s webhook events left for another instance", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, event_key: str, data: dict, attempts: int = 0, delay: float = 0):
+        item = (event_key, data, attempts)
+        if delay <= 0:
+            self.queue.put_nowait(item)
+            return
+
+        def release():
+            self._timers.discard(timer)
+            self.queue.put_nowait(item)
+
+        timer = asyncio.get_running_loop().call_later(delay, release)
+        self._timers.add(timer)
+
+    async def _worker(self):
+        while True:
+            event_key, data, attempts = await self.queue.get()
+            try:
+                status = await self.process(data)
+                await set_webhook_event_status(event_key, status)
+            except Exception as e:
+                await self._retry(event_key, data, attempts + 1, e)
+            finally:
+                self.queue.task_done()
+
+    async def _retry(self, event_key, data, attempts, error):
+        give_up = attempts >= self.max_attempts
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay *= random.uniform(0.8, 1.2)
+
+        await schedule_webhook_event_retry(
+            event_key, attempts, int(time.time() + delay), str(error), give_up
+        )
+
+        if give_up:
+            logger.error("❌ Webhook %s failed after %s attempts: %s", event_key, attempts, error)
+            if self.on_give_up:
+                self.on_give_up(event_key)
+            return
+
+        logger.info(
+            "🔁 Webhook %s attempt %s failed, retrying in %.0fs: %s",
+            event_key, attempts, delay, error
+        )
+        self.enqueue(event_key, data, attempts, delay)